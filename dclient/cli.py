@@ -1,16 +1,40 @@
+import base64
+import bz2
 import click
 from click_default_group import DefaultGroup
+import collections
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import csv
+import datetime
+import decimal
+import glob
+import gzip
+import hashlib
 import httpx
 import io
+import itertools
 import json
+import lzma
+import math
+import mmap
 import os
 import pathlib
-from sqlite_utils.utils import rows_from_file, Format, TypeTracker, progressbar
+import queue
+import signal
+import sqlite3
+from sqlite_utils.utils import (
+    rows_from_file,
+    Format,
+    RowError,
+    TypeTracker,
+    progressbar,
+)
 import sys
 import textwrap
+import threading
 import time
-from .utils import token_for_url
+from .utils import percentile, tilde_encode, token_for_url
 import urllib
 
 
@@ -140,6 +164,48 @@ def _output_rows(rows, fmt, columns=None):
         click.echo(json.dumps(rows, indent=2, default=str))
 
 
+def _stream_rows(rows, fmt, same_keys=True):
+    """
+    Like _output_rows(), but writes each row as soon as it arrives - except
+    for table output, which needs every row to work out the column widths.
+
+    CSV and TSV output takes its header from the first row. If the rows may
+    not all have the same keys, pass same_keys=False to read every row first
+    and output all of their columns.
+    """
+    if fmt == "table":
+        _output_table(list(rows))
+        return
+    if fmt in ("csv", "tsv") and not same_keys:
+        rows = list(rows)
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        _output_csv(rows, columns, delimiter="\t" if fmt == "tsv" else ",")
+        return
+    writer = buf = None
+    first = True
+    for row in rows:
+        if fmt == "nl":
+            click.echo(json.dumps(row, default=str))
+        elif fmt in ("csv", "tsv"):
+            if writer is None:
+                columns = list(row.keys())
+                buf = io.StringIO()
+                writer = csv.writer(buf, delimiter="\t" if fmt == "tsv" else ",")
+                writer.writerow(columns)
+            writer.writerow(str(row.get(col, "")) for col in columns)
+            click.echo(buf.getvalue(), nl=False)
+            buf.seek(0)
+            buf.truncate()
+        else:
+            click.echo("[" if first else ",")
+            click.echo(
+                textwrap.indent(json.dumps(row, indent=2, default=str), "  "), nl=False
+            )
+        first = False
+    if fmt == "json":
+        click.echo("[]" if first else "\n]")
+
+
 def _output_csv(rows, columns=None, delimiter=","):
     if not rows and not columns:
         return
@@ -486,27 +552,47 @@ def rows(
     all_rows = []
     col_names = None
     total = 0
-    next_page_url = None
-    first = True
 
-    while True:
-        if first:
-            response = _make_request(
-                url, token, f"/{db}/{table}.json", params=param_items
-            )
-            first = False
-        else:
-            # Follow next_url directly
-            headers = {}
-            if token:
-                headers["Authorization"] = f"Bearer {token}"
-            response = httpx.get(
-                next_page_url,
-                headers=headers,
-                follow_redirects=True,
-                timeout=30.0,
-            )
+    for data in _table_pages(url, token, f"/{db}/{table}.json", param_items):
+        page_rows = data.get("rows", [])
+        if col_names is None:
+            col_names = data.get("columns")
+
+        if limit:
+            remaining = limit - total
+            page_rows = page_rows[:remaining]
+
+        all_rows.extend(page_rows)
+        total += len(page_rows)
+
+        if limit and total >= limit:
+            break
+
+        if not fetch_all:
+            break
+
+    fmt = _determine_output_format(fmt_csv, fmt_tsv, fmt_nl, fmt_table)
+    _output_rows(all_rows, fmt, col_names)
+
+
+def _table_pages(url, token, path, params, client=None):
+    """
+    Fetch the JSON for a table one page at a time, following next_url.
 
+    Yields the decoded JSON for each page. The next page is only requested
+    once the previous one has been consumed.
+    """
+    headers = {}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    response = (client or httpx).get(
+        url.rstrip("/") + path,
+        headers=headers,
+        params=params,
+        follow_redirects=True,
+        timeout=30.0,
+    )
+    while True:
         if response.status_code != 200:
             try:
                 data = response.json()
@@ -520,28 +606,439 @@ def rows(
             raise click.ClickException(
                 "{} status code. {}".format(response.status_code, ": ".join(bits))
             )
-
         data = response.json()
-        page_rows = data.get("rows", [])
-        if col_names is None:
-            col_names = data.get("columns")
+        yield data
+        if not data.get("next_url"):
+            return
+        # Follow next_url directly
+        response = (client or httpx).get(
+            data["next_url"],
+            headers=headers,
+            follow_redirects=True,
+            timeout=30.0,
+        )
 
-        if limit:
-            remaining = limit - total
-            page_rows = page_rows[:remaining]
 
-        all_rows.extend(page_rows)
-        total += len(page_rows)
+# Longest URL that lookup will request - many servers and proxies refuse
+# URLs of more than 8KB
+MAX_URL_LENGTH = 4000
 
-        if limit and total >= limit:
-            break
 
-        next_page_url = data.get("next_url")
-        if not fetch_all or not next_page_url:
-            break
+@cli.command()
+@click.argument("database")
+@click.argument("table")
+@click.option(
+    "pks_from",
+    "--pks-from",
+    type=click.Path(allow_dash=True, dir_okay=False),
+    required=True,
+    help="File with the keys to look up",
+)
+@click.option("--key", default="id", help="Column to look the keys up in")
+@click.option("-i", "--instance", default=None, help="Datasette instance URL or alias")
+@click.option("--token", help="API token")
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of requests to run at once",
+)
+@click.option(
+    "--max-url-length",
+    type=click.IntRange(min=200),
+    default=MAX_URL_LENGTH,
+    help="Put as many keys in each request as fit in a URL this long",
+)
+@click.option(
+    "--missing",
+    type=click.Path(dir_okay=False),
+    help="Write keys that were not found to this file, one per line",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Verbose output: show HTTP request")
+@output_format_options
+def lookup(
+    database,
+    table,
+    pks_from,
+    key,
+    instance,
+    token,
+    concurrency,
+    max_url_length,
+    missing,
+    verbose,
+    fmt_csv,
+    fmt_tsv,
+    fmt_nl,
+    fmt_table,
+):
+    """
+    Fetch the rows for a list of keys
+
+    Keys are read one per line from a .txt file or standard input, or from
+    the --key column of a CSV, TSV, JSON or newline-delimited JSON file.
+    Each request looks up as many keys as fit in a URL using a key__in
+    filter, with several requests running at once. Rows are output in the
+    same order as the keys.
 
+    Example usage:
+
+    \b
+        dclient lookup data dogs --pks-from ids.txt -i myapp
+        dclient lookup data dogs --pks-from dogs.csv --key name --nl
+    """
+    config_dir = get_config_dir()
+    url = _resolve_instance(instance, config_dir / "config.json")
+    token = _resolve_token(
+        token, url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    keys = _read_keys(pks_from, key)
     fmt = _determine_output_format(fmt_csv, fmt_tsv, fmt_nl, fmt_table)
-    _output_rows(all_rows, fmt, col_names)
+    path = "/{}/{}.json".format(database, tilde_encode(table))
+    not_found = []
+
+    with contextlib.ExitStack() as stack:
+        client = stack.enter_context(
+            httpx.Client(limits=httpx.Limits(max_connections=concurrency))
+        )
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+
+        def fetch(chunk):
+            return chunk, _rows_by_key(client, url, token, path, key, chunk, verbose)
+
+        def found():
+            chunks = _in_chunks(keys, url, path, key, max_url_length)
+            for chunk, rows_by_key in _ordered_map(
+                executor, fetch, ((chunk,) for chunk in chunks), ahead=concurrency * 2
+            ):
+                for value in chunk:
+                    if value in rows_by_key:
+                        yield from rows_by_key[value]
+                    else:
+                        not_found.append(value)
+
+        _stream_rows(found(), fmt)
+
+    if missing:
+        pathlib.Path(missing).write_text("".join(value + "\n" for value in not_found))
+    if not_found:
+        shown = ", ".join(not_found[:10])
+        if len(not_found) > 10:
+            shown += " and {} more".format(len(not_found) - 10)
+        click.echo("{} keys were not found: {}".format(len(not_found), shown), err=True)
+
+
+def _read_keys(filepath, key):
+    """
+    Read keys, as strings, from a file with one key per line or from the key
+    column of a CSV, TSV, JSON or newline-delimited JSON file
+    """
+    try:
+        fp, _, _ = _open_input(filepath)
+    except OSError as ex:
+        raise click.ClickException(str(ex))
+    if filepath == "-" or _input_suffix(filepath) == ".txt":
+        lines = io.TextIOWrapper(fp, encoding="utf-8-sig")
+        return [line.strip() for line in lines if line.strip()]
+    rows, _ = _file_rows(fp, filepath)
+    keys = []
+    for row in rows:
+        if row.get(key) is None:
+            raise click.ClickException(
+                "Row has no {} value: {}".format(key, json.dumps(row, default=repr))
+            )
+        keys.append(str(row[key]))
+    return keys
+
+
+# Sniffing can't find the delimiter in a file with a single column, so input
+# formats go by the file extension where there is one
+INPUT_FORMATS = {
+    ".csv": Format.CSV,
+    ".tsv": Format.TSV,
+    ".json": Format.JSON,
+    ".ndjson": Format.NL,
+    ".jsonl": Format.NL,
+}
+
+
+def _input_suffix(filepath):
+    "The extension of an input file, ignoring any compression extension"
+    path = pathlib.Path(filepath)
+    if path.suffix in (".gz", ".bz2", ".xz", ".zst"):
+        path = path.with_suffix("")
+    return path.suffix
+
+
+def _file_rows(fp, filepath):
+    """
+    Read a CSV, TSV, JSON or newline-delimited JSON file, returning an
+    iterator over its rows and the Format it was read as
+    """
+    try:
+        rows, format = rows_from_file(
+            fp, format=INPUT_FORMATS.get(_input_suffix(filepath))
+        )
+    except Exception as ex:
+        raise click.ClickException(str(ex))
+
+    def checked_rows():
+        try:
+            yield from rows
+        except Exception as ex:
+            raise click.ClickException(str(ex))
+
+    return checked_rows(), format
+
+
+def _in_chunks(keys, url, path, column, max_url_length):
+    """
+    Split keys into lists that can each be looked up with a column__in filter
+    on a URL of at most max_url_length characters
+    """
+    base_length = len(
+        "{}{}?{}".format(
+            url.rstrip("/"),
+            path,
+            urllib.parse.urlencode(
+                {"_shape": "objects", "_size": "max", column + "__in": ""}
+            ),
+        )
+    )
+    chunk = []
+    # The length of the URL with the keys as a comma-separated list, and as
+    # a JSON list - which is needed if any of them contain a comma
+    length = json_length = base_length
+    use_json = False
+    for key in keys:
+        size = len(urllib.parse.quote_plus(key)) + 3
+        json_size = len(urllib.parse.quote_plus(json.dumps(key))) + 3
+        if use_json or _in_needs_json(key):
+            new_length = json_length + json_size
+        else:
+            new_length = length + size
+        if chunk and new_length > max_url_length:
+            yield chunk
+            chunk = []
+            length = json_length = base_length
+            use_json = False
+        chunk.append(key)
+        length += size
+        json_length += json_size
+        use_json = use_json or _in_needs_json(key)
+    if chunk:
+        yield chunk
+
+
+def _in_needs_json(key):
+    "Datasette reads __in values that start with [ as a JSON list"
+    return "," in key or key.startswith("[")
+
+
+def _rows_by_key(client, url, token, path, column, keys, verbose=False):
+    "Fetch the rows where column is one of keys, as {key: [rows]}"
+    keys = list(dict.fromkeys(keys))
+    if any(_in_needs_json(key) for key in keys):
+        value = json.dumps(keys, separators=(",", ":"))
+    else:
+        value = ",".join(keys)
+    params = {"_shape": "objects", "_size": "max", column + "__in": value}
+    if verbose:
+        click.echo(
+            "GET {}{}?{}".format(url.rstrip("/"), path, urllib.parse.urlencode(params)),
+            err=True,
+        )
+    rows_by_key = {}
+    for page in _table_pages(url, token, path, params, client=client):
+        for row in page.get("rows", []):
+            rows_by_key.setdefault(str(row[column]), []).append(row)
+    return rows_by_key
+
+
+@cli.command()
+@click.argument("filepath", type=click.Path(allow_dash=True, dir_okay=False))
+@click.option("--on", required=True, help="Column in the file to join on")
+@click.option(
+    "from_",
+    "--from",
+    required=True,
+    help="Table to look up rows in, as database/table",
+)
+@click.option("--key", default="id", help="Column in the table to match --on against")
+@click.option(
+    "--prefix",
+    help="Prefix for the added columns - defaults to the table name and _",
+)
+@click.option("-i", "--instance", default=None, help="Datasette instance URL or alias")
+@click.option("--token", help="API token")
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    help="Number of rows of the file to look up keys for at a time",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=0),
+    default=10000,
+    help="Number of looked up keys to remember",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of requests to run at once",
+)
+@click.option(
+    "--max-url-length",
+    type=click.IntRange(min=200),
+    default=MAX_URL_LENGTH,
+    help="Put as many keys in each request as fit in a URL this long",
+)
+@click.option("-v", "--verbose", is_flag=True, help="Verbose output: show HTTP request")
+@output_format_options
+def enrich(
+    filepath,
+    on,
+    from_,
+    key,
+    prefix,
+    instance,
+    token,
+    batch_size,
+    cache_size,
+    concurrency,
+    max_url_length,
+    verbose,
+    fmt_csv,
+    fmt_tsv,
+    fmt_nl,
+    fmt_table,
+):
+    """
+    Add columns from a Datasette table to the rows of a file
+
+    Reads a CSV, TSV, JSON or newline-delimited JSON file and looks up the
+    value of each row's --on column in the --key column of the table. The
+    columns of the matching row are added to the file's row, with names
+    starting with the --prefix. Rows with no match get empty columns, and
+    rows with several matches are output once for each of them.
+
+    The distinct keys in each batch of rows are looked up together using
+    key__in filters, and the rows found for the most recent keys are
+    cached so repeated keys are only requested once.
+
+    Example usage:
+
+    \b
+        dclient enrich orders.csv --on dog_id --from data/dogs -i myapp
+        dclient enrich visits.ndjson --on name --from data/dogs --key name --nl
+    """
+    database, table = _split_table_path(from_)
+    config_dir = get_config_dir()
+    url = _resolve_instance(instance, config_dir / "config.json")
+    token = _resolve_token(
+        token, url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    fmt = _determine_output_format(fmt_csv, fmt_tsv, fmt_nl, fmt_table)
+    if prefix is None:
+        prefix = table + "_"
+    path = "/{}/{}.json".format(database, tilde_encode(table))
+    try:
+        fp, _, _ = _open_input(filepath)
+    except OSError as ex:
+        raise click.ClickException(str(ex))
+    file_rows, input_format = _file_rows(fp, filepath)
+    # Keys that have been looked up, most recently used last
+    cache = collections.OrderedDict()
+    counts = {"rows": 0, "unmatched": 0, "requested": 0, "cached": 0}
+
+    with contextlib.ExitStack() as stack:
+        client = stack.enter_context(
+            httpx.Client(limits=httpx.Limits(max_connections=concurrency))
+        )
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+        if not _table_exists(url.rstrip("/") + "/" + database, table, token, client):
+            raise click.ClickException("Table {} not found".format(from_))
+        columns = next(
+            _table_pages(url, token, path, {"_size": 0, "_extra": "columns"}, client)
+        )["columns"]
+        if key not in columns:
+            raise click.ClickException("Table {} has no column {}".format(from_, key))
+        # The key is already in the file's row as the --on column
+        added = [column for column in columns if column != key]
+
+        def fetch(chunk):
+            return _rows_by_key(client, url, token, path, key, chunk, verbose)
+
+        def enriched():
+            for batch in _batches(file_rows, batch_size):
+                values = []
+                for row in batch:
+                    if on not in row:
+                        raise click.ClickException(
+                            "Row has no {} column: {}".format(
+                                on, json.dumps(row, default=repr)
+                            )
+                        )
+                    values.append(_join_value(row[on]))
+                found = {}
+                wanted = []
+                for value in dict.fromkeys(values):
+                    if value is None:
+                        continue
+                    if value in cache:
+                        cache.move_to_end(value)
+                        found[value] = cache[value]
+                        counts["cached"] += 1
+                    else:
+                        wanted.append(value)
+                chunks = _in_chunks(wanted, url, path, key, max_url_length)
+                for rows_by_key in executor.map(fetch, chunks):
+                    found.update(rows_by_key)
+                counts["requested"] += len(wanted)
+                for value in wanted:
+                    cache[value] = found.setdefault(value, [])
+                while len(cache) > cache_size:
+                    cache.popitem(last=False)
+                for row, value in zip(batch, values):
+                    counts["rows"] += 1
+                    matches = found.get(value)
+                    if not matches:
+                        counts["unmatched"] += 1
+                        matches = [{}]
+                    for match in matches:
+                        yield dict(
+                            row,
+                            **{prefix + column: match.get(column) for column in added},
+                        )
+
+        # Rows from a JSON file can each have different keys
+        _stream_rows(
+            enriched(), fmt, same_keys=input_format in (Format.CSV, Format.TSV)
+        )
+
+    if verbose:
+        click.echo(
+            "Looked up {} keys, {} more were cached".format(
+                counts["requested"], counts["cached"]
+            ),
+            err=True,
+        )
+    if counts["unmatched"]:
+        click.echo(
+            "{} of {} rows had no match in {}".format(
+                counts["unmatched"], counts["rows"], from_
+            ),
+            err=True,
+        )
+
+
+def _join_value(value):
+    "The string to look a value up as, or None for empty values"
+    if value is None or value == "":
+        return None
+    return str(value)
 
 
 @cli.command()
@@ -620,7 +1117,7 @@ def query(database, sql, instance, token, verbose, fmt_csv, fmt_tsv, fmt_nl, fmt
 def _do_insert(
     database,
     table,
-    filepath,
+    filepaths,
     format_csv,
     format_tsv,
     format_json,
@@ -639,269 +1136,3732 @@ def _do_insert(
     verbose,
     instance,
     endpoint="insert",
+    parse_workers=None,
+    checkpoint=None,
+    resume=False,
+    skip_unchanged=False,
+    from_sqlite=None,
+    from_table=None,
+    from_sql=None,
+    format_parquet=False,
+    format_arrow=False,
+    arrow_csv=False,
+    stats=False,
+    stats_json=None,
+    dry_run=False,
+    stream=False,
+    max_latency=None,
+    rejects=None,
+    schema_types=False,
+    dedupe_pk=False,
+    dedupe_window=None,
+    table_field=None,
+    files_concurrency=None,
+    spool=None,
+    verify=False,
+    shared=None,
 ):
     """Shared implementation for insert and upsert commands."""
+    options = dict(locals())
+    instances = instance
+    instance = instances[0] if instances else None
+    if len(instances) > 1 and (
+        checkpoint
+        or rejects
+        or skip_unchanged
+        or schema_types
+        or table_field
+        or len(filepaths) > 1
+        or any(glob.has_magic(filepath) for filepath in filepaths)
+    ):
+        raise click.ClickException(
+            "Multiple instances cannot be used with --checkpoint, --rejects, "
+            "--skip-unchanged, --schema-types, --table-field or multiple files"
+        )
+    if table_field:
+        # Each row names its own table, so the TABLE argument is the file
+        if filepaths:
+            raise click.ClickException("Cannot use both TABLE and --table-field")
+        table, filepaths = None, (table,)
+    paths = _expand_filepaths(filepaths)
+    if verify and (
+        dry_run
+        or spool
+        or skip_unchanged
+        or table_field
+        or len(instances) > 1
+        or len(paths) > 1
+    ):
+        raise click.ClickException(
+            "--verify cannot be used with --dry-run, --spool, --skip-unchanged, "
+            "--table-field, multiple instances or multiple files"
+        )
+    if len(paths) > 1:
+        return _insert_files(paths, options)
+    filepath = paths[0] if paths else None
+    if table_field:
+        if checkpoint or skip_unchanged or schema_types or dedupe_pk or stream:
+            raise click.ClickException(
+                "--table-field cannot be used with --checkpoint, --skip-unchanged, "
+                "--schema-types, --dedupe-pk or --stream"
+            )
     config_dir = get_config_dir()
-    url = _resolve_instance(instance, config_dir / "config.json")
-    token = _resolve_token(
-        token, url, config_dir / "auth.json", config_dir / "config.json"
-    )
-
-    format = None
-    if format_csv:
-        format = Format.CSV
-    elif format_tsv:
-        format = Format.TSV
-    elif format_json:
-        format = Format.JSON
-    elif format_nl:
+    if shared:
+        # Already resolved once for all of the files
+        url, token = shared.url, shared.token
+    else:
+        urls = [
+            _resolve_instance(instance, config_dir / "config.json")
+            for instance in instances or (None,)
+        ]
+        tokens = [
+            _resolve_token(
+                token, url, config_dir / "auth.json", config_dir / "config.json"
+            )
+            for url in urls
+        ]
+        url, token = urls[0], tokens[0]
+
+    format = _input_format(format_csv, format_tsv, format_json, format_nl)
+
+    # Columnar formats are read with pyarrow rather than rows_from_file
+    columnar = None
+    if format_parquet:
+        columnar = "parquet"
+    elif format_arrow:
+        columnar = "arrow"
+    elif arrow_csv:
+        if format in (Format.JSON, Format.NL):
+            raise click.ClickException("--arrow-csv only works with CSV or TSV")
+        columnar = "arrow-csv"
+    compression = None
+    magic = b""
+    if filepath not in (None, "-") and not from_sqlite:
+        with open(filepath, "rb") as fp:
+            magic = fp.read(6)
+        compression = _compression(magic)
+    if format is None and filepath not in (None, "-") and _is_ndjson_path(filepath):
         format = Format.NL
-    if format is None and filepath == "-":
+    if format is None and columnar is None and compression is None:
+        if magic.startswith(b"PAR1"):
+            columnar = "parquet"
+        elif magic == b"ARROW1":
+            columnar = "arrow"
+    if columnar and (format_parquet + format_arrow + bool(format) > 1):
+        raise click.ClickException("Only one input format can be specified")
+    if format is None and columnar is None and filepath == "-":
         raise click.ClickException(
             "An explicit format is required  - e.g. --csv "
             "- when reading from standard input"
         )
 
-    if filepath != "-":
+    parallel = parse_workers is not None and parse_workers > 1
+    if from_sqlite:
+        if filepath is not None:
+            raise click.ClickException("Cannot use FILEPATH with --from-sqlite")
+        if bool(from_table) == bool(from_sql):
+            raise click.ClickException(
+                "--from-sqlite requires either --from-table or --from-sql"
+            )
+        if parallel or checkpoint or columnar:
+            raise click.ClickException(
+                "--parse-workers, --checkpoint and input formats cannot be used "
+                "with --from-sqlite"
+            )
+    elif from_table or from_sql:
+        raise click.ClickException(
+            "--from-table and --from-sql can only be used with --from-sqlite"
+        )
+    elif filepath is None:
+        raise click.ClickException("Provide a FILEPATH, or use --from-sqlite")
+    if parallel and filepath == "-":
+        raise click.ClickException(
+            "--parse-workers cannot be used when reading from standard input"
+        )
+    if resume and not checkpoint:
+        raise click.ClickException("--resume requires --checkpoint")
+    if skip_unchanged and not pks:
+        raise click.ClickException("--skip-unchanged requires --pk to identify rows")
+    if dedupe_pk and not pks:
+        raise click.ClickException("--dedupe-pk requires --pk to identify rows")
+    if dedupe_window is not None and not dedupe_pk:
+        raise click.ClickException("--dedupe-window requires --dedupe-pk")
+    if dedupe_window is not None and (checkpoint or stream):
+        # Rows held back in the window would be recorded as sent, or delayed
+        # indefinitely waiting for more input
+        raise click.ClickException(
+            "--dedupe-window cannot be used with --checkpoint or --stream"
+        )
+    if checkpoint and filepath == "-":
+        raise click.ClickException(
+            "--checkpoint cannot be used when reading from standard input"
+        )
+    if parallel and compression:
+        raise click.ClickException(
+            "--parse-workers cannot be used with compressed input"
+        )
+    if columnar and compression:
+        raise click.ClickException(
+            "Compressed input is not supported for --parquet, --arrow or --arrow-csv"
+        )
+    if max_latency is not None and not stream:
+        raise click.ClickException("--max-latency requires --stream")
+    if stream and (parallel or columnar or from_sqlite):
+        raise click.ClickException(
+            "--stream cannot be used with --parse-workers, --from-sqlite or "
+            "columnar formats"
+        )
+    if stream and format == Format.JSON:
+        raise click.ClickException(
+            "--stream requires CSV, TSV or newline-delimited JSON"
+        )
+    if columnar and (parallel or checkpoint):
+        raise click.ClickException(
+            "--parse-workers and --checkpoint cannot be used with "
+            "--parquet, --arrow or --arrow-csv"
+        )
+
+    saved = None
+    if resume and pathlib.Path(checkpoint).exists():
+        saved = json.loads(pathlib.Path(checkpoint).read_text())
+        if saved.get("file") != str(pathlib.Path(filepath).resolve()):
+            raise click.ClickException(
+                "Checkpoint {} was recorded for {}, not {}".format(
+                    checkpoint, saved.get("file"), filepath
+                )
+            )
+
+    if filepath not in (None, "-"):
         file_size = pathlib.Path(filepath).stat().st_size
-        fp = open(filepath, "rb")
     else:
-        fp = sys.stdin.buffer
         file_size = None
 
-    try:
-        rows, format = rows_from_file(fp, format=format, encoding=encoding)
-    except Exception as ex:
-        raise click.ClickException(str(ex))
+    use_offsets = False
+    rows = batches = None
+    progress = None
+    if columnar:
+        # pyarrow has already decided the types - progress is measured in rows
+        batches, file_size, position = _arrow_batches(
+            filepath, columnar, format, encoding, batch_size
+        )
+        no_detect_types = True
+    elif from_sqlite:
+        # SQLite already knows the types, so there's nothing to detect -
+        # progress is measured in rows rather than bytes
+        rows, file_size, position = _sqlite_rows(from_sqlite, from_table, from_sql)
+        no_detect_types = True
+    elif parallel or checkpoint:
+        # Read the file ourselves, so we know the exact offset of each row
+        format, csv_options, fieldnames, start = _file_layout(
+            filepath, format, encoding
+        )
+        if format == Format.JSON and parallel:
+            raise click.ClickException(
+                "--parse-workers only works with CSV, TSV or newline-delimited JSON"
+            )
+        use_offsets = format != Format.JSON
+    if use_offsets:
+        if saved:
+            start = saved["offset"]
+        rows, position, progress = _rows_from_offset(
+            filepath,
+            start,
+            format,
+            encoding,
+            csv_options,
+            fieldnames,
+            parse_workers if parallel else None,
+        )
+    elif not (from_sqlite or columnar):
+        fp, raw, _ = _open_input(filepath)
+        try:
+            rows, format = rows_from_file(fp, format=format, encoding=encoding)
+        except Exception as ex:
+            raise click.ClickException(str(ex))
+        if saved:
+            rows = itertools.islice(rows, saved["rows"], None)
+        # For compressed files this counts compressed bytes, matching file_size
+        position = raw.tell
 
     if format in (Format.JSON, Format.NL):
         file_size = None
         no_detect_types = True
+    if shared and columnar:
+        # The shared progress bar counts bytes, not rows
+        file_size = None
 
-    first = True
     base_url = url.rstrip("/") + "/" + database
+    spool_dir = spool
+    if spool_dir:
+        spool = _Spool(spool_dir, url.rstrip("/"), database)
+        if (
+            table
+            and len(instances) < 2
+            and not (dry_run or silent or shared)
+            and spool.holds(table)
+        ):
+            click.echo(
+                "Batches for {} are already waiting in {}, so new rows will be "
+                "spooled behind them".format(table, spool_dir),
+                err=True,
+            )
+    column_types = None
+    if schema_types:
+        # None if the table doesn't exist yet, in which case types are
+        # detected as usual
+        column_types = _remote_column_types(base_url, table, token)
+    insert_stats = _InsertStats()
+    if table_field:
+        if batches is not None:
+            rows = itertools.chain.from_iterable(batches)
+        _insert_routed(
+            insert_stats.timed(rows, "parse"),
+            table_field=table_field,
+            url=base_url,
+            token=token,
+            create=create,
+            alter=alter,
+            pks=pks,
+            replace=replace,
+            ignore=ignore,
+            batch_size=batch_size,
+            interval=interval,
+            endpoint=endpoint,
+            detect_types=not no_detect_types,
+            rejects=rejects,
+            spool=spool,
+            progress=progress or (position if filepath != "-" else None),
+            file_size=file_size,
+            stats=insert_stats,
+            dry_run=dry_run,
+            silent=silent,
+            verbose=verbose,
+        )
+        _report_insert(insert_stats, dry_run, stats, stats_json, silent, spool_dir)
+        return
+    rows_done = saved["rows"] if saved else 0
+    skipped = 0
+    if len(instances) > 1:
+        targets = [
+            _Target(
+                instance,
+                target_url,
+                target_token,
+                database,
+                create,
+                alter,
+                _InsertStats(),
+                _Spool(spool_dir, target_url.rstrip("/"), database)
+                if spool_dir
+                else None,
+            )
+            for instance, target_url, target_token in zip(instances, urls, tokens)
+        ]
+    else:
+        targets = [
+            _Target(instance, url, token, database, create, alter, insert_stats, spool)
+        ]
+    deduper = (
+        _RowDeduper(pks, dedupe_window, keep_first=ignore, merge=endpoint == "upsert")
+        if dedupe_pk
+        else None
+    )
+    rejected = 0
+
+    def post(batch, target):
+        batch_create, batch_alter = target.planner.plan(batch)
+        _insert_batch(
+            url=target.base_url,
+            table=table,
+            batch=batch,
+            token=target.token,
+            create=batch_create,
+            alter=batch_alter,
+            pks=pks,
+            replace=replace,
+            ignore=ignore,
+            verbose=verbose,
+            endpoint=endpoint,
+            stats=target.stats,
+            dry_run=dry_run,
+            client=client,
+            spool=target.spool,
+        )
+        target.planner.sent()
+        if verifier is not None:
+            verifier.sent(batch)
 
-    with progressbar(
-        length=file_size,
-        label="Inserting rows",
-        silent=silent or (file_size is None),
-        show_percent=True,
-    ) as bar:
-        bytes_so_far = 0
-        for batch in _batches(rows, batch_size, interval=interval):
-            if file_size is not None:
+    def send(batch):
+        if len(targets) == 1:
+            post(batch, targets[0])
+        else:
+            _fan_out(fan_out_executor, post, targets, batch)
+
+    def read_batches(rows, batches, stopped):
+        # Runs in a background thread: parse and convert the next batches
+        # while the previous ones are being uploaded
+        first = True
+        if deduper is not None and deduper.window:
+            if batches is not None:
+                rows, batches = itertools.chain.from_iterable(batches), None
+            rows = deduper.rows(rows)
+        if batches is None and stream:
+            batches = _stream_batches(
+                insert_stats.timed(rows, "parse"),
+                batch_size,
+                max_latency if max_latency is not None else 1.0,
+                stopped,
+            )
+        elif batches is None:
+            batches = _batches(
+                insert_stats.timed(rows, "parse"), batch_size, interval=interval
+            )
+        else:
+            batches = insert_stats.timed(batches, "parse")
+        for batch in batches:
+            offset = bytes_consumed_so_far = None
+            if filepath != "-":
                 try:
-                    bytes_consumed_so_far = fp.tell()
-                    new_bytes = bytes_consumed_so_far - bytes_so_far
-                    bar.update(new_bytes)
-                    bytes_so_far += new_bytes
+                    offset = position()
+                    bytes_consumed_so_far = progress() if progress else offset
                 except ValueError:
                     pass
-            types = None
-            if first and not no_detect_types:
-                tracker = TypeTracker()
-                list(tracker.wrap(batch))
-                types = tracker.types
-                for row in batch:
-                    for key, value in row.items():
-                        if value is None:
-                            continue
-                        if types[key] == "integer":
-                            if not value:
-                                row[key] = None
-                            else:
-                                row[key] = int(value)
-                        elif types[key] == "float":
-                            if not value:
-                                row[key] = None
-                            else:
-                                row[key] = float(value)
+            invalid = []
+            if column_types is not None:
+                with insert_stats.timer("convert"):
+                    batch, invalid = _coerce_batch(batch, column_types)
+                if invalid and not rejects:
+                    row, errors = invalid[0]
+                    raise click.ClickException(
+                        "Invalid row {}: {}".format(
+                            json.dumps(row, default=repr), "; ".join(errors)
+                        )
+                    )
+            elif first and not no_detect_types:
+                with insert_stats.timer("convert"):
+                    _convert_types(batch)
             first = False
+            yield batch, offset, bytes_consumed_so_far, invalid
+
+    with contextlib.ExitStack() as stack:
+        stopped = None
+        if stream:
+            # Send the rows that have been read so far, then exit - the reader
+            # may be blocked waiting for input, so _stream_batches watches for this
+            stopped = stack.enter_context(
+                _stop_on_signals(signal.SIGINT, signal.SIGTERM)
+            )
+        elif checkpoint:
+            # Ctrl-C stops reading new rows, then sends what has been read
+            stopped = stack.enter_context(_stop_on_signals(signal.SIGINT))
+            rows = _until(rows, stopped)
+        if shared:
+            client, rejects_fp = shared.client, shared.rejects_fp
+        else:
+            # One connection, kept open between batches
+            client = stack.enter_context(httpx.Client())
+            rejects_fp = None
+            if rejects:
+                rejects_fp = stack.enter_context(open(rejects, "w"))
+        if len(targets) > 1:
+            fan_out_executor = stack.enter_context(ThreadPoolExecutor(len(targets)))
+        verifier = None
+        if verify:
+            verifier = _LoadVerifier(
+                _RemoteSQL(
+                    stack.enter_context(
+                        httpx.Client(
+                            headers={"Authorization": "Bearer {}".format(token)},
+                            timeout=40.0,
+                        )
+                    ),
+                    base_url,
+                    verbose,
+                ),
+                table,
+                by_key=replace or ignore or endpoint == "upsert",
+                keep_first=ignore,
+                merge=endpoint == "upsert",
+            )
+        hash_cache = None
+        if skip_unchanged:
+            hash_cache = stack.enter_context(
+                contextlib.closing(_open_row_hash_cache(config_dir))
+            )
+            cache_scope = (url.rstrip("/"), database, table)
+        if shared:
+            bar = shared.bar
+        else:
+            bar = stack.enter_context(
+                progressbar(
+                    length=file_size,
+                    label="Inserting rows",
+                    silent=silent or (file_size is None),
+                    show_percent=True,
+                )
+            )
+        bytes_so_far = 0
+        if saved and saved["offset"] and not compression:
+            bytes_so_far = saved["offset"]
+        bar.update(bytes_so_far)
+        for batch, offset, bytes_consumed_so_far, invalid in _pipelined(
+            read_batches(rows, batches, stopped), PIPELINE_QUEUE_SIZE
+        ):
+            rows_done += len(batch) + len(invalid)
+            if invalid:
+                # Rows that --schema-types could not convert
+                for row, errors in invalid:
+                    rejects_fp.write(
+                        json.dumps({"row": row, "errors": errors}, default=repr) + "\n"
+                    )
+                rejected += len(invalid)
+            if deduper is not None:
+                batch = deduper.batch(batch)
+            if hash_cache is not None:
+                unchanged = len(batch)
+                batch, hashes = _changed_rows(hash_cache, cache_scope, pks, batch)
+                skipped += unchanged - len(batch)
+            if batch and rejects_fp is not None:
+                batch_rejects = _send_bisecting(send, batch)
+                for row, errors in batch_rejects:
+                    rejects_fp.write(
+                        json.dumps({"row": row, "errors": errors}, default=repr) + "\n"
+                    )
+                    if hash_cache is not None:
+                        # So the row is tried again next time
+                        hashes.pop(_row_key(row, pks), None)
+                rejects_fp.flush()
+                rejected += len(batch_rejects)
+            elif batch:
+                send(batch)
+            if hash_cache is not None and not dry_run:
+                _save_row_hashes(hash_cache, cache_scope, hashes)
+            if checkpoint and not dry_run:
+                _write_checkpoint(
+                    checkpoint,
+                    {
+                        "file": str(pathlib.Path(filepath).resolve()),
+                        "offset": offset,
+                        "rows": rows_done,
+                    },
+                )
+            if file_size is not None and bytes_consumed_so_far is not None:
+                bar.update(bytes_consumed_so_far - bytes_so_far)
+                bytes_so_far = bytes_consumed_so_far
+        if shared:
+            shared.finished(
+                pathlib.Path(filepath).stat().st_size - bytes_so_far,
+                insert_stats,
+                rejected,
+                deduper.dropped if deduper is not None else 0,
+            )
+            return
+        if skip_unchanged and not silent:
+            click.echo("Skipped {} unchanged rows".format(skipped), err=True)
+        if deduper is not None and not silent:
+            click.echo("Dropped {} duplicate rows".format(deduper.dropped), err=True)
+        if rejected:
+            click.echo(
+                "{} rejected rows were written to {}".format(rejected, rejects),
+                err=True,
+            )
+        if len(targets) > 1:
+            for target in targets:
+                insert_stats.add(target.stats)
+            _report_targets(targets)
+        _report_insert(insert_stats, dry_run, stats, stats_json, silent, spool_dir)
+        if verifier is not None:
+            rows_verified = verifier.check()
+            if not silent:
+                click.echo(
+                    "Verified {} rows against the server's count and checksum".format(
+                        rows_verified
+                    ),
+                    err=True,
+                )
+        if any(target.error for target in targets):
+            raise click.exceptions.Exit(1)
+        if checkpoint and stopped is not None and stopped.is_set():
+            click.echo(
+                "\nInterrupted after {} rows, run again with --resume to "
+                "continue".format(rows_done),
+                err=True,
+            )
+            raise click.exceptions.Exit(130)
+
+
+class _LoadVerifier:
+    """
+    Check that the rows sent by insert or upsert arrived, using one aggregate
+    query on the server.
+
+    The hash of each row that was sent is added to a _hash_summary(). At the
+    end the server calculates the same summary for the whole table, which
+    should have grown by exactly the rows that were sent. Rows are hashed
+    locally using a copy of the table's columns in an in-memory database,
+    so values are stored with the same types as on the server.
+
+    If the table has an INTEGER PRIMARY KEY, rows without one get a key from
+    the server. Each row is also hashed without that column, and if any row
+    left it out both sides are compared that way instead.
+
+    by_key is for --replace, --ignore and upsert, where rows with the same
+    primary key replace each other. Only the last one (or the first, with
+    keep_first) is counted, and the table has to start out empty as rows
+    that were already there may be changed. With merge, for upsert, a row
+    only changes the columns it has, so each one is merged into the earlier
+    rows with the same key - which are kept in memory until the end. The
+    server fills in columns that other rows in its batch have, so a repeated
+    key that leaves those out can't be checked.
+    """
+
+    def __init__(self, remote, table, by_key=False, keep_first=False, merge=False):
+        self.remote = remote
+        self.table = table
+        hash_sql = _remote_hash_function(remote)
+        if hash_sql is None:
+            raise click.ClickException(
+                "--verify needs the server to have a sha1(), sha256() or md5() "
+                "SQL function"
+            )
+        self.hash_name, self.template = hash_sql
+        self.by_key = by_key
+        self.keep_first = keep_first
+        self.merge = merge
+        self.rows = {}
+        self.unverifiable = False
+        self.conn = sqlite3.connect(":memory:")
+        self.columns = []
+        self.known = set()
+        self.pks = []
+        self.assigned_key = None
+        self.assigned = False
+        self.hashes = {}
+        # With every column, then without assigned_key
+        self.summaries = [(0, 0, 0), (0, 0, 0)]
+        self.before = [(0, 0, 0), (0, 0, 0)]
+        if self.remote.columns(table):
+            self._copy_columns()
+            self.before = [self._remote_summary(0)] * 2
+            if self.assigned_key:
+                self.before[1] = self._remote_summary(1)
+        if by_key and self.before[0][0]:
+            raise click.ClickException(
+                "--verify can only be used with --replace, --ignore or upsert "
+                "when the table starts out empty"
+            )
+
+    def _fingerprints(self, columns):
+        return [
+            _verify_fingerprint_sql(columns),
+            _verify_fingerprint_sql(
+                [column for column in columns if column != self.assigned_key]
+            ),
+        ]
+
+    def _remote_summary(self, variant):
+        return _remote_hash_summary(
+            self.remote,
+            self.table,
+            self.template.format(
+                self._fingerprints(self.remote.columns(self.table))[variant]
+            ),
+            "1",
+            {},
+        )
+
+    def _copy_columns(self):
+        # The table may have been created or altered by the last batch
+        info, _ = self.remote.query(
+            "select name, type, pk from pragma_table_info(:table)",
+            {"table": self.table},
+        )
+        self.columns = [column["name"] for column in info]
+        self.pks = [
+            column["name"]
+            for column in sorted(info, key=lambda column: column["pk"])
+            if column["pk"]
+        ]
+        # An alias for the rowid, which the server fills in if it is missing
+        integer_keys = [
+            column["name"]
+            for column in info
+            if column["pk"] and column["type"].upper() == "INTEGER"
+        ]
+        if len(self.pks) == 1 and integer_keys:
+            self.assigned_key = integer_keys[0]
+        self.conn.execute("drop table if exists copy")
+        self.conn.execute(
+            "create table copy ({})".format(
+                ", ".join(
+                    "{} {}".format(_quote_identifier(column["name"]), column["type"])
+                    for column in info
+                )
+            )
+        )
+
+    def _insert(self, batch):
+        self.conn.executemany(
+            "insert into copy ({}) values ({})".format(
+                _column_list(self.columns), ", ".join("?" for _ in self.columns)
+            ),
+            [
+                [_sqlite_value(row.get(column)) for column in self.columns]
+                for row in batch
+            ],
+        )
+
+    def _merged(self, batch, keys):
+        "Merge each row into the earlier rows with the same primary key"
+        # The copy table gives each key the type the server would store
+        self._insert(batch)
+        found = self.conn.execute(
+            "select {} from copy order by rowid".format(_column_list(self.pks))
+        ).fetchall()
+        self.conn.execute("delete from copy")
+        merged = {}
+        for key, row in zip(found, batch):
+            if key in self.rows and set(row) != keys:
+                # Depends on how the server splits up the batch
+                self.unverifiable = True
+            merged[key] = self.rows[key] = {**self.rows.get(key, {}), **row}
+        return list(merged.values())
+
+    def sent(self, batch):
+        "Called with each batch the server has accepted"
+        keys = {key for row in batch for key in row}
+        if not keys <= self.known:
+            self._copy_columns()
+            # Keys that still aren't columns, such as rowid, are left out
+            self.known = set(self.columns) | keys
+        if self.assigned_key and any(
+            row.get(self.assigned_key) is None for row in batch
+        ):
+            self.assigned = True
+        if self.merge and self.pks:
+            batch = self._merged(batch, keys)
+        self._insert(batch)
+        key_count = len(self.pks) if self.by_key else 0
+        # The second fingerprint is only needed if the server can assign keys
+        fingerprints = self._fingerprints(self.columns)[: 2 if self.assigned_key else 1]
+        for row in self.conn.execute(
+            "select {} from copy".format(
+                ", ".join(
+                    [_quote_identifier(pk) for pk in self.pks[:key_count]]
+                    + fingerprints
+                )
+            )
+        ):
+            key, fingerprints = row[:key_count], row[key_count:]
+            digests = [
+                hashlib.new(self.hash_name, fingerprint.encode("utf-8")).hexdigest()
+                for fingerprint in fingerprints
+            ]
+            if not key or None in key:
+                # Rows the server gave a new key are never replaced
+                self.summaries = [
+                    tuple(
+                        total + part
+                        for total, part in zip(summary, _hash_summary([digest]))
+                    )
+                    for summary, digest in zip(self.summaries, digests)
+                ]
+            elif not (self.keep_first and key in self.hashes):
+                self.hashes[key] = digests
+        self.conn.execute("delete from copy")
+
+    def check(self):
+        "Compare with the server, returning the number of rows verified"
+        if self.unverifiable:
+            raise click.ClickException(
+                "Could not verify: an upsert for a row that was already sent "
+                "left out columns that other rows in its batch have"
+            )
+        variant = 1 if self.assigned else 0
+        expected = tuple(
+            total + part
+            for total, part in zip(
+                self.summaries[variant],
+                _hash_summary([digests[variant] for digests in self.hashes.values()]),
+            )
+        )
+        after = self._remote_summary(variant)
+        added = tuple(a - b for a, b in zip(after, self.before[variant]))
+        if added[0] != expected[0]:
+            raise click.ClickException(
+                "Verification failed: {} rows were sent, but the table has {} "
+                "more rows than before".format(expected[0], added[0])
+            )
+        if added != expected:
+            raise click.ClickException(
+                "Verification failed: the server's checksum for the table does "
+                "not match the {} rows that were sent".format(expected[0])
+            )
+        return expected[0]
+
+
+def _verify_fingerprint_sql(columns):
+    """
+    SQL expression encoding the non-null values of a row, with their column
+    names, as one string. Adding a column to the table doesn't change it, so
+    it works across insert --alter.
+    """
+    return "''" + "".join(
+        " || case when {c} is null then '' else '{name}' || char(30) || {value} "
+        "|| char(31) end".format(
+            c=_quote_identifier(column),
+            name=column.replace("'", "''"),
+            value=_typed_value_sql(column),
+        )
+        for column in sorted(columns)
+    )
+
+
+def _sqlite_value(value):
+    "A JSON value from an insert, as the server will store it"
+    if isinstance(value, dict) and value.get("$base64") is True:
+        return base64.b64decode(value["encoded"])
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=repr, ensure_ascii=False)
+    return value
+
+
+class _Target:
+    "An instance that every batch is sent to, when insert is given several"
+
+    def __init__(self, name, url, token, database, create, alter, stats, spool):
+        self.name = name or url
+        self.base_url = url.rstrip("/") + "/" + database
+        self.token = token
+        self.planner = _BatchPlanner(create, alter)
+        self.stats = stats
+        self.spool = spool
+        self.error = None
+
+
+def _fan_out(executor, post, targets, batch):
+    """
+    Call post(batch, target) for every target that hasn't failed yet, all at
+    once. A target that fails is skipped from then on, unless that leaves
+    none to send to.
+    """
+    futures = [
+        (target, executor.submit(post, batch, target))
+        for target in targets
+        if target.error is None
+    ]
+    for target, future in futures:
+        try:
+            future.result()
+        except click.ClickException as ex:
+            target.error = ex.format_message()
+        except httpx.HTTPError as ex:
+            target.error = str(ex) or type(ex).__name__
+    if all(target.error for target in targets):
+        _report_targets(targets)
+        raise click.ClickException("Could not send to any of the instances")
+
+
+def _report_targets(targets):
+    for target in targets:
+        message = "{}: {} rows sent".format(target.name, target.stats.rows)
+        if target.stats.spooled:
+            message += ", {} spooled".format(target.stats.spooled)
+        if target.error:
+            message += ", then failed: {}".format(target.error)
+        click.echo(message, err=True)
+
+
+def _report_insert(insert_stats, dry_run, stats, stats_json, silent, spool_dir=None):
+    if insert_stats.spooled:
+        click.echo(
+            "{} rows could not be sent and were spooled in {} - send them "
+            "later with: dclient spool flush {}".format(
+                insert_stats.spooled, spool_dir, spool_dir
+            ),
+            err=True,
+        )
+    if dry_run and not silent:
+        click.echo("Dry run: {} rows were not sent".format(insert_stats.rows), err=True)
+    if stats:
+        click.echo(insert_stats.summary(), err=True)
+    if stats_json:
+        pathlib.Path(stats_json).write_text(json.dumps(insert_stats.report(), indent=2))
+
+
+def _expand_filepaths(filepaths):
+    "Expand any glob patterns in filepaths that don't name an existing file"
+    paths = []
+    for filepath in filepaths:
+        if filepath == "-" or pathlib.Path(filepath).exists():
+            paths.append(filepath)
+        elif glob.has_magic(filepath):
+            matches = sorted(
+                path
+                for path in glob.glob(filepath, recursive=True)
+                if pathlib.Path(path).is_file()
+            )
+            if not matches:
+                raise click.ClickException("No files match {}".format(filepath))
+            paths.extend(matches)
+        else:
+            raise click.ClickException("File {} does not exist".format(filepath))
+    return paths
+
+
+# How many files are inserted at once, unless --files-concurrency is set
+FILES_CONCURRENCY = 4
+
+
+class _Synchronized:
+    "Wraps an object so that only one thread at a time can call its methods"
+
+    def __init__(self, wrapped, lock):
+        self._wrapped = wrapped
+        self._lock = lock
+
+    def __getattr__(self, name):
+        method = getattr(self._wrapped, name)
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return method(*args, **kwargs)
+
+        return call
+
+
+class _SharedInsert:
+    """
+    Everything the files in a multi-file insert share: the resolved URL and
+    token, one pool of connections, the progress bar, the rejects file and
+    the totals.
+    """
+
+    def __init__(self, url, token, client, bar, rejects_fp):
+        self.lock = threading.Lock()
+        self.url = url
+        self.token = token
+        self.client = client
+        self.bar = _Synchronized(bar, self.lock)
+        self.rejects_fp = rejects_fp and _Synchronized(rejects_fp, self.lock)
+        self.stats = _InsertStats()
+        self.rejected = 0
+        self.dropped = 0
+
+    def finished(self, bytes_remaining, stats, rejected, dropped):
+        "Called once each file is done"
+        # Bytes that weren't counted while reading, e.g. for JSON files
+        self.bar.update(bytes_remaining)
+        with self.lock:
+            self.stats.add(stats)
+            self.rejected += rejected
+            self.dropped += dropped
+
+
+def _insert_files(paths, options):
+    """
+    Insert several files into the same table, --files-concurrency of them
+    at a time, sharing one pool of connections and one progress bar.
+    """
+    if "-" in paths:
+        raise click.ClickException("Standard input cannot be combined with other files")
+    if (
+        options["checkpoint"]
+        or options["skip_unchanged"]
+        or options["stream"]
+        or options["from_sqlite"]
+    ):
+        raise click.ClickException(
+            "--checkpoint, --skip-unchanged, --stream and --from-sqlite cannot "
+            "be used with multiple files"
+        )
+    config_dir = get_config_dir()
+    url = _resolve_instance(
+        options["instance"][0] if options["instance"] else None,
+        config_dir / "config.json",
+    )
+    token = _resolve_token(
+        options["token"], url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    with contextlib.ExitStack() as stack:
+        client = stack.enter_context(httpx.Client())
+        rejects_fp = None
+        if options["rejects"]:
+            rejects_fp = stack.enter_context(open(options["rejects"], "w"))
+        bar = stack.enter_context(
+            progressbar(
+                length=sum(pathlib.Path(path).stat().st_size for path in paths),
+                label="Inserting rows",
+                silent=options["silent"],
+                show_percent=True,
+            )
+        )
+        shared = _SharedInsert(url, token, client, bar, rejects_fp)
+
+        def insert_file(path):
+            try:
+                _do_insert(**dict(options, filepaths=(path,), shared=shared))
+            except click.ClickException as ex:
+                ex.message = "{}: {}".format(path, ex.message)
+                raise
+
+        executor = stack.enter_context(
+            ThreadPoolExecutor(
+                max_workers=options["files_concurrency"] or FILES_CONCURRENCY
+            )
+        )
+        futures = [executor.submit(insert_file, path) for path in paths]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            # Let the files already being inserted finish, but start no more
+            for future in futures:
+                future.cancel()
+            raise
+    if options["dedupe_pk"] and not options["silent"]:
+        click.echo("Dropped {} duplicate rows".format(shared.dropped), err=True)
+    if shared.rejected:
+        click.echo(
+            "{} rejected rows were written to {}".format(
+                shared.rejected, options["rejects"]
+            ),
+            err=True,
+        )
+    _report_insert(
+        shared.stats,
+        options["dry_run"],
+        options["stats"],
+        options["stats_json"],
+        options["silent"],
+        options["spool"],
+    )
+
+
+class _BatchPlanner:
+    """
+    Decide how to send each batch: only the first goes to /-/create, the
+    rest use the faster insert or upsert endpoint. With --alter, the server
+    is only asked to add columns for batches with keys not sent before.
+    """
+
+    def __init__(self, create, alter):
+        self.create = create
+        self.alter = alter
+        self.columns = set()
+
+    def plan(self, batch):
+        "Returns (create, alter) for this batch"
+        alter = False
+        self.keys = set()
+        if self.alter:
+            for row in batch:
+                self.keys.update(row)
+            alter = not self.keys <= self.columns
+        return self.create, alter
+
+    def sent(self):
+        "Call once the batch last passed to plan() has been accepted"
+        self.create = False
+        self.columns |= self.keys
+
+
+class _RoutedTable:
+    "Rows waiting to be sent to one table, and the upload currently in flight"
+
+    def __init__(self, name, create, alter):
+        self.name = name
+        self.planner = _BatchPlanner(create, alter)
+        # Only updated by this table's upload, so uploads to different
+        # tables never add to the same totals at once
+        self.stats = _InsertStats()
+        self.rows = []
+        self.started = time.monotonic()
+        self.upload = None
+        self.first = True
+        self.sent = 0
+
+
+def _insert_routed(
+    rows,
+    *,
+    table_field,
+    url,
+    token,
+    create,
+    alter,
+    pks,
+    replace,
+    ignore,
+    batch_size,
+    interval,
+    endpoint,
+    detect_types,
+    rejects,
+    spool,
+    progress,
+    file_size,
+    stats,
+    dry_run,
+    silent,
+    verbose,
+):
+    """
+    Insert each row into the table named by its table_field value, which is
+    removed from the row.
+
+    Every table is batched separately and has at most one upload in flight,
+    so a single pass over the input keeps all of the tables busy. Uploads
+    share one pool of connections.
+    """
+    tables = {}
+    rejected = 0
+    bytes_so_far = 0
+
+    def upload(table, batch):
+        # Runs in the thread pool - only one upload per table at a time, so
+        # its planner is never used concurrently
+        def send(batch):
+            batch_create, batch_alter = table.planner.plan(batch)
             _insert_batch(
-                url=base_url,
-                table=table,
+                url=url,
+                table=table.name,
                 batch=batch,
                 token=token,
-                create=create,
-                alter=alter,
+                create=batch_create,
+                alter=batch_alter,
                 pks=pks,
                 replace=replace,
                 ignore=ignore,
                 verbose=verbose,
                 endpoint=endpoint,
+                stats=table.stats,
+                dry_run=dry_run,
+                client=client,
+                spool=spool,
             )
+            table.planner.sent()
 
+        if rejects_fp is not None:
+            return _send_bisecting(send, batch)
+        send(batch)
+        return []
 
-_insert_options = [
-    click.argument("database"),
-    click.argument("table"),
-    click.argument(
-        "filepath",
-        type=click.Path("rb", readable=True, allow_dash=True, dir_okay=False),
-    ),
-    click.option(
-        "-i", "--instance", default=None, help="Datasette instance URL or alias"
-    ),
-    click.option("format_csv", "--csv", is_flag=True, help="Input is CSV"),
-    click.option("format_tsv", "--tsv", is_flag=True, help="Input is TSV"),
-    click.option("format_json", "--json", is_flag=True, help="Input is JSON"),
-    click.option(
-        "format_nl", "--nl", is_flag=True, help="Input is newline-delimited JSON"
-    ),
-    click.option("--encoding", help="Character encoding for CSV/TSV"),
-    click.option(
-        "--no-detect-types", is_flag=True, help="Don't detect column types for CSV/TSV"
-    ),
-    click.option(
-        "--alter", is_flag=True, help="Alter table to add any missing columns"
-    ),
-    click.option(
-        "pks",
-        "--pk",
-        multiple=True,
-        help="Columns to use as the primary key when creating the table",
-    ),
-    click.option(
-        "--batch-size", type=int, default=100, help="Send rows in batches of this size"
-    ),
-    click.option(
-        "--interval", type=float, default=10, help="Send batch at least every X seconds"
-    ),
-    click.option("--token", help="API token"),
-    click.option("--silent", is_flag=True, help="Don't output progress"),
-    click.option(
-        "-v",
-        "--verbose",
-        is_flag=True,
-        help="Verbose output: show HTTP request and response",
-    ),
-]
+    def reject(row, errors):
+        nonlocal rejected
+        rejects_fp.write(
+            json.dumps({"row": row, "errors": errors}, default=repr) + "\n"
+        )
+        rejected += 1
+
+    def wait(table):
+        if table.upload is not None:
+            for row, errors in table.upload.result():
+                reject(row, errors)
+                table.sent -= 1
+            table.upload = None
+
+    def flush(table):
+        nonlocal bytes_so_far
+        wait(table)
+        if not table.rows:
+            return
+        if table.first and detect_types:
+            _convert_types(table.rows)
+        table.first = False
+        table.upload = executor.submit(upload, table, table.rows)
+        table.sent += len(table.rows)
+        table.rows = []
+        table.started = time.monotonic()
+        if progress is not None and file_size is not None:
+            try:
+                bytes_consumed_so_far = progress()
+            except ValueError:
+                return
+            bar.update(bytes_consumed_so_far - bytes_so_far)
+            bytes_so_far = bytes_consumed_so_far
+
+    with contextlib.ExitStack() as stack:
+        client = stack.enter_context(httpx.Client())
+        executor = stack.enter_context(ThreadPoolExecutor())
+        rejects_fp = None
+        if rejects:
+            rejects_fp = stack.enter_context(open(rejects, "w"))
+        bar = stack.enter_context(
+            progressbar(
+                length=file_size,
+                label="Inserting rows",
+                silent=silent or (file_size is None),
+                show_percent=True,
+            )
+        )
+        for row in rows:
+            name = row.pop(table_field, None)
+            if name is None or name == "":
+                errors = ["Row has no {} value".format(table_field)]
+                if rejects_fp is None:
+                    raise click.ClickException(
+                        "{}: {}".format(errors[0], json.dumps(row, default=repr))
+                    )
+                reject(row, errors)
+                continue
+            name = str(name)
+            table = tables.get(name)
+            if table is None:
+                table = tables[name] = _RoutedTable(name, create, alter)
+            table.rows.append(row)
+            if len(table.rows) >= batch_size or (
+                interval is not None and time.monotonic() - table.started >= interval
+            ):
+                flush(table)
+        for table in tables.values():
+            flush(table)
+        for table in tables.values():
+            wait(table)
+    for table in tables.values():
+        stats.add(table.stats)
+    if not silent:
+        for table in tables.values():
+            click.echo("{}: {} rows".format(table.name, table.sent), err=True)
+    if rejected:
+        click.echo(
+            "{} rejected rows were written to {}".format(rejected, rejects), err=True
+        )
 
 
-def _apply_options(options):
-    def decorator(func):
-        for option in reversed(options):
-            func = option(func)
-        return func
+class _RowDeduper:
+    """
+    Drop rows that share their primary key with a later row, keeping the
+    last occurrence - so overwritten rows are never sent. With keep_first,
+    as for --ignore where the server keeps the first row it sees, the first
+    occurrence is kept instead. With merge, as for upsert where each row only
+    sets the columns it has, later rows are merged into the earlier ones.
+
+    batch() collapses duplicates within a batch. rows() also catches
+    duplicates across batches by holding back up to window rows, keyed by
+    primary key, so memory use stays bounded. Keeping the first occurrence
+    only needs the last window keys, so no rows are held back.
+    """
 
-    return decorator
+    def __init__(self, pks, window=None, keep_first=False, merge=False):
+        self.pks = pks
+        self.window = window
+        self.keep_first = keep_first
+        self.merge = merge
+        self.dropped = 0
+
+    def batch(self, batch):
+        rows = {}
+        for row in batch:
+            key = _row_key(row, self.pks)
+            if self.keep_first:
+                if key in rows:
+                    self.dropped += 1
+                else:
+                    rows[key] = row
+                continue
+            # Remove first, so the row takes the position of its last occurrence
+            earlier = rows.pop(key, None)
+            if earlier is not None:
+                self.dropped += 1
+                if self.merge:
+                    row = {**earlier, **row}
+            rows[key] = row
+        return list(rows.values())
+
+    def rows(self, rows):
+        pending = collections.OrderedDict()
+        for row in rows:
+            key = _row_key(row, self.pks)
+            if self.keep_first:
+                if key in pending:
+                    self.dropped += 1
+                    continue
+                pending[key] = None
+                if len(pending) > self.window:
+                    pending.popitem(last=False)
+                yield row
+                continue
+            earlier = pending.pop(key, None)
+            if earlier is not None:
+                self.dropped += 1
+                if self.merge:
+                    row = {**earlier, **row}
+            pending[key] = row
+            if len(pending) > self.window:
+                yield pending.popitem(last=False)[1]
+        if not self.keep_first:
+            yield from pending.values()
+
+
+class _InsertStats:
+    """Time spent in each stage of an insert, measured with monotonic clocks."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.timings = collections.defaultdict(float)
+        self.latencies = []
+        self.rows = 0
+        self.bytes = 0
+        self.spooled = 0
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.monotonic() - start
+
+    def timed(self, iterable, stage):
+        "Wrap an iterator, adding the time spent producing each item to stage"
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add(self, other):
+        "Add the totals from another _InsertStats to this one"
+        for stage, seconds in other.timings.items():
+            self.timings[stage] += seconds
+        self.latencies.extend(other.latencies)
+        self.rows += other.rows
+        self.bytes += other.bytes
+        self.spooled += other.spooled
+
+    def record_batch(self, rows, bytes, latency=None):
+        self.rows += rows
+        self.bytes += bytes
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def report(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "rows": self.rows,
+            "bytes": self.bytes,
+            "batches": len(self.latencies),
+            "elapsed": elapsed,
+            "rows_per_second": self.rows / elapsed if elapsed else None,
+            "bytes_per_second": self.bytes / elapsed if elapsed else None,
+            "stages": dict(self.timings),
+            "batch_latency": {
+                "p50": percentile(self.latencies, 50),
+                "p90": percentile(self.latencies, 90),
+                "p99": percentile(self.latencies, 99),
+                "max": max(self.latencies) if self.latencies else None,
+            },
+        }
 
+    def summary(self):
+        report = self.report()
+        lines = [
+            "Rows: {:,} in {:.2f}s ({:,.0f} rows/s)".format(
+                report["rows"], report["elapsed"], report["rows_per_second"] or 0
+            ),
+            "Sent: {:,} bytes ({:,.0f} bytes/s)".format(
+                report["bytes"], report["bytes_per_second"] or 0
+            ),
+            "Time spent:",
+        ]
+        for stage in ("parse", "convert", "serialize", "request"):
+            lines.append(
+                "  {:<10} {:.3f}s".format(stage, report["stages"].get(stage, 0))
+            )
+        if self.latencies:
+            lines.append(
+                "Batch latency: "
+                + ", ".join(
+                    "{} {:.0f}ms".format(key, value * 1000)
+                    for key, value in report["batch_latency"].items()
+                )
+            )
+        return "\n".join(lines)
 
-@cli.command()
-@_apply_options(_insert_options)
-@click.option(
-    "--replace", is_flag=True, help="Replace rows with a matching primary key"
-)
-@click.option("--ignore", is_flag=True, help="Ignore rows with a matching primary key")
-@click.option("--create", is_flag=True, help="Create table if it does not exist")
-def insert(
-    database,
-    table,
-    filepath,
-    instance,
-    format_csv,
-    format_tsv,
-    format_json,
-    format_nl,
-    encoding,
-    no_detect_types,
-    alter,
-    pks,
-    batch_size,
-    interval,
-    token,
-    silent,
-    verbose,
-    replace,
-    ignore,
-    create,
-):
+
+def _sqlite_rows(path, table, sql):
+    """
+    Stream rows from a table or query in a local SQLite database.
+
+    Returns (rows, count, position) - count is None for queries, position()
+    returns the number of rows read so far.
+    """
+    if not pathlib.Path(path).exists():
+        raise click.ClickException("SQLite database {} does not exist".format(path))
+    # Rows are read from the background thread that builds the batches
+    conn = sqlite3.connect(path, check_same_thread=False)
+    count = None
+    if table:
+        sql = "select * from {}".format(_quote_identifier(table))
+    try:
+        if table:
+            count = conn.execute(
+                "select count(*) from {}".format(_quote_identifier(table))
+            ).fetchone()[0]
+        cursor = conn.execute(sql)
+    except sqlite3.Error as ex:
+        raise click.ClickException(str(ex))
+    columns = [column[0] for column in cursor.description]
+    state = {"count": 0}
+
+    def rows():
+        with contextlib.closing(conn):
+            for values in cursor:
+                state["count"] += 1
+                yield {
+                    column: _json_value(value) for column, value in zip(columns, values)
+                }
+
+    return rows(), count, lambda: state["count"]
+
+
+def _quote_identifier(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _json_value(value):
+    # Binary values are sent using the Datasette write API's base64 format
+    if isinstance(value, bytes):
+        return {"$base64": True, "encoded": base64.b64encode(value).decode("latin1")}
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise click.ClickException(
+            "pyarrow is required for Parquet and Arrow support - install it "
+            "with: pip install 'dclient[arrow]'"
+        )
+    return pyarrow
+
+
+def _arrow_batches(filepath, kind, format, encoding, batch_size):
+    """
+    Read batches of rows from a Parquet, Arrow IPC or CSV/TSV file using pyarrow.
+
+    kind is one of "parquet", "arrow" or "arrow-csv". Returns (batches, count,
+    position) - count is None if the number of rows is not known up front,
+    position() returns the number of rows read so far.
+    """
+    pyarrow = _import_pyarrow()
+    source = sys.stdin.buffer if filepath == "-" else filepath
+    count = None
+    try:
+        if kind == "parquet":
+            import pyarrow.parquet
+
+            parquet_file = pyarrow.parquet.ParquetFile(source)
+            count = parquet_file.metadata.num_rows
+            record_batches = parquet_file.iter_batches(batch_size=batch_size)
+        elif kind == "arrow":
+            import pyarrow.ipc
+
+            if filepath == "-":
+                record_batches = pyarrow.ipc.open_stream(source)
+            else:
+                try:
+                    reader = pyarrow.ipc.open_file(pyarrow.memory_map(filepath))
+                    # Batches are memory mapped, so this doesn't read the data
+                    count = sum(
+                        reader.get_batch(i).num_rows
+                        for i in range(reader.num_record_batches)
+                    )
+                    record_batches = (
+                        reader.get_batch(i) for i in range(reader.num_record_batches)
+                    )
+                except pyarrow.ArrowInvalid:
+                    # Not the random access format, try the streaming format
+                    record_batches = pyarrow.ipc.open_stream(
+                        pyarrow.memory_map(filepath)
+                    )
+        else:
+            import pyarrow.csv
+
+            record_batches = pyarrow.csv.open_csv(
+                source,
+                read_options=pyarrow.csv.ReadOptions(encoding=encoding or "utf8"),
+                parse_options=pyarrow.csv.ParseOptions(
+                    delimiter="\t" if format == Format.TSV else ","
+                ),
+            )
+    except (pyarrow.ArrowException, OSError) as ex:
+        raise click.ClickException(str(ex))
+
+    state = {"rows": 0}
+
+    def batches():
+        for record_batch in record_batches:
+            # Record batches can be larger than --batch-size
+            for offset in range(0, record_batch.num_rows, batch_size):
+                batch = [
+                    {key: _json_value(value) for key, value in row.items()}
+                    for row in record_batch.slice(offset, batch_size).to_pylist()
+                ]
+                state["rows"] += len(batch)
+                yield batch
+
+    return batches(), count, lambda: state["rows"]
+
+
+def _open_row_hash_cache(config_dir):
+    config_dir.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(config_dir / "row-hashes.db"))
+    conn.execute(
+        """
+        create table if not exists row_hashes (
+            instance text,
+            database text,
+            table_name text,
+            pk text,
+            hash text,
+            primary key (instance, database, table_name, pk)
+        )
+        """
+    )
+    return conn
+
+
+def _row_hash(row):
+    # Compare values as strings, so "1" from a CSV file and a detected
+    # integer 1 are treated as the same value
+    normalized = {
+        key: None if value is None else str(value) for key, value in row.items()
+    }
+    return hashlib.sha1(
+        json.dumps(normalized, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def _changed_rows(conn, scope, pks, batch):
+    """
+    Filter a batch down to rows that are new or have changed since they
+    were last sent. Returns (changed_rows, {pk: hash}) for those rows.
+    """
+    hashes = {}
+    keyed = []
+    for row in batch:
+        key = _row_key(row, pks)
+        hashes[key] = _row_hash(row)
+        keyed.append((key, row))
+    previous = {}
+    keys = list(hashes)
+    for i in range(0, len(keys), 500):
+        chunk = keys[i : i + 500]
+        previous.update(
+            conn.execute(
+                "select pk, hash from row_hashes where instance = ? and "
+                "database = ? and table_name = ? and pk in ({})".format(
+                    ", ".join("?" for _ in chunk)
+                ),
+                list(scope) + chunk,
+            ).fetchall()
+        )
+    changed = [row for key, row in keyed if previous.get(key) != hashes[key]]
+    return changed, {
+        key: hash for key, hash in hashes.items() if previous.get(key) != hash
+    }
+
+
+def _row_key(row, pks):
+    return json.dumps([str(row.get(pk)) for pk in pks])
+
+
+def _save_row_hashes(conn, scope, hashes):
+    with conn:
+        conn.executemany(
+            "insert or replace into row_hashes "
+            "(instance, database, table_name, pk, hash) values (?, ?, ?, ?, ?)",
+            [tuple(scope) + (key, hash) for key, hash in hashes.items()],
+        )
+
+
+def _write_checkpoint(path, data):
+    # Write then rename, so an interrupted write can't corrupt the checkpoint
+    tmp_path = "{}.tmp".format(path)
+    pathlib.Path(tmp_path).write_text(json.dumps(data, indent=4))
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def _stop_on_signals(*signums):
+    """
+    Set a threading.Event when one of these signals arrives, instead of
+    interrupting the program. A second signal gets the previous behavior.
+    """
+    stopped = threading.Event()
+    previous = {}
+
+    def handler(signum, frame):
+        stopped.set()
+        signal.signal(signum, previous[signum])
+
+    for signum in signums:
+        try:
+            previous[signum] = signal.signal(signum, handler)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread
+            pass
+    try:
+        yield stopped
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def _until(iterable, event):
+    "Stop iterating as soon as event is set"
+    for item in iterable:
+        yield item
+        if event.is_set():
+            return
+
+
+def _convert_types(batch):
+    "Detect integer and float columns in a batch and convert them in place"
+    tracker = TypeTracker()
+    list(tracker.wrap(batch))
+    types = tracker.types
+    for row in batch:
+        for key, value in row.items():
+            if value is None:
+                continue
+            if types[key] == "integer":
+                if not value:
+                    row[key] = None
+                else:
+                    row[key] = int(value)
+            elif types[key] == "float":
+                if not value:
+                    row[key] = None
+                else:
+                    row[key] = float(value)
+
+
+def _remote_schema(url, table, token, client=None):
+    """
+    Fetch the CREATE TABLE statement for a remote table from its schema.json.
+
+    Returns None if the table does not exist.
+    """
+    response = (client or httpx).get(
+        "{}/{}/-/schema.json".format(url, tilde_encode(table)),
+        headers={"Authorization": "Bearer {}".format(token)},
+        timeout=40.0,
+    )
+    if response.status_code == 404 and tilde_encode(table) != table:
+        # Some versions of Datasette don't decode the table name on this page,
+        # so fall back to the schema of the whole database
+        if not _table_exists(url, table, token, client):
+            return None
+        response = (client or httpx).get(
+            "{}/-/schema.json".format(url),
+            headers={"Authorization": "Bearer {}".format(token)},
+            timeout=40.0,
+        )
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise click.ClickException(
+            "Could not read schema for {}: {} {}".format(
+                table, response.status_code, response.reason_phrase
+            )
+        )
+    return response.json()["schema"]
+
+
+def _schema_table_info(schema, table):
+    """
+    Let SQLite parse a CREATE TABLE statement.
+
+    Returns the rows of pragma table_info(): (cid, name, type, notnull,
+    dflt_value, pk).
+    """
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.executescript(schema)
+        return conn.execute(
+            "pragma table_info({})".format(_quote_identifier(table))
+        ).fetchall()
+    except sqlite3.Error as ex:
+        raise click.ClickException(
+            "Could not parse schema for {}: {}".format(table, ex)
+        )
+    finally:
+        conn.close()
+
+
+def _remote_column_types(url, table, token):
+    """
+    Read the column types of an existing remote table from its schema.json.
+
+    Returns {column: affinity}, or None if the table does not exist.
+    """
+    schema = _remote_schema(url, table, token)
+    if schema is None:
+        return None
+    return {
+        name: _affinity(declared)
+        for _, name, declared, *_ in _schema_table_info(schema, table)
+    }
+
+
+def _affinity(declared):
+    "SQLite's rules for the type affinity of a declared column type"
+    declared = (declared or "").upper()
+    if "INT" in declared:
+        return "integer"
+    if "CHAR" in declared or "CLOB" in declared or "TEXT" in declared:
+        return "text"
+    if "BLOB" in declared or not declared:
+        return "blob"
+    if "REAL" in declared or "FLOA" in declared or "DOUB" in declared:
+        return "real"
+    return "numeric"
+
+
+def _to_integer(value):
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            value = float(value)
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise ValueError(value)
+        return int(value)
+    if isinstance(value, int):
+        return int(value)
+    raise TypeError(value)
+
+
+def _to_real(value):
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+    if isinstance(value, (str, int, float)):
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(value)
+        return value
+    raise TypeError(value)
+
+
+def _to_text(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict) and value.get("$base64") is True:
+        return value
+    if isinstance(value, (dict, list)):
+        # Stored as JSON text, as the server would
+        return _sqlite_value(value)
+    raise TypeError(value)
+
+
+def _to_numeric(value):
+    # Like SQLite: text that looks like a number becomes one, other text is kept
+    if isinstance(value, str):
+        for convert in (int, float):
+            try:
+                return convert(value.strip())
+            except ValueError:
+                pass
+    return value
+
+
+_COERCE = {
+    "integer": _to_integer,
+    "real": _to_real,
+    "text": _to_text,
+    "numeric": _to_numeric,
+    "blob": lambda value: value,
+}
+
+
+def _coerce_batch(batch, column_types):
+    """
+    Convert the values in a batch of rows to the affinities in column_types.
+
+    Returns (rows, invalid) - invalid is a list of (row, errors) for rows
+    with values that can't be converted, such as text in an INTEGER column.
+    """
+    rows = []
+    invalid = []
+    for row in batch:
+        converted = {}
+        errors = []
+        for key, value in row.items():
+            affinity = column_types.get(key)
+            if affinity is None or value is None:
+                converted[key] = value
+                continue
+            try:
+                converted[key] = _COERCE[affinity](value)
+            except (TypeError, ValueError, OverflowError):
+                errors.append(
+                    "{}: {} is not a valid {} value".format(
+                        key, json.dumps(value, default=repr), affinity
+                    )
+                )
+        if errors:
+            invalid.append((row, errors))
+        else:
+            rows.append(converted)
+    return rows, invalid
+
+
+_input_format_options = [
+    click.option("format_csv", "--csv", is_flag=True, help="Input is CSV"),
+    click.option("format_tsv", "--tsv", is_flag=True, help="Input is TSV"),
+    click.option("format_json", "--json", is_flag=True, help="Input is JSON"),
+    click.option(
+        "format_nl", "--nl", is_flag=True, help="Input is newline-delimited JSON"
+    ),
+]
+
+_rejects_option = click.option(
+    "--rejects",
+    type=click.Path(dir_okay=False),
+    help="Write rows the server rejects to this newline-delimited JSON file "
+    "and carry on",
+)
+
+_request_options = [
+    click.option("--token", help="API token"),
+    click.option("--silent", is_flag=True, help="Don't output progress"),
+    click.option(
+        "-v",
+        "--verbose",
+        is_flag=True,
+        help="Verbose output: show HTTP request and response",
+    ),
+]
+
+_insert_options = [
+    click.argument("database"),
+    click.argument("table"),
+    click.argument(
+        "filepaths",
+        nargs=-1,
+        type=click.Path(allow_dash=True, dir_okay=False),
+    ),
+    click.option(
+        "-i",
+        "--instance",
+        multiple=True,
+        help="Datasette instance URL or alias - use more than once to send the "
+        "same rows to several instances",
+    ),
+    *_input_format_options,
+    click.option("format_parquet", "--parquet", is_flag=True, help="Input is Parquet"),
+    click.option("format_arrow", "--arrow", is_flag=True, help="Input is Arrow IPC"),
+    click.option(
+        "--arrow-csv", is_flag=True, help="Use the pyarrow reader for CSV/TSV"
+    ),
+    click.option("--encoding", help="Character encoding for CSV/TSV"),
+    click.option(
+        "--no-detect-types", is_flag=True, help="Don't detect column types for CSV/TSV"
+    ),
+    click.option(
+        "--schema-types",
+        is_flag=True,
+        help="Convert values to the column types of the existing remote table",
+    ),
+    click.option(
+        "--alter", is_flag=True, help="Alter table to add any missing columns"
+    ),
+    click.option(
+        "pks",
+        "--pk",
+        multiple=True,
+        help="Columns to use as the primary key when creating the table",
+    ),
+    click.option(
+        "--batch-size", type=int, default=100, help="Send rows in batches of this size"
+    ),
+    click.option(
+        "--interval", type=float, default=10, help="Send batch at least every X seconds"
+    ),
+    _rejects_option,
+    click.option(
+        "--verify",
+        is_flag=True,
+        help="Check the row count and a checksum of the rows on the server "
+        "once they have all been sent",
+    ),
+    click.option(
+        "--spool",
+        type=click.Path(file_okay=False),
+        help="Save batches the server can't accept right now in this directory, "
+        "to send later with 'dclient spool flush'",
+    ),
+    click.option(
+        "--stream",
+        is_flag=True,
+        help="Send partial batches on a timer, for unbounded input such as tail -f",
+    ),
+    click.option(
+        "--max-latency",
+        type=float,
+        help="With --stream, send rows at most this many seconds after reading them "
+        "(default 1)",
+    ),
+    click.option(
+        "--parse-workers",
+        type=int,
+        help="Parse CSV/TSV/newline-delimited JSON using this many processes",
+    ),
+    click.option(
+        "--checkpoint",
+        type=click.Path(dir_okay=False),
+        help="Record progress in this file after each batch",
+    ),
+    click.option(
+        "--resume",
+        is_flag=True,
+        help="Skip rows already recorded as sent in the --checkpoint file",
+    ),
+    click.option(
+        "--skip-unchanged",
+        is_flag=True,
+        help="Only send rows that are new or changed since they were last sent",
+    ),
+    click.option(
+        "--files-concurrency",
+        type=click.IntRange(min=1),
+        help="With several files or a glob, insert this many files at once "
+        "(default {})".format(FILES_CONCURRENCY),
+    ),
+    click.option(
+        "--table-field",
+        help="Insert each row into the table named by this field, instead of TABLE",
+    ),
+    click.option(
+        "--dedupe-pk",
+        is_flag=True,
+        help="Only send the last of any rows with the same --pk values, or the "
+        "first with --ignore",
+    ),
+    click.option(
+        "--dedupe-window",
+        type=click.IntRange(min=1),
+        help="With --dedupe-pk, also drop duplicates across batches, holding back "
+        "up to this many rows",
+    ),
+    click.option(
+        "--from-sqlite",
+        type=click.Path(dir_okay=False),
+        help="Read rows from this local SQLite database instead of a file",
+    ),
+    click.option("--from-table", help="Table to read from the --from-sqlite database"),
+    click.option("--from-sql", help="SQL query to run against --from-sqlite"),
+    click.option(
+        "--stats", is_flag=True, help="Show timings for each stage at the end"
+    ),
+    click.option(
+        "--stats-json",
+        type=click.Path(dir_okay=False),
+        help="Write timings for each stage to this JSON file",
+    ),
+    click.option(
+        "--dry-run",
+        is_flag=True,
+        help="Read, convert and serialize rows but don't send them",
+    ),
+    *_request_options,
+]
+
+
+def _apply_options(options):
+    def decorator(func):
+        for option in reversed(options):
+            func = option(func)
+        return func
+
+    return decorator
+
+
+@cli.command()
+@_apply_options(_insert_options)
+@click.option(
+    "--replace", is_flag=True, help="Replace rows with a matching primary key"
+)
+@click.option("--ignore", is_flag=True, help="Ignore rows with a matching primary key")
+@click.option("--create", is_flag=True, help="Create table if it does not exist")
+def insert(
+    database,
+    table,
+    filepaths,
+    instance,
+    format_csv,
+    format_tsv,
+    format_json,
+    format_nl,
+    encoding,
+    no_detect_types,
+    alter,
+    pks,
+    batch_size,
+    interval,
+    token,
+    silent,
+    verbose,
+    replace,
+    ignore,
+    create,
+    **kwargs,
+):
+    """
+    Insert data into a remote Datasette instance
+
+    Example usage:
+
+    \b
+        dclient insert main mytable data.csv --csv -i myapp
+        dclient insert main mytable data.csv --csv --create --pk id
+        dclient insert main mytable --from-sqlite local.db --from-table src
+        dclient insert main events.ndjson --table-field type --create
+        dclient insert main mytable 'shards/*.csv' --files-concurrency 8
+    """
+    _do_insert(
+        database,
+        table,
+        filepaths,
+        format_csv,
+        format_tsv,
+        format_json,
+        format_nl,
+        encoding,
+        no_detect_types,
+        replace,
+        ignore,
+        create,
+        alter,
+        pks,
+        batch_size,
+        interval,
+        token,
+        silent,
+        verbose,
+        instance,
+        endpoint="insert",
+        **kwargs,
+    )
+
+
+@cli.command()
+@_apply_options(_insert_options)
+def upsert(
+    database,
+    table,
+    filepaths,
+    instance,
+    format_csv,
+    format_tsv,
+    format_json,
+    format_nl,
+    encoding,
+    no_detect_types,
+    alter,
+    pks,
+    batch_size,
+    interval,
+    token,
+    silent,
+    verbose,
+    **kwargs,
+):
+    """
+    Upsert data into a remote Datasette instance
+
+    Example usage:
+
+    \b
+        dclient upsert main mytable data.csv --csv -i myapp
+    """
+    _do_insert(
+        database,
+        table,
+        filepaths,
+        format_csv,
+        format_tsv,
+        format_json,
+        format_nl,
+        encoding,
+        no_detect_types,
+        False,
+        False,
+        False,
+        alter,
+        pks,
+        batch_size,
+        interval,
+        token,
+        silent,
+        verbose,
+        instance,
+        endpoint="upsert",
+        **kwargs,
+    )
+
+
+@cli.group()
+def spool():
+    "Send batches saved by insert and upsert --spool"
+
+
+@spool.command(name="flush")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of tables to send at once",
+)
+@click.option("--token", help="API token, instead of the one stored for the instance")
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Verbose output: show HTTP request and response",
+)
+def spool_flush(directory, concurrency, token, verbose):
+    """
+    Send the batches waiting in a --spool directory
+
+    Each table's batches are sent in the order they were spooled, stopping
+    at the first one that fails. Tokens are looked up for each instance now,
+    as they are not stored in the spool.
+
+    Example usage:
+
+    \b
+        dclient spool flush spool/
+    """
+    spool = _Spool(directory)
+    queues = spool.queues()
+    if not queues:
+        click.echo("Nothing to send", err=True)
+        return
+    config_dir = get_config_dir()
+    tokens = {}
+    for instance, _, _ in queues:
+        if instance not in tokens:
+            tokens[instance] = _resolve_token(
+                token,
+                instance,
+                config_dir / "auth.json",
+                config_dir / "config.json",
+            )
+
+    def send_queue(client, queue):
+        # Returns (requests sent, rows sent, error or None)
+        requests = rows = 0
+        while True:
+            item = spool.next(queue)
+            if item is None:
+                return requests, rows, None
+            id, url, body, batch_rows = item
+            if verbose:
+                click.echo("POST {}".format(url), err=True)
+            try:
+                response = client.post(
+                    url,
+                    headers={
+                        "Authorization": "Bearer {}".format(tokens[queue[0]]),
+                        "Content-Type": "application/json",
+                    },
+                    content=body,
+                    timeout=40.0,
+                )
+            except httpx.TransportError as ex:
+                return requests, rows, str(ex) or type(ex).__name__
+            if verbose:
+                click.echo(str(response), err=True)
+            if str(response.status_code)[0] != "2":
+                error = "{} {}".format(response.status_code, response.reason_phrase)
+                if "/json" in response.headers.get("content-type", ""):
+                    error = "\n".join(response.json().get("errors") or [error])
+                return requests, rows, error
+            spool.remove(id)
+            requests += 1
+            rows += batch_rows
+
+    failed = False
+    with httpx.Client() as client, ThreadPoolExecutor(concurrency) as executor:
+        results = executor.map(lambda queue: send_queue(client, queue), queues)
+        for (instance, database, table), (requests, rows, error) in zip(
+            queues, results
+        ):
+            message = "{}/{}: sent {} rows in {} batches".format(
+                database, table, rows, requests
+            )
+            if error:
+                failed = True
+                waiting, waiting_rows = spool.waiting((instance, database, table))
+                message += (
+                    ", stopped with {} rows in {} batches still waiting: {}".format(
+                        waiting_rows, waiting, error
+                    )
+                )
+            click.echo(message, err=True)
+    if failed:
+        raise click.exceptions.Exit(1)
+
+
+_row_action_options = [
+    click.option(
+        "-i", "--instance", default=None, help="Datasette instance URL or alias"
+    ),
+    *_input_format_options,
+    click.option("--encoding", help="Character encoding for CSV/TSV"),
+    click.option(
+        "pks",
+        "--pk",
+        multiple=True,
+        help="Primary key column(s) - defaults to those of the table",
+    ),
+    click.option(
+        "--concurrency",
+        type=int,
+        default=10,
+        help="Number of requests to run at once",
+    ),
+    _rejects_option,
+    *_request_options,
+]
+
+
+@cli.command()
+@click.argument("database")
+@click.argument("table")
+@click.option(
+    "pks_from",
+    "--pks-from",
+    type=click.Path("rb", readable=True, allow_dash=True, dir_okay=False),
+    required=True,
+    help="File containing the primary keys of the rows to delete",
+)
+@_apply_options(_row_action_options)
+def delete(database, table, pks_from, **kwargs):
+    """
+    Delete rows identified by primary keys read from a file
+
+    The file can be CSV, TSV, JSON or newline-delimited JSON, with a
+    column for each primary key.
+
+    Example usage:
+
+    \b
+        dclient delete main mytable --pks-from ids.csv -i myapp
+    """
+    _do_row_action("delete", database, table, pks_from, **kwargs)
+
+
+@cli.command()
+@click.argument("database")
+@click.argument("table")
+@click.argument(
+    "filepath",
+    type=click.Path("rb", readable=True, allow_dash=True, dir_okay=False),
+)
+@click.option("--alter", is_flag=True, help="Alter table to add any missing columns")
+@_apply_options(_row_action_options)
+def update(database, table, filepath, alter, **kwargs):
+    """
+    Update rows using data from a file
+
+    Each row must include the primary key columns of the row to update,
+    the other columns are the values to set.
+
+    Example usage:
+
+    \b
+        dclient update main mytable changes.csv -i myapp
+    """
+    _do_row_action("update", database, table, filepath, alter=alter, **kwargs)
+
+
+def _do_row_action(
+    action,
+    database,
+    table,
+    filepath,
+    instance,
+    format_csv,
+    format_tsv,
+    format_json,
+    format_nl,
+    encoding,
+    pks,
+    concurrency,
+    rejects,
+    token,
+    silent,
+    verbose,
+    alter=False,
+):
+    """
+    Shared implementation for delete and update, which make one request
+    per row to /db/table/<pk>/-/delete or /-/update.
+    """
+    config_dir = get_config_dir()
+    url = _resolve_instance(instance, config_dir / "config.json")
+    token = _resolve_token(
+        token, url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    format = _input_format(format_csv, format_tsv, format_json, format_nl)
+    if format is None and filepath == "-":
+        raise click.ClickException(
+            "An explicit format is required  - e.g. --csv "
+            "- when reading from standard input"
+        )
+    if format is None and filepath != "-" and _is_ndjson_path(filepath):
+        format = Format.NL
+    if concurrency < 1:
+        raise click.ClickException("--concurrency must be at least 1")
+
+    fp, raw, _ = _open_input(filepath)
+    try:
+        try:
+            rows, format = rows_from_file(fp, format=format, encoding=encoding)
+        except csv.Error:
+            if format is not None or filepath == "-":
+                raise
+            # A single column of keys has no delimiter to detect
+            fp, raw, _ = _open_input(filepath)
+            rows, format = rows_from_file(fp, format=Format.CSV, encoding=encoding)
+    except Exception as ex:
+        raise click.ClickException(str(ex))
+    file_size = None
+    if filepath != "-" and format not in (Format.JSON, Format.NL):
+        file_size = pathlib.Path(filepath).stat().st_size
+
+    table_url = "{}/{}/{}".format(url.rstrip("/"), database, tilde_encode(table))
+    headers = {
+        "Authorization": "Bearer {}".format(token),
+        "Content-Type": "application/json",
+    }
+    done = rejected = 0
+    with contextlib.ExitStack() as stack:
+        client = stack.enter_context(
+            httpx.Client(
+                headers=headers,
+                timeout=40.0,
+                limits=httpx.Limits(max_connections=concurrency),
+            )
+        )
+        pks = list(pks) or _table_primary_keys(client, table_url)
+
+        def request(row):
+            # Runs in a worker thread
+            return row, _row_request(
+                client, table_url, action, pks, row, alter=alter, verbose=verbose
+            )
+
+        rejects_fp = None
+        if rejects:
+            rejects_fp = stack.enter_context(open(rejects, "w"))
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+        bar = stack.enter_context(
+            progressbar(
+                length=file_size,
+                label="Deleting rows" if action == "delete" else "Updating rows",
+                silent=silent or (file_size is None),
+                show_percent=True,
+            )
+        )
+        bytes_so_far = 0
+        for row, errors in _ordered_map(
+            executor, request, ((row,) for row in rows), ahead=concurrency * 2
+        ):
+            if errors is None:
+                done += 1
+            elif rejects_fp is None:
+                raise click.ClickException("\n".join(errors))
+            else:
+                rejected += 1
+                rejects_fp.write(
+                    json.dumps({"row": row, "errors": errors}, default=repr) + "\n"
+                )
+            if file_size is not None:
+                try:
+                    position = raw.tell()
+                except ValueError:
+                    # The file is closed once all of it has been read
+                    position = file_size
+                bar.update(position - bytes_so_far)
+                bytes_so_far = position
+    if not silent:
+        click.echo(
+            "{} {} rows".format("Deleted" if action == "delete" else "Updated", done),
+            err=True,
+        )
+    if rejected:
+        click.echo(
+            "{} rejected rows were written to {}".format(rejected, rejects), err=True
+        )
+
+
+def _row_request(client, table_url, action, pks, row, alter=False, verbose=False):
+    """
+    Delete or update a single row using /db/table/<pk>/-/delete or /-/update.
+
+    Returns None if that worked, or a list of errors if the server rejected
+    the row. Other errors raise a ClickException.
+    """
+    missing = [pk for pk in pks if row.get(pk) in (None, "")]
+    if missing:
+        return ["Row is missing primary key column: {}".format(", ".join(missing))]
+    row_url = "{}/{}/-/{}".format(
+        table_url,
+        ",".join(tilde_encode(str(row[pk])) for pk in pks),
+        action,
+    )
+    data = None
+    if action == "update":
+        data = {"update": {key: value for key, value in row.items() if key not in pks}}
+        if alter:
+            data["alter"] = True
+    if verbose:
+        click.echo("POST {}".format(row_url), err=True)
+    response = client.post(row_url, json=data)
+    if verbose:
+        click.echo(str(response), err=True)
+    if str(response.status_code)[0] == "2":
+        return None
+    errors = _response_errors(response)
+    if _rows_refused(response, single_row=True):
+        return errors
+    raise click.ClickException("\n".join(errors))
+
+
+def _table_primary_keys(client, table_url):
+    "Primary key columns of a table - rowid for tables that don't have one"
+    response = client.get(table_url + ".json?_size=0&_extra=primary_keys")
+    if response.status_code != 200:
+        raise click.ClickException(
+            "Could not read primary keys of {}: {} {}".format(
+                table_url, response.status_code, response.reason_phrase
+            )
+        )
+    return response.json().get("primary_keys") or ["rowid"]
+
+
+@cli.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False, readable=True))
+@click.argument("database")
+@click.option("tables", "--table", multiple=True, help="Only push these tables")
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    help="Compare rows in chunks of this many primary keys",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=100,
+    help="Send rows in batches of this size",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=10,
+    help="Number of requests to run at once",
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Report what would change without changing it"
+)
+@click.option("-i", "--instance", default=None, help="Datasette instance URL or alias")
+@click.option("--token", help="API token")
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Verbose output: show HTTP request and response",
+)
+def push(
+    path,
+    database,
+    tables,
+    chunk_size,
+    batch_size,
+    concurrency,
+    dry_run,
+    instance,
+    token,
+    verbose,
+):
+    """
+    Sync tables from a local SQLite database to a remote database
+
+    Rows are compared by primary key. New and changed rows are upserted,
+    rows that no longer exist locally are deleted.
+
+    Example usage:
+
+    \b
+        dclient push local.db data -i myapp
+        dclient push local.db data --table dogs --dry-run
+    """
+    config_dir = get_config_dir()
+    url = _resolve_instance(instance, config_dir / "config.json")
+    token = _resolve_token(
+        token, url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    if min(concurrency, chunk_size, batch_size) < 1:
+        raise click.ClickException(
+            "--concurrency, --chunk-size and --batch-size must be at least 1"
+        )
+    db_url = url.rstrip("/") + "/" + database
+    counts = {}
+
+    with contextlib.ExitStack() as stack:
+        conn = stack.enter_context(contextlib.closing(sqlite3.connect(path)))
+        local_tables = _local_tables(conn)
+        for table in tables:
+            if table not in local_tables:
+                raise click.ClickException(
+                    "Table {} not found in {}".format(table, path)
+                )
+        client = stack.enter_context(
+            httpx.Client(
+                headers={"Authorization": "Bearer {}".format(token)},
+                timeout=40.0,
+                limits=httpx.Limits(max_connections=concurrency),
+            )
+        )
+        remote = _RemoteSQL(client, db_url, verbose)
+        hash_sql = _remote_hash_function(remote)
+
+        def upload(table, pks, rows, create=False, alter=False):
+            _insert_batch(
+                url=db_url,
+                table=table,
+                batch=rows,
+                token=token,
+                create=create,
+                alter=alter,
+                pks=pks,
+                replace=False,
+                ignore=False,
+                verbose=verbose,
+                endpoint="upsert",
+                client=client,
+            )
+
+        def delete(table, pks, key):
+            errors = _row_request(
+                client,
+                db_url + "/" + tilde_encode(table),
+                "delete",
+                pks,
+                dict(zip(pks, key)),
+                verbose=verbose,
+            )
+            if errors:
+                raise click.ClickException("\n".join(errors))
+
+        def jobs():
+            # Runs in this thread, comparing the next chunks while the
+            # changes found in earlier ones are being sent
+            for table in tables or local_tables:
+                columns, pks = local_tables[table]
+                if not pks:
+                    click.echo(
+                        "Skipping {}: it has no primary key".format(table), err=True
+                    )
+                    continue
+                table_counts = counts[table] = collections.Counter()
+                remote_columns = remote.columns(table)
+                if not remote_columns:
+                    # There is nothing to compare, so send every row - the
+                    # table has to be created before the other batches
+                    batches = _batches(_local_rows(conn, table, pks), batch_size)
+                    first = next(batches, None)
+                    if first:
+                        table_counts["upserted"] += len(first)
+                        if not dry_run:
+                            upload(table, pks, first, create=True)
+                    for batch in batches:
+                        table_counts["upserted"] += len(batch)
+                        if not dry_run:
+                            yield upload, table, pks, batch
+                    continue
+                # Columns the remote table doesn't have yet compare as null,
+                # and are added by the first batch of changed rows
+                missing = [column for column in columns if column not in remote_columns]
+                missing_pks = [pk for pk in pks if pk in missing]
+                if missing_pks:
+                    raise click.ClickException(
+                        "{}: the remote table has no {} column, so rows can't be "
+                        "matched by primary key".format(table, ", ".join(missing_pks))
+                    )
+                for changed, deleted, unchanged in _push_diff(
+                    remote, conn, table, columns, pks, chunk_size, hash_sql, missing
+                ):
+                    table_counts["unchanged"] += unchanged
+                    table_counts["upserted"] += len(changed)
+                    table_counts["deleted"] += len(deleted)
+                    if dry_run:
+                        continue
+                    for keys in _batches(changed, batch_size):
+                        rows = _local_rows(conn, table, pks, keys)
+                        if missing:
+                            # Other batches can only be sent once this one has
+                            # added the columns
+                            upload(table, pks, rows, alter=True)
+                            missing = []
+                            continue
+                        yield upload, table, pks, rows
+                    for key in deleted:
+                        yield delete, table, pks, key
+
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+        for _ in _ordered_map(executor, _call, jobs(), ahead=concurrency * 2):
+            pass
+
+    for table, table_counts in counts.items():
+        click.echo(
+            "{}: {} {}, {} {}, {} unchanged".format(
+                table,
+                table_counts["upserted"],
+                "to upsert" if dry_run else "upserted",
+                table_counts["deleted"],
+                "to delete" if dry_run else "deleted",
+                table_counts["unchanged"],
+            )
+        )
+
+
+def _call(fn, *args):
+    return fn(*args)
+
+
+def _local_tables(conn):
+    """
+    Returns {table: (columns, pks)} for the tables in a local database,
+    leaving out virtual tables and their shadow tables.
+    """
+    masters = conn.execute(
+        "select name, sql from sqlite_master where type = 'table' "
+        "and name not like 'sqlite_%' order by name"
+    ).fetchall()
+    virtual = [
+        name for name, sql in masters if sql.upper().startswith("CREATE VIRTUAL")
+    ]
+    tables = {}
+    for name, sql in masters:
+        if name in virtual or any(name.startswith(v + "_") for v in virtual):
+            continue
+        info = conn.execute(
+            "select name, pk from pragma_table_info(?)", [name]
+        ).fetchall()
+        columns = [column for column, _ in info]
+        pks = [column for column, pk in sorted(info, key=lambda c: c[1]) if pk]
+        tables[name] = (columns, pks)
+    return tables
+
+
+def _column_list(columns):
+    return ", ".join(_quote_identifier(column) for column in columns)
+
+
+def _local_rows(conn, table, pks, keys=None):
+    "Rows from a local table in primary key order, optionally just these keys"
+    sql = "select * from {}".format(_quote_identifier(table))
+    params = []
+    if keys is not None:
+        sql += " where ({}) in (values {})".format(
+            _column_list(pks),
+            ", ".join("({})".format(", ".join("?" for _ in pks)) for _ in keys),
+        )
+        params = [value for key in keys for value in key]
+    cursor = conn.execute(sql + " order by {}".format(_column_list(pks)), params)
+    columns = [column[0] for column in cursor.description]
+    rows = (
+        {column: _json_value(value) for column, value in zip(columns, values)}
+        for values in cursor
+    )
+    return rows if keys is None else list(rows)
+
+
+def _fingerprint_sql(columns, missing=()):
+    """
+    SQL expression encoding the values of a row, and their types, as one
+    string - evaluated by SQLite both locally and on the server, so the two
+    can be compared. Columns in missing are encoded as null.
+    """
+    return " || char(31) || ".join(
+        "'n'" if column in missing else _typed_value_sql(column) for column in columns
+    )
+
+
+def _typed_value_sql(column):
+    "SQL expression encoding a column's value and its type as a string"
+    return (
+        "case typeof({c}) when 'null' then 'n' when 'integer' then 'i' || {c} "
+        "when 'real' then 'r' || printf('%.17g', {c}) when 'text' then 't' || {c} "
+        "else 'b' || hex({c}) end".format(c=_quote_identifier(column))
+    )
+
+
+def _pk_range_sql(pks, lower, upper):
+    """
+    SQL where clause and params for rows with lower < primary key <= upper.
+    A bound of None means there is no limit in that direction.
+    """
+    columns = "({})".format(_column_list(pks))
+    clauses = []
+    params = {}
+    for bound, op, prefix in ((lower, ">", "l"), (upper, "<=", "u")):
+        if bound is None:
+            continue
+        names = ["{}{}".format(prefix, i) for i in range(len(pks))]
+        clauses.append(
+            "{} {} ({})".format(columns, op, ", ".join(":" + name for name in names))
+        )
+        params.update(zip(names, bound))
+    return " and ".join(clauses) or "1", params
+
+
+# Python equivalents of SQL functions the server might have for hashing rows
+PUSH_HASH_FUNCTIONS = ("sha1", "sha256", "md5")
+
+
+class _QueryInterrupted(click.ClickException):
+    "The server stopped a query that ran for longer than its time limit"
+
+
+class _RemoteSQL:
+    "Run read-only SQL queries against a remote database"
+
+    def __init__(self, client, db_url, verbose=False):
+        self.client = client
+        self.db_url = db_url
+        self.verbose = verbose
+
+    def query(self, sql, params=None):
+        params = dict(params or {}, sql=sql, _shape="objects")
+        if self.verbose:
+            click.echo(
+                "GET {}.json?{}".format(self.db_url, urllib.parse.urlencode(params)),
+                err=True,
+            )
+        response = self.client.get(
+            self.db_url + ".json", params=params, follow_redirects=True
+        )
+        try:
+            data = response.json()
+        except json.JSONDecodeError:
+            data = {}
+        if response.status_code != 200 or not data.get("ok", True):
+            error = (
+                _QueryInterrupted
+                if data.get("title") == "SQL Interrupted"
+                else click.ClickException
+            )
+            raise error(
+                "{} status code. {}".format(
+                    response.status_code,
+                    data.get("error") or data.get("title") or "Query failed",
+                )
+            )
+        return data["rows"], data.get("truncated", False)
+
+    def columns(self, table):
+        "Columns of a remote table - an empty list if it does not exist"
+        rows, _ = self.query(
+            "select name from pragma_table_info(:table)", {"table": table}
+        )
+        return [row["name"] for row in rows]
+
+    def keyed_rows(self, table, pks, expression, where, params, page_size=1000):
+        """
+        Yield (primary key tuple, expression) for each matching row, paginating
+        through them in primary key order.
+        """
+        after = None
+        keys = ", ".join(
+            "{} as p{}".format(_quote_identifier(pk), i) for i, pk in enumerate(pks)
+        )
+        while True:
+            after_sql, after_params = _pk_range_sql(pks, after, None)
+            rows, truncated = self.query(
+                "select {}, {} as h from {} where {} and {} order by {} "
+                "limit {}".format(
+                    keys,
+                    expression,
+                    _quote_identifier(table),
+                    where,
+                    after_sql,
+                    _column_list(pks),
+                    page_size,
+                ),
+                dict(params, **after_params),
+            )
+            for row in rows:
+                yield tuple(row["p{}".format(i)] for i in range(len(pks))), row["h"]
+            if not rows or (len(rows) < page_size and not truncated):
+                return
+            after = tuple(rows[-1]["p{}".format(i)] for i in range(len(pks)))
+
+    def key_boundaries(self, table, pks, bounds, step, limit=None):
+        """
+        Yield the primary key of every step-th row within bounds, in order.
+
+        Each query skips step rows from the previous key using the primary
+        key index, so none of them has to read more than step rows.
+        """
+        lower, upper = bounds
+        keys = ", ".join(
+            "{} as p{}".format(_quote_identifier(pk), i) for i, pk in enumerate(pks)
+        )
+        found = 0
+        while limit is None or found < limit:
+            where, params = _pk_range_sql(pks, lower, upper)
+            rows, _ = self.query(
+                "select {} from {} where {} order by {} limit 1 offset {}".format(
+                    keys,
+                    _quote_identifier(table),
+                    where,
+                    _column_list(pks),
+                    step - 1,
+                ),
+                params,
+            )
+            if not rows:
+                return
+            lower = tuple(rows[0]["p{}".format(i)] for i in range(len(pks)))
+            yield lower
+            found += 1
+
+
+def _remote_hash_function(remote):
+    """
+    Find a hash function the server can run over SQL strings.
+
+    Returns (name, sql_template) where sql_template.format(expr) gives a
+    lowercase hex digest, or None if the server doesn't have one.
+    """
+    for name in PUSH_HASH_FUNCTIONS:
+        expected = hashlib.new(name, b"dclient").hexdigest()
+        try:
+            rows, _ = remote.query(
+                "select typeof({0}('dclient')) as t, lower({0}('dclient')) as s, "
+                "lower(hex({0}('dclient'))) as b".format(name)
+            )
+        except click.ClickException:
+            continue
+        # Some implementations return text, others a blob
+        if rows and rows[0]["t"] == "text" and rows[0]["s"] == expected:
+            return name, "lower(" + name + "({}))"
+        if rows and rows[0]["t"] == "blob" and rows[0]["b"] == expected:
+            return name, "lower(hex(" + name + "({})))"
+    return None
+
+
+def _hex_to_int_sql(expression, start):
+    "SQL for the integer value of the 8 hex digits of expression from start"
+    return " + ".join(
+        "(instr('0123456789abcdef', substr({}, {}, 1)) - 1) * {}".format(
+            expression, start + i, 16 ** (7 - i)
+        )
+        for i in range(8)
+    )
+
+
+def _hash_summary(hashes):
+    "Order-independent (count, sum, sum) summary of a set of hex digests"
+    return (
+        len(hashes),
+        sum(int(h[:8], 16) for h in hashes),
+        sum(int(h[8:16], 16) for h in hashes),
+    )
+
+
+def _remote_hash_summary(remote, table, expression, where, params):
+    "The _hash_summary() of a range of remote rows, calculated by the server"
+    # lower() of the digest happens in the subquery - the limit stops SQLite
+    # from flattening it and hashing every row 16 times
+    summary, _ = remote.query(
+        "select count(*) as c, sum({}) as a, sum({}) as b from ("
+        "select {} as h from {} where {} limit -1)".format(
+            _hex_to_int_sql("h", 1),
+            _hex_to_int_sql("h", 9),
+            expression,
+            _quote_identifier(table),
+            where,
+        ),
+        params,
+    )
+    return summary[0]["c"], summary[0]["a"] or 0, summary[0]["b"] or 0
+
+
+def _push_diff(remote, conn, table, columns, pks, chunk_size, hash_sql, missing=()):
+    """
+    Compare a local table with the remote one in chunks of primary keys.
+
+    Yields (changed_keys, deleted_keys, unchanged_count) for each chunk. If
+    the server can hash rows, each chunk is first compared using a single
+    aggregate query - only chunks that differ are compared row by row.
+
+    missing lists local columns the remote table does not have, which are
+    compared as if they were null there.
+    """
+    name, template = hash_sql or ("sha1", None)
+    fingerprint = _fingerprint_sql(columns)
+    remote_fingerprint = _fingerprint_sql(columns, missing)
+    cursor = conn.execute(
+        "select {}, {} from {} order by {}".format(
+            _column_list(pks), fingerprint, _quote_identifier(table), _column_list(pks)
+        )
+    )
+
+    def digest(value):
+        return hashlib.new(name, value.encode("utf-8")).hexdigest()
+
+    lower = None
+    rows = cursor.fetchmany(chunk_size)
+    while True:
+        following = cursor.fetchmany(chunk_size) if rows else []
+        local = {tuple(row[:-1]): digest(row[-1]) for row in rows}
+        # The last chunk takes every remote key after the previous chunk
+        upper = tuple(rows[-1][:-1]) if following else None
+        where, params = _pk_range_sql(pks, lower, upper)
+        if template:
+            remote_summary = _remote_hash_summary(
+                remote, table, template.format(remote_fingerprint), where, params
+            )
+            if remote_summary == _hash_summary(list(local.values())):
+                yield [], [], len(local)
+                lower = upper
+                if not following:
+                    return
+                rows = following
+                continue
+            remote_rows = remote.keyed_rows(
+                table, pks, template.format(remote_fingerprint), where, params
+            )
+        else:
+            remote_rows = (
+                (key, digest(value))
+                for key, value in remote.keyed_rows(
+                    table, pks, remote_fingerprint, where, params
+                )
+            )
+        remote_hashes = dict(remote_rows)
+        changed = [key for key, h in local.items() if remote_hashes.get(key) != h]
+        deleted = [key for key in remote_hashes if key not in local]
+        yield changed, deleted, len(local) - len(changed)
+        if not following:
+            return
+        lower = upper
+        rows = following
+
+
+# How many parts a range of primary keys is split into when it differs
+DIFF_PARTS = 16
+
+# Rows in each of the ranges diff starts with - small enough for the server
+# to hash within its default one second time limit
+DIFF_RANGE_SIZE = 50000
+
+
+@cli.command()
+@click.argument("path")
+@click.option(
+    "-i",
+    "--instance",
+    default=None,
+    help="Datasette instance URL or alias with the table",
+)
+@click.option(
+    "--against",
+    required=True,
+    help="Datasette instance URL or alias to compare it with",
+)
+@click.option("--token", help="API token for the -i instance")
+@click.option("--against-token", help="API token for the --against instance")
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=1000,
+    help="Compare ranges of up to this many rows row by row",
+)
+@click.option(
+    "--range-size",
+    type=click.IntRange(min=1),
+    default=DIFF_RANGE_SIZE,
+    help="Start by comparing ranges of this many rows",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=10,
+    help="Number of ranges to compare at once",
+)
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Verbose output: show HTTP request and response",
+)
+@output_format_options
+def diff(
+    path,
+    instance,
+    against,
+    token,
+    against_token,
+    chunk_size,
+    range_size,
+    concurrency,
+    verbose,
+    fmt_csv,
+    fmt_tsv,
+    fmt_nl,
+    fmt_table,
+):
+    """
+    Compare a table on two Datasette instances without downloading it
+
+    PATH is database/table. Both servers hash ranges of --range-size primary
+    keys with SQL queries, and only ranges that differ are split up and
+    compared again, until they are small enough to compare row by row. Outputs the primary
+    keys of rows that are changed, missing from the --against instance or
+    extra rows only found there, and exits with status 1 if there are any.
+
+    Example usage:
+
+    \b
+        dclient diff data/dogs -i staging --against prod
+    """
+    database, table = _split_table_path(path)
+    config_dir = get_config_dir()
+    urls = [
+        _resolve_instance(instance, config_dir / "config.json"),
+        _resolve_instance(against, config_dir / "config.json"),
+    ]
+    tokens = [
+        _resolve_token(
+            side_token, url, config_dir / "auth.json", config_dir / "config.json"
+        )
+        for side_token, url in zip((token, against_token), urls)
+    ]
+
+    with contextlib.ExitStack() as stack:
+        sides = []
+        for url, side_token in zip(urls, tokens):
+            client = stack.enter_context(
+                httpx.Client(
+                    headers=(
+                        {"Authorization": "Bearer {}".format(side_token)}
+                        if side_token
+                        else {}
+                    ),
+                    timeout=40.0,
+                    limits=httpx.Limits(max_connections=concurrency),
+                )
+            )
+            sides.append(_RemoteSQL(client, url.rstrip("/") + "/" + database, verbose))
+        columns, against_columns = (side.columns(table) for side in sides)
+        for url, side_columns in zip(urls, (columns, against_columns)):
+            if not side_columns:
+                raise click.ClickException("Table {} not found on {}".format(path, url))
+        if set(columns) != set(against_columns):
+            raise click.ClickException(
+                "{} has different columns on the two instances: {} and {}".format(
+                    path, ", ".join(columns), ", ".join(against_columns)
+                )
+            )
+        pks, against_pks = (
+            _table_primary_keys(side.client, side.db_url + "/" + tilde_encode(table))
+            for side in sides
+        )
+        if pks != against_pks:
+            raise click.ClickException(
+                "{} has different primary keys on the two instances: {} and {}".format(
+                    path, ", ".join(pks), ", ".join(against_pks)
+                )
+            )
+        hash_sql = [_remote_hash_function(side) for side in sides]
+        if None in hash_sql or hash_sql[0][0] != hash_sql[1][0]:
+            click.echo(
+                "The two instances can't hash rows the same way, so every row "
+                "will be compared",
+                err=True,
+            )
+            templates = None
+        else:
+            templates = [template for _, template in hash_sql]
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=concurrency))
+        differences = []
+        unchanged = 0
+        for found, same in _remote_diff(
+            sides,
+            table,
+            columns,
+            pks,
+            templates,
+            chunk_size,
+            range_size,
+            executor,
+            concurrency,
+        ):
+            differences.extend(
+                dict(status=status, **dict(zip(pks, key))) for status, key in found
+            )
+            unchanged += same
+
+    _output_rows(
+        differences,
+        _determine_output_format(fmt_csv, fmt_tsv, fmt_nl, fmt_table),
+        columns=["status"] + pks,
+    )
+    counts = collections.Counter(row["status"] for row in differences)
+    click.echo(
+        "{} changed, {} missing, {} extra, {} unchanged".format(
+            counts["changed"], counts["missing"], counts["extra"], unchanged
+        ),
+        err=True,
+    )
+    if differences:
+        raise click.exceptions.Exit(1)
+
+
+def _remote_diff(
+    sides, table, columns, pks, templates, chunk_size, range_size, executor, concurrency
+):
+    """
+    Compare a table on two servers by primary key.
+
+    Yields ([(status, key), ...], unchanged_count) for each range of keys
+    that has been compared, where status is "changed", "missing" (only on
+    the first server) or "extra" (only on the second).
+
+    templates are each server's hash function from _remote_hash_function().
+    The table is divided into ranges of range_size rows on the first server,
+    and each range is compared using a single aggregate query on each server.
+    Ranges that differ are split into DIFF_PARTS parts, until they have at
+    most chunk_size rows and are compared row by row. If the server stops a
+    query for taking too long the range is split up without it. Without
+    templates the whole table is compared row by row, chunk_size rows at a
+    time. Ranges are compared concurrency at a time using executor.
+    """
+    fingerprint = _fingerprint_sql(columns)
+    first, second = sides
+
+    def compare_rows(first_hashes, bounds, expression):
+        where, params = _pk_range_sql(pks, *bounds)
+        second_hashes = dict(second.keyed_rows(table, pks, expression, where, params))
+        found = [
+            ("changed" if key in second_hashes else "missing", key)
+            for key, h in first_hashes.items()
+            if second_hashes.get(key) != h
+        ]
+        found.extend(("extra", key) for key in second_hashes if key not in first_hashes)
+        same = sum(1 for key, h in first_hashes.items() if second_hashes.get(key) == h)
+        return found, same
+
+    if templates is None:
+        lower = None
+        rows = _batches(first.keyed_rows(table, pks, fingerprint, "1", {}), chunk_size)
+        batch = next(rows, None)
+        while True:
+            following = next(rows, None)
+            # The last chunk takes every remaining key on the second server
+            upper = batch[-1][0] if batch and following else None
+            yield compare_rows(dict(batch or []), (lower, upper), fingerprint)
+            if following is None:
+                return
+            lower, batch = upper, following
+
+    def split(side, bounds, size):
+        "Split a range using keys from side, without reading it all at once"
+        step = math.ceil(size / DIFF_PARTS)
+        points = list(
+            side.key_boundaries(table, pks, bounds, step, limit=DIFF_PARTS - 1)
+        )
+        lowers = [bounds[0]] + points
+        uppers = points + [bounds[1]]
+        return [(part, step) for part in zip(lowers, uppers)]
+
+    def compare_row_by_row(bounds):
+        where, params = _pk_range_sql(pks, *bounds)
+        first_hashes = dict(
+            first.keyed_rows(
+                table, pks, templates[0].format(fingerprint), where, params
+            )
+        )
+        return compare_rows(first_hashes, bounds, templates[1].format(fingerprint))
+
+    def compare(bounds, size):
+        """
+        Compare a range expected to have about size rows. Returns (result,
+        subranges) - one of them is None.
+        """
+        where, params = _pk_range_sql(pks, *bounds)
+        summaries = []
+        for side, template in zip(sides, templates):
+            try:
+                summaries.append(
+                    _remote_hash_summary(
+                        side, table, template.format(fingerprint), where, params
+                    )
+                )
+            except _QueryInterrupted:
+                if size <= chunk_size:
+                    # Reading rows a page at a time can't take too long
+                    return compare_row_by_row(bounds), None
+                return None, split(side, bounds, size)
+        counts = [summary[0] for summary in summaries]
+        if summaries[0] == summaries[1]:
+            return ([], counts[0]), None
+        if max(counts) <= chunk_size:
+            return compare_row_by_row(bounds), None
+        # Split the range into parts with the same number of rows on the
+        # server that has more of them - the server just counted them, so
+        # numbering them won't take too long
+        side = sides[counts.index(max(counts))]
+        keys = ", ".join(
+            "{} as p{}".format(_quote_identifier(pk), i) for i, pk in enumerate(pks)
+        )
+        step = math.ceil(max(counts) / DIFF_PARTS)
+        try:
+            rows, _ = side.query(
+                "select * from (select {}, row_number() over (order by {}) as n "
+                "from {} where {}) where n % {} = 0 order by n limit {}".format(
+                    keys,
+                    _column_list(pks),
+                    _quote_identifier(table),
+                    where,
+                    step,
+                    DIFF_PARTS - 1,
+                ),
+                params,
+            )
+        except _QueryInterrupted:
+            return None, split(side, bounds, max(counts))
+        points = [tuple(row["p{}".format(i)] for i in range(len(pks))) for row in rows]
+        lowers = [bounds[0]] + points
+        uppers = points + [bounds[1]]
+        return None, [(part, step) for part in zip(lowers, uppers)]
+
+    def starting_ranges():
+        # Found a query at a time while the first ranges are being compared
+        lower = None
+        for point in first.key_boundaries(table, pks, (None, None), range_size):
+            yield (lower, point), range_size
+            lower = point
+        # The last range takes every remaining key on the second server
+        yield (lower, None), range_size
+
+    ranges = starting_ranges()
+    while True:
+        following = []
+        for result, subranges in _ordered_map(
+            executor, compare, ranges, ahead=concurrency * 2
+        ):
+            if result is not None:
+                yield result
+            else:
+                following.extend(subranges)
+        if not following:
+            return
+        ranges = following
+
+
+@cli.command()
+@click.argument("source")
+@click.argument("destination")
+@click.option(
+    "-i",
+    "--instance",
+    default=None,
+    help="Datasette instance URL or alias to copy from",
+)
+@click.option(
+    "to_instance",
+    "--to",
+    help="Datasette instance URL or alias to copy to, if different",
+)
+@click.option("--token", help="API token for the source instance")
+@click.option("--to-token", help="API token for the destination instance")
+@click.option(
+    "--size",
+    type=click.IntRange(min=1),
+    help="Rows to read per page (default: the most the server allows)",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=100,
+    help="Send rows in batches of this size",
+)
+@click.option(
+    "--replace", is_flag=True, help="Replace rows with a matching primary key"
+)
+@click.option("--ignore", is_flag=True, help="Ignore rows with a matching primary key")
+@click.option("--silent", is_flag=True, help="Don't output progress")
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Verbose output: show HTTP request and response",
+)
+def copy(
+    source,
+    destination,
+    instance,
+    to_instance,
+    token,
+    to_token,
+    size,
+    batch_size,
+    replace,
+    ignore,
+    silent,
+    verbose,
+):
+    """
+    Copy a table from one Datasette instance to another
+
+    SOURCE and DESTINATION are database/table paths. Pages of rows are sent to
+    the destination while the next page is being read, so only a few pages
+    are held in memory. If the destination table does not exist it is created
+    with the column types and primary keys of the source table.
+
+    Example usage:
+
+    \b
+        dclient copy data/dogs backup/dogs -i src --to dst
+    """
+    source_db, source_table = _split_table_path(source)
+    dest_db, dest_table = _split_table_path(destination)
+    config_dir = get_config_dir()
+    source_url = _resolve_instance(instance, config_dir / "config.json")
+    dest_url = source_url
+    if to_instance:
+        dest_url = _resolve_instance(to_instance, config_dir / "config.json")
+    source_token = _resolve_token(
+        token, source_url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    dest_token = _resolve_token(
+        to_token, dest_url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    source_base = source_url.rstrip("/") + "/" + source_db
+    dest_base = dest_url.rstrip("/") + "/" + dest_db
+
+    with httpx.Client() as client:
+        schema = _remote_schema(source_base, source_table, source_token, client)
+        if schema is None:
+            raise click.ClickException("Table {} not found".format(source))
+        if _remote_schema(dest_base, dest_table, dest_token, client) is None:
+            _create_table_like(
+                dest_base, dest_table, schema, source_table, dest_token, verbose
+            )
+
+        def batches():
+            # Runs in a background thread, reading the next pages while
+            # earlier rows are being sent
+            pages = _table_pages(
+                source_url,
+                source_token,
+                "/{}/{}.json".format(source_db, tilde_encode(source_table)),
+                {"_shape": "objects", "_size": size or "max"},
+                client=client,
+            )
+            for page in pages:
+                page_rows = page.get("rows", [])
+                for start in range(0, len(page_rows), batch_size):
+                    yield page_rows[start : start + batch_size]
+
+        copied = 0
+        for batch in _pipelined(batches(), PIPELINE_QUEUE_SIZE):
+            _insert_batch(
+                url=dest_base,
+                table=dest_table,
+                batch=batch,
+                token=dest_token,
+                create=False,
+                alter=False,
+                pks=None,
+                replace=replace,
+                ignore=ignore,
+                verbose=verbose,
+                client=client,
+            )
+            copied += len(batch)
+    if not silent:
+        click.echo("Copied {} rows".format(copied), err=True)
+
+
+DUMP_CONCURRENCY = 4
+
+
+@cli.command()
+@click.argument("database")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("-i", "--instance", default=None, help="Datasette instance URL or alias")
+@click.option("--token", help="API token")
+@click.option(
+    "tables",
+    "--table",
+    multiple=True,
+    help="Only dump these tables",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=DUMP_CONCURRENCY,
+    help="Number of tables to read at once",
+)
+@click.option(
+    "--size",
+    type=click.IntRange(min=1),
+    help="Rows to read per page (default: the most the server allows)",
+)
+@click.option("--silent", is_flag=True, help="Don't output progress")
+def dump(database, directory, instance, token, tables, concurrency, size, silent):
     """
-    Insert data into a remote Datasette instance
+    Save every table in a database to a directory
+
+    Each table is written to a gzipped newline-delimited JSON file. The
+    directory also gets a schema.sql file with the database schema
+    and a manifest.json file listing the tables and their row counts, which
+    is written last. Use "dclient restore" to load the directory into a
+    database.
 
     Example usage:
 
     \b
-        dclient insert main mytable data.csv --csv -i myapp
-        dclient insert main mytable data.csv --csv --create --pk id
+        dclient dump data backup/ -i prod
     """
-    _do_insert(
-        database,
-        table,
-        filepath,
-        format_csv,
-        format_tsv,
-        format_json,
-        format_nl,
-        encoding,
-        no_detect_types,
-        replace,
-        ignore,
-        create,
-        alter,
-        pks,
-        batch_size,
-        interval,
-        token,
-        silent,
-        verbose,
-        instance,
-        endpoint="insert",
+    config_dir = get_config_dir()
+    url = _resolve_instance(instance, config_dir / "config.json")
+    token = _resolve_token(
+        token, url, config_dir / "auth.json", config_dir / "config.json"
     )
+    # Hidden tables belong to full-text search indexes and the like, which
+    # the create API can't make
+    names = [
+        table["name"]
+        for table in _database_tables(url, token, database)
+        if not table["hidden"]
+    ]
+    if tables:
+        missing = [table for table in tables if table not in names]
+        if missing:
+            raise click.ClickException("Table {} not found".format(", ".join(missing)))
+        names = [name for name in names if name in tables]
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    with httpx.Client() as client:
+        schema = _database_schema(url, token, database, client)
+
+        def dump_table(table):
+            path = directory / "{}.ndjson.gz".format(tilde_encode(table))
+            count = 0
+            with gzip.open(path, "wt", encoding="utf-8") as fp:
+                pages = _table_pages(
+                    url,
+                    token,
+                    "/{}/{}.json".format(database, tilde_encode(table)),
+                    {"_shape": "objects", "_size": size or "max"},
+                    client=client,
+                )
+                for page in pages:
+                    for row in page.get("rows", []):
+                        fp.write(json.dumps(row) + "\n")
+                        count += 1
+            if not silent:
+                click.echo("{}: {} rows".format(table, count), err=True)
+            return {"name": table, "file": path.name, "rows": count}
+
+        results = _each_table(dump_table, names, concurrency)
+    (directory / "schema.sql").write_text(schema + "\n")
+    manifest = {
+        "database": database,
+        "instance": url,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "tables": results,
+    }
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2) + "\n")
+    if not silent:
+        click.echo(
+            "Dumped {} rows from {} tables to {}".format(
+                sum(table["rows"] for table in results),
+                len(results),
+                directory,
+            ),
+            err=True,
+        )
 
 
 @cli.command()
-@_apply_options(_insert_options)
-def upsert(
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.argument("database")
+@click.option("-i", "--instance", default=None, help="Datasette instance URL or alias")
+@click.option("--token", help="API token")
+@click.option(
+    "tables",
+    "--table",
+    multiple=True,
+    help="Only restore these tables",
+)
+@click.option(
+    "--concurrency",
+    type=click.IntRange(min=1),
+    default=DUMP_CONCURRENCY,
+    help="Number of tables to load at once",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=100,
+    help="Send rows in batches of this size",
+)
+@click.option(
+    "--replace", is_flag=True, help="Replace rows with a matching primary key"
+)
+@click.option("--ignore", is_flag=True, help="Ignore rows with a matching primary key")
+@click.option("--silent", is_flag=True, help="Don't output progress")
+@click.option(
+    "-v",
+    "--verbose",
+    is_flag=True,
+    help="Verbose output: show HTTP request and response",
+)
+def restore(
+    directory,
     database,
-    table,
-    filepath,
     instance,
-    format_csv,
-    format_tsv,
-    format_json,
-    format_nl,
-    encoding,
-    no_detect_types,
-    alter,
-    pks,
-    batch_size,
-    interval,
     token,
+    tables,
+    concurrency,
+    batch_size,
+    replace,
+    ignore,
     silent,
     verbose,
 ):
     """
-    Upsert data into a remote Datasette instance
+    Load a directory written by "dclient dump" into a database
+
+    Tables that do not exist yet are created with the column types and
+    primary keys from schema.sql. Tables that already exist have the rows
+    added to them.
 
     Example usage:
 
     \b
-        dclient upsert main mytable data.csv --csv -i myapp
+        dclient restore backup/ data -i staging
     """
-    _do_insert(
-        database,
-        table,
-        filepath,
-        format_csv,
-        format_tsv,
-        format_json,
-        format_nl,
-        encoding,
-        no_detect_types,
-        False,
-        False,
-        False,
-        alter,
-        pks,
-        batch_size,
-        interval,
-        token,
-        silent,
-        verbose,
-        instance,
-        endpoint="upsert",
+    directory = pathlib.Path(directory)
+    try:
+        manifest = json.loads((directory / "manifest.json").read_text())
+    except FileNotFoundError:
+        raise click.ClickException(
+            "{} has no manifest.json - is it a complete dclient dump?".format(directory)
+        )
+    schema = (directory / "schema.sql").read_text()
+    entries = manifest["tables"]
+    if tables:
+        names = [entry["name"] for entry in entries]
+        missing = [table for table in tables if table not in names]
+        if missing:
+            raise click.ClickException(
+                "Table {} is not in {}".format(", ".join(missing), directory)
+            )
+        entries = [entry for entry in entries if entry["name"] in tables]
+    config_dir = get_config_dir()
+    url = _resolve_instance(instance, config_dir / "config.json")
+    token = _resolve_token(
+        token, url, config_dir / "auth.json", config_dir / "config.json"
+    )
+    base = url.rstrip("/") + "/" + database
+
+    with httpx.Client() as client:
+
+        def restore_table(entry):
+            table = entry["name"]
+            if not _table_exists(base, table, token, client):
+                _create_table_like(base, table, schema, table, token, verbose)
+            count = 0
+            with gzip.open(directory / entry["file"], "rt", encoding="utf-8") as fp:
+                rows = (json.loads(line) for line in fp)
+                for batch in _batches(rows, batch_size):
+                    _insert_batch(
+                        url=base,
+                        table=table,
+                        batch=batch,
+                        token=token,
+                        create=False,
+                        alter=False,
+                        pks=None,
+                        replace=replace,
+                        ignore=ignore,
+                        verbose=verbose,
+                        client=client,
+                    )
+                    count += len(batch)
+            if count != entry["rows"]:
+                raise click.ClickException(
+                    "{} has {} rows but the manifest lists {}".format(
+                        entry["file"], count, entry["rows"]
+                    )
+                )
+            if not silent:
+                click.echo("{}: {} rows".format(table, count), err=True)
+            return count
+
+        counts = _each_table(
+            restore_table, entries, concurrency, name=lambda entry: entry["name"]
+        )
+    if not silent:
+        click.echo(
+            "Restored {} rows into {} tables".format(sum(counts), len(counts)),
+            err=True,
+        )
+
+
+def _database_tables(url, token, database):
+    "The tables listed on a database's JSON page"
+    response = _make_request(url, token, "/{}.json".format(database))
+    if response.status_code != 200:
+        raise click.ClickException(
+            "Could not list tables in {}: {} error".format(
+                database, response.status_code
+            )
+        )
+    return response.json()["tables"]
+
+
+def _table_exists(url, table, token, client=None):
+    "Check a table exists using its JSON page, which knows about new tables"
+    response = (client or httpx).get(
+        "{}/{}.json".format(url, tilde_encode(table)),
+        headers={"Authorization": "Bearer {}".format(token)},
+        params={"_size": 0},
+        timeout=40.0,
+    )
+    if response.status_code == 404:
+        return False
+    if response.status_code != 200:
+        raise click.ClickException(
+            "Could not check for table {}: {} {}".format(
+                table, response.status_code, response.reason_phrase
+            )
+        )
+    return True
+
+
+def _database_schema(url, token, database, client=None):
+    "The CREATE statements for everything in a database"
+    response = (client or httpx).get(
+        "{}/{}/-/schema.json".format(url.rstrip("/"), database),
+        headers={"Authorization": "Bearer {}".format(token)},
+        timeout=40.0,
     )
+    if response.status_code != 200:
+        raise click.ClickException(
+            "Could not read schema for {}: {} {}".format(
+                database, response.status_code, response.reason_phrase
+            )
+        )
+    return response.json()["schema"]
+
+
+def _each_table(fn, tables, concurrency, name=str):
+    """
+    Call fn for each table on a pool of threads, returning the results in
+    the same order as tables.
+
+    Errors are prefixed with the table name, and stop any tables that have
+    not started yet.
+    """
+
+    def call(table):
+        try:
+            return fn(table)
+        except click.ClickException as ex:
+            ex.message = "{}: {}".format(name(table), ex.message)
+            raise
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(call, table) for table in tables]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return [future.result() for future in futures]
+
+
+# The create API's column type for each SQLite affinity. NUMERIC columns
+# store values the same way as INTEGER ones.
+_CREATE_TYPES = {
+    "integer": "integer",
+    "real": "float",
+    "text": "text",
+    "blob": "blob",
+    "numeric": "integer",
+}
+
+
+def _create_table_like(url, table, schema, schema_table, token, verbose=False):
+    """
+    Create a table with the column types and primary keys that schema_table
+    has in a CREATE TABLE statement
+    """
+    table_info = _schema_table_info(schema, schema_table)
+    columns = [
+        {"name": name, "type": _CREATE_TYPES[_affinity(declared)]}
+        for _, name, declared, *_ in table_info
+    ]
+    # pk is each column's position in the primary key, or 0
+    pks = [
+        column[1]
+        for column in sorted(table_info, key=lambda column: column[5])
+        if column[5]
+    ]
+    _create_table(url, table, columns, pks, token, verbose)
+
+
+def _split_table_path(path):
+    "Split database/table into its two parts"
+    database, _, table = path.partition("/")
+    if not database or not table:
+        raise click.ClickException(
+            "{} should be in the form database/table".format(path)
+        )
+    return database, table
 
 
 @cli.command(name="create-table")
@@ -949,6 +4909,14 @@ def create_table(database, table_name, column_defs, pks, instance, token, verbos
         raise click.ClickException("Provide at least one --column definition")
 
     columns = [{"name": name, "type": typ} for name, typ in column_defs]
+    response_data = _create_table(
+        url.rstrip("/") + "/" + database, table_name, columns, pks, token, verbose
+    )
+    click.echo(json.dumps(response_data, indent=2))
+
+
+def _create_table(url, table_name, columns, pks, token, verbose=False):
+    "Create an empty table using the create API, returning the response JSON"
     data = {"table": table_name, "columns": columns}
     if pks:
         if len(pks) == 1:
@@ -956,7 +4924,7 @@ def create_table(database, table_name, column_defs, pks, instance, token, verbos
         else:
             data["pks"] = list(pks)
 
-    api_url = url.rstrip("/") + "/" + database + "/-/create"
+    api_url = url + "/-/create"
     if verbose:
         click.echo("POST {}".format(api_url), err=True)
         click.echo(textwrap.indent(json.dumps(data, indent=2), "  "), err=True)
@@ -977,7 +4945,7 @@ def create_table(database, table_name, column_defs, pks, instance, token, verbos
             if "errors" in resp_data:
                 raise click.ClickException("\n".join(resp_data["errors"]))
         response.raise_for_status()
-    click.echo(json.dumps(response.json(), indent=2))
+    return response.json()
 
 
 @cli.command()
@@ -1719,6 +5687,315 @@ def _migrate_v1_to_v2(config_dir):
     aliases_file.rename(config_dir / "aliases.json.bak")
 
 
+# Leading bytes that identify compressed input files
+COMPRESSION_MAGIC = (
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+)
+
+
+def _open_input(filepath):
+    """
+    Open a file, or "-" for standard input, decompressing gzip, bzip2, xz
+    and zstd data as it is read.
+
+    Returns (fp, raw, compression) - raw is the underlying file, so
+    raw.tell() is the number of compressed bytes consumed so far, and
+    compression is None if the data was not compressed.
+    """
+    raw = sys.stdin.buffer if filepath == "-" else open(filepath, "rb")
+    if not hasattr(raw, "peek"):
+        raw = io.BufferedReader(raw)
+    compression = _compression(raw.peek(6)[:6])
+    if compression is None:
+        return raw, raw, None
+    return _decompress(raw, compression), raw, compression
+
+
+def _input_format(format_csv, format_tsv, format_json, format_nl):
+    "The Format chosen by the --csv, --tsv, --json and --nl options, if any"
+    if format_csv:
+        return Format.CSV
+    elif format_tsv:
+        return Format.TSV
+    elif format_json:
+        return Format.JSON
+    elif format_nl:
+        return Format.NL
+    return None
+
+
+def _is_ndjson_path(filepath):
+    "Auto-detection can't tell NDJSON from JSON, so go by the file extension"
+    path = pathlib.Path(filepath)
+    if path.suffix in (".gz", ".bz2", ".xz", ".zst"):
+        path = path.with_suffix("")
+    return path.suffix in (".ndjson", ".jsonl")
+
+
+def _compression(magic):
+    for prefix, compression in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            return compression
+    return None
+
+
+def _decompress(raw, compression):
+    if compression == "gzip":
+        fp = gzip.GzipFile(fileobj=raw)
+    elif compression == "bz2":
+        fp = bz2.BZ2File(raw)
+    elif compression == "xz":
+        fp = lzma.LZMAFile(raw)
+    else:
+        try:
+            # Python 3.14+
+            from compression import zstd
+
+            fp = zstd.ZstdFile(raw)
+        except ImportError:
+            try:
+                import zstandard
+            except ImportError:
+                raise click.ClickException(
+                    "Reading zstd compressed input requires the zstandard "
+                    "package: pip install zstandard"
+                )
+            fp = zstandard.ZstdDecompressor().stream_reader(raw)
+    # Adds peek() and line iteration, which not every decompressor provides
+    return io.BufferedReader(fp)
+
+
+# Size of the byte ranges handed to each --parse-workers process
+PARSE_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _csv_options(dialect):
+    # Sniffed dialects are classes defined on the fly, which can't be pickled
+    # and sent to a worker process - so pass the individual settings instead
+    return {
+        "delimiter": dialect.delimiter,
+        "quotechar": dialect.quotechar,
+        "doublequote": dialect.doublequote,
+        "escapechar": dialect.escapechar,
+        "skipinitialspace": dialect.skipinitialspace,
+        "quoting": dialect.quoting,
+    }
+
+
+def _chunk_offsets(filepath, start, chunk_size):
+    """Split a file into (start, end) byte ranges that end on a newline."""
+    with open(filepath, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            offsets = []
+            while start < size:
+                end = start + chunk_size
+                if end >= size:
+                    end = size
+                else:
+                    newline = mm.find(b"\n", end - 1)
+                    end = size if newline == -1 else newline + 1
+                offsets.append((start, end))
+                start = end
+            return offsets
+
+
+def _file_layout(filepath, format, encoding):
+    """
+    Detect the format, CSV dialect and header of a file.
+
+    Returns (format, csv_options, fieldnames, start) where start is the byte
+    offset of the first row after the header.
+    """
+    csv_options = None
+    # Re-open rather than seek(0), since not every decompressor can rewind
+    if format is None:
+        fp, raw, _ = _open_input(filepath)
+        with raw, fp:
+            try:
+                _, format = rows_from_file(fp, encoding=encoding)
+            except Exception as ex:
+                raise click.ClickException(str(ex))
+        if format in (Format.CSV, Format.TSV):
+            fp, raw, _ = _open_input(filepath)
+            with raw, fp:
+                sample = fp.read(2048).strip()
+            csv_options = _csv_options(
+                csv.Sniffer().sniff(sample.decode(encoding or "utf-8-sig", "ignore"))
+            )
+    if format not in (Format.CSV, Format.TSV):
+        return format, None, None, 0
+    if csv_options is None:
+        csv_options = _csv_options(csv.excel_tab if format == Format.TSV else csv.excel)
+    fp, raw, _ = _open_input(filepath)
+    with raw, fp:
+        header = fp.readline()
+    fieldnames = next(
+        csv.reader([header.decode(encoding or "utf-8-sig")], **csv_options), []
+    )
+    return format, csv_options, fieldnames, len(header)
+
+
+def _rows_with_offsets(fp, start, format, encoding, csv_options, fieldnames):
+    """
+    Yield (row, offset) pairs from a CSV, TSV or newline-delimited JSON file
+    positioned at byte offset start - offset is the position just after that row.
+    """
+    position = start
+
+    def lines():
+        nonlocal position
+        for line in fp:
+            position += len(line)
+            yield line.decode(encoding or "utf-8")
+
+    if format == Format.NL:
+        for line in lines():
+            if line.strip():
+                yield json.loads(line), position
+        return
+    # csv.reader only pulls as many lines as it needs for each record
+    for row in csv.DictReader(lines(), fieldnames=fieldnames, **csv_options):
+        if None in row:
+            extras = row.pop(None)
+            raise RowError(f"Row {row} contained these extra values: {extras}")
+        yield row, position
+
+
+def _parse_chunk(filepath, start, end, format, encoding, csv_options, fieldnames):
+    """Parse the rows in one byte range of a file - runs in a worker process."""
+    with open(filepath, "rb") as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    return list(
+        _rows_with_offsets(
+            io.BytesIO(data), start, format, encoding, csv_options, fieldnames
+        )
+    )
+
+
+def _ordered_map(executor, fn, iterable, ahead):
+    """
+    Like executor.map() but only keeps ``ahead`` calls in flight at once,
+    so a fast producer can't pile up results faster than they are consumed.
+    """
+    pending = collections.deque()
+    for args in iterable:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _rows_from_offset(
+    filepath, start, format, encoding, csv_options, fieldnames, workers=None
+):
+    """
+    Read rows from a file starting at byte offset start, optionally parsing
+    it in chunks using a pool of worker processes.
+
+    Returns (rows, position, progress) - position() returns the byte offset
+    just after the most recently returned row, progress() the number of bytes
+    of the file read so far. These differ for compressed files, where offsets
+    are in the decompressed data.
+    """
+    state = {"position": start, "raw": None}
+
+    def rows():
+        if not workers:
+            fp, state["raw"], _ = _open_input(filepath)
+            with state["raw"], fp:
+                fp.seek(start)
+                for row, offset in _rows_with_offsets(
+                    fp, start, format, encoding, csv_options, fieldnames
+                ):
+                    state["position"] = offset
+                    yield row
+            return
+        chunks = _chunk_offsets(filepath, start, PARSE_CHUNK_SIZE)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chunk in _ordered_map(
+                executor,
+                _parse_chunk,
+                (
+                    (
+                        filepath,
+                        chunk_start,
+                        end,
+                        format,
+                        encoding,
+                        csv_options,
+                        fieldnames,
+                    )
+                    for chunk_start, end in chunks
+                ),
+                ahead=workers * 2,
+            ):
+                for row, offset in chunk:
+                    state["position"] = offset
+                    yield row
+
+    def progress():
+        if state["raw"] is not None:
+            return state["raw"].tell()
+        return state["position"]
+
+    return rows(), lambda: state["position"], progress
+
+
+# Maximum number of parsed batches waiting to be uploaded
+PIPELINE_QUEUE_SIZE = 4
+
+
+def _pipelined(iterable, maxsize):
+    """
+    Consume an iterable in a background thread, yielding its items here.
+
+    At most ``maxsize`` items are buffered, so a fast producer blocks
+    until the consumer catches up. Exceptions raised by the producer are
+    re-raised in the consuming thread.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(("item", item)):
+                    return
+            put(("done", None))
+        except BaseException as ex:
+            put(("error", ex))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stopped.set()
+
+
 def _batches(iterable, size, interval=None):
     iterable = iter(iterable)
     last_yield_time = time.time()
@@ -1737,6 +6014,231 @@ def _batches(iterable, size, interval=None):
         last_yield_time = time.time()
 
 
+def _undeliverable(response):
+    "Did the server fail to handle a request, rather than refuse it?"
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def _rows_refused(response, single_row=False):
+    """
+    Did the server refuse a request because of the rows in it, rather than
+    because of the request as a whole? For a request about a single row, a
+    404 means there is no row with that primary key.
+    """
+    if response.status_code == 404:
+        return single_row
+    return 400 <= response.status_code < 500 and response.status_code not in (
+        401,
+        403,
+        429,
+    )
+
+
+def _response_errors(response):
+    "The errors in a JSON error response, or its status"
+    errors = None
+    if "/json" in response.headers.get("content-type", ""):
+        errors = response.json().get("errors")
+    return errors or ["{} {}".format(response.status_code, response.reason_phrase)]
+
+
+def _spool_batch(spool, table, url, body, batch, stats, verbose):
+    if verbose:
+        click.echo("Spooling {} rows for {}".format(len(batch), url), err=True)
+    spool.add(table, url, body, len(batch))
+    stats.spooled += len(batch)
+    return {"ok": True}
+
+
+class _Spool:
+    """
+    A SQLite database of requests that couldn't be delivered, to be sent
+    later by ``dclient spool flush``.
+
+    Each table's requests form a queue that is sent in order. API tokens are
+    never written to the spool - they are looked up again when it is flushed.
+    """
+
+    def __init__(self, directory, instance=None, database=None):
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        self.path = pathlib.Path(directory) / "spool.db"
+        self.instance = instance
+        self.database = database
+        self.lock = threading.Lock()
+        # Uploads may run in several threads
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("pragma busy_timeout = 30000")
+        self.conn.execute(
+            """
+            create table if not exists requests (
+                id integer primary key,
+                instance text,
+                database text,
+                table_name text,
+                url text,
+                body blob,
+                rows integer,
+                created text
+            )
+            """
+        )
+        self.held = set()
+        self.checked = set()
+
+    def holds(self, table):
+        "Are requests for this table waiting in the spool?"
+        with self.lock:
+            if table not in self.checked:
+                self.checked.add(table)
+                if self.conn.execute(
+                    "select 1 from requests where instance = ? and database = ? "
+                    "and table_name = ? limit 1",
+                    [self.instance, self.database, table],
+                ).fetchone():
+                    self.held.add(table)
+            return table in self.held
+
+    def add(self, table, url, body, rows):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "insert into requests "
+                "(instance, database, table_name, url, body, rows, created) "
+                "values (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    self.instance,
+                    self.database,
+                    table,
+                    url,
+                    body,
+                    rows,
+                    datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                ],
+            )
+            self.held.add(table)
+
+    def queues(self):
+        "(instance, database, table) for each table with waiting requests"
+        with self.lock:
+            return self.conn.execute(
+                "select instance, database, table_name from requests "
+                "group by instance, database, table_name order by min(id)"
+            ).fetchall()
+
+    def next(self, queue):
+        "The oldest waiting request for a queue, as (id, url, body, rows)"
+        with self.lock:
+            return self.conn.execute(
+                "select id, url, body, rows from requests where instance = ? "
+                "and database = ? and table_name = ? order by id limit 1",
+                queue,
+            ).fetchone()
+
+    def remove(self, id):
+        with self.lock, self.conn:
+            self.conn.execute("delete from requests where id = ?", [id])
+
+    def waiting(self, queue):
+        "Number of (requests, rows) waiting in a queue"
+        with self.lock:
+            return self.conn.execute(
+                "select count(*), coalesce(sum(rows), 0) from requests "
+                "where instance = ? and database = ? and table_name = ?",
+                queue,
+            ).fetchone()
+
+
+class _RejectedBatch(click.ClickException):
+    "The server refused a batch because of the rows in it"
+
+    def __init__(self, errors):
+        super().__init__("\n".join(errors))
+        self.errors = errors
+
+
+def _send_bisecting(send, batch):
+    """
+    Call send(batch), splitting the batch in half each time the server
+    rejects it until the rows it won't accept are isolated.
+
+    Returns a list of (row, errors) for the rows that could not be sent.
+    """
+    try:
+        send(batch)
+        return []
+    except _RejectedBatch as ex:
+        if len(batch) == 1:
+            return [(batch[0], ex.errors)]
+    middle = len(batch) // 2
+    return _send_bisecting(send, batch[:middle]) + _send_bisecting(send, batch[middle:])
+
+
+# How often an idle _stream_batches() checks whether it has been stopped
+STREAM_POLL_INTERVAL = 0.2
+
+
+def _stream_batches(iterable, size, max_latency, stopped=None):
+    """
+    Like _batches() but for unbounded input such as ``tail -f``.
+
+    Rows are read in a background thread. A batch is yielded once it is full,
+    or once its oldest row has waited max_latency seconds - even if no more
+    input arrives. If the stopped event is set, the rows that have already
+    been read are yielded and iteration ends.
+    """
+    buffer = []
+    # When the first row of each batch in the buffer arrived. A batch is
+    # either size rows or the whole buffer, so those rows are every size-th
+    started = collections.deque()
+    state = {"done": False, "error": None}
+    ready = threading.Condition()
+
+    def read():
+        try:
+            for row in iterable:
+                with ready:
+                    # Don't read too far ahead of the uploads
+                    while len(buffer) >= size * PIPELINE_QUEUE_SIZE:
+                        ready.wait()
+                    buffer.append(row)
+                    if (len(buffer) - 1) % size == 0:
+                        # One clock reading per batch, not per row
+                        started.append(time.monotonic())
+                    if len(buffer) in (1, size):
+                        ready.notify_all()
+        except BaseException as ex:
+            state["error"] = ex
+        with ready:
+            state["done"] = True
+            ready.notify_all()
+
+    def finishing():
+        return state["done"] or (stopped is not None and stopped.is_set())
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        with ready:
+            while not buffer and not finishing():
+                ready.wait(STREAM_POLL_INTERVAL)
+            while len(buffer) < size and not finishing():
+                remaining = started[0] + max_latency - time.monotonic()
+                if remaining <= 0:
+                    break
+                ready.wait(min(remaining, STREAM_POLL_INTERVAL))
+            batch = buffer[:size]
+            del buffer[:size]
+            if batch:
+                # Rows left behind wait from when the first of them arrived
+                started.popleft()
+            ready.notify_all()
+            finished = finishing() and not buffer
+        if state["error"] is not None:
+            raise state["error"]
+        if batch:
+            yield batch
+        if finished:
+            return
+
+
 def _insert_batch(
     *,
     url,
@@ -1750,6 +6252,10 @@ def _insert_batch(
     ignore,
     verbose,
     endpoint="insert",
+    stats=None,
+    dry_run=False,
+    client=None,
+    spool=None,
 ):
     if create:
         data = {
@@ -1778,28 +6284,54 @@ def _insert_batch(
             data["ignore"] = True
         if alter:
             data["alter"] = True
-        url = "{}/{}/-/{}".format(url, table, endpoint)
+        url = "{}/{}/-/{}".format(url, tilde_encode(table), endpoint)
     if verbose:
         click.echo("POST {}".format(url), err=True)
         click.echo(textwrap.indent(json.dumps(data, indent=2), "  "), err=True)
-    response = httpx.post(
-        url,
-        headers={
-            "Authorization": "Bearer {}".format(token),
-            "Content-Type": "application/json",
-        },
-        json=data,
-        timeout=40.0,
-    )
+    stats = stats or _InsertStats()
+    with stats.timer("serialize"):
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    if dry_run:
+        stats.record_batch(len(batch), len(body))
+        return {"ok": True}
+    if spool is not None and spool.holds(table):
+        # Earlier batches for this table are waiting in the spool, and this
+        # one has to be sent after them
+        return _spool_batch(spool, table, url, body, batch, stats, verbose)
+    start = time.monotonic()
+    try:
+        with stats.timer("request"):
+            response = (client or httpx).post(
+                url,
+                headers={
+                    "Authorization": "Bearer {}".format(token),
+                    "Content-Type": "application/json",
+                },
+                content=body,
+                timeout=40.0,
+            )
+    except httpx.TransportError:
+        if spool is None:
+            raise
+        return _spool_batch(spool, table, url, body, batch, stats, verbose)
+    latency = time.monotonic() - start
     if verbose:
         click.echo(str(response), err=True)
+    if spool is not None and _undeliverable(response):
+        return _spool_batch(spool, table, url, body, batch, stats, verbose)
     if str(response.status_code)[0] != "2":
+        if _rows_refused(response):
+            # Something about the rows themselves
+            raise _RejectedBatch(_response_errors(response))
         # Is there an error we can show?
-        if "/json" in response.headers["content-type"]:
-            data = response.json()
-            if "errors" in data:
-                raise click.ClickException("\n".join(data["errors"]))
+        if "/json" in response.headers.get("content-type", ""):
+            errors = response.json().get("errors")
+            if errors:
+                raise click.ClickException("\n".join(errors))
         response.raise_for_status()
+    # Only count rows the server accepted - a batch that is split up and sent
+    # again by --rejects is counted once, by the parts that succeed
+    stats.record_batch(len(batch), len(body), latency)
     response_data = response.json()
     if verbose:
         click.echo(textwrap.indent(json.dumps(response_data, indent=2), "  "), err=True)
@@ -1,3 +1,4 @@
+import math
 from urllib.parse import urlparse
 
 
@@ -40,3 +41,25 @@ def token_for_url(url: str, tokens: dict) -> str:
     if matches:
         return matches[0][1]
     return None
+
+
+def percentile(values, pct):
+    "Nearest-rank percentile of a list of numbers, or None if it is empty"
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+_TILDE_ENCODING_SAFE = frozenset(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
+)
+
+
+def tilde_encode(s: str) -> str:
+    "Encode a value for a Datasette URL path, the way Datasette does for row keys"
+    return "".join(
+        chr(b) if b in _TILDE_ENCODING_SAFE else "+" if b == 32 else "~{:02X}".format(b)
+        for b in s.encode("utf-8")
+    )
@@ -0,0 +1,102 @@
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from datasette import hookimpl
+from datasette.app import Datasette
+from datasette.plugins import pm
+
+
+@pytest.fixture
+def non_mocked_hosts():
+    # This ensures httpx-mock will not affect Datasette's own
+    # httpx calls made in the tests by datasette.client:
+    return ["localhost"]
+
+
+def _run_async(coroutine):
+    # dclient makes sync requests from its own threads, so each call gets a
+    # fresh event loop
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
+@pytest.fixture
+def run_async():
+    "Run a coroutine against an in-memory Datasette from synchronous test code"
+    return _run_async
+
+
+@pytest.fixture
+def serve(httpx_mock):
+    """
+    Answer the requests dclient makes with httpx by passing them on to
+    Datasette instances.
+
+    Call serve(ds) to answer every request from one instance, or pass a
+    function that picks the instance for each request. rewrite(request,
+    content) can change a request body before the server sees it, and
+    observe(request, response) is called with each response - if it returns
+    a response that is sent instead.
+    """
+
+    def serve(datasette, rewrite=None, observe=None):
+        # The in-memory databases can't handle writes from several event
+        # loops at once, so the fake server handles one request at a time
+        lock = threading.Lock()
+
+        def custom_response(request: httpx.Request):
+            ds = datasette if isinstance(datasette, Datasette) else datasette(request)
+            content = request.read()
+            headers = dict(request.headers)
+            if rewrite is not None:
+                content = rewrite(request, content)
+                headers.pop("content-length", None)
+
+            async def respond():
+                response = await ds.client.request(
+                    request.method,
+                    request.url.raw_path.decode(),
+                    content=content,
+                    headers=headers,
+                )
+                return httpx.Response(
+                    status_code=response.status_code,
+                    headers=response.headers,
+                    content=response.content,
+                )
+
+            with lock:
+                response = _run_async(respond())
+            if observe is not None:
+                response = observe(request, response) or response
+            return response
+
+        httpx_mock.add_callback(custom_response, is_reusable=True)
+
+    return serve
+
+
+class HashPlugin:
+    __name__ = "HashPlugin"
+
+    @hookimpl
+    def prepare_connection(self, conn):
+        conn.create_function(
+            "sha1",
+            1,
+            lambda value: (
+                None if value is None else hashlib.sha1(value.encode()).digest()
+            ),
+        )
+
+
+@pytest.fixture
+def sha1_function():
+    "Give Datasette's connections a sha1() SQL function, as plugins can"
+    pm.register(HashPlugin(), name="test-hash-plugin")
+    yield
+    pm.unregister(name="test-hash-plugin")
@@ -0,0 +1,160 @@
+"""Tests for the copy command."""
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from dclient.cli import cli
+import pytest
+
+
+@pytest.fixture
+def instances(serve, run_async):
+    permissions = {
+        "permissions": {
+            "create-table": {"id": "*"},
+            "insert-row": {"id": "*"},
+            "update-row": {"id": "*"},
+        }
+    }
+    source = Datasette(config=permissions)
+    source_db = source.add_memory_database("copy_source")
+    dest = Datasette(config=permissions)
+    dest_db = dest.add_memory_database("copy_dest")
+
+    async def setup():
+        for db in (source_db, dest_db):
+            for table in await db.table_names():
+                await db.execute_write("drop table [{}]".format(table))
+        await source_db.execute_write(
+            "create table dogs (id integer primary key, name text, "
+            "weight real, photo blob, born date)"
+        )
+        await source_db.execute_write_many(
+            "insert into dogs values (?, ?, ?, ?, ?)",
+            [
+                (i, "dog {}".format(i), i / 4, bytes([i % 256]), "2020-01-01")
+                for i in range(1, 251)
+            ],
+        )
+        await source_db.execute_write(
+            "create table pairs (a text, b integer, value text, primary key (b, a))"
+        )
+        await source_db.execute_write(
+            "insert into pairs values ('x', 1, 'one'), ('y', 2, 'two')"
+        )
+        await source_db.execute_write("create table notes (note text)")
+        await source_db.execute_write(
+            "insert into notes values ('first'), ('second'), ('third')"
+        )
+        await source_db.execute_write("delete from notes where note = 'second'")
+        await source_db.execute_write(
+            "create table [odd/name.v~1] (id integer primary key, name text)"
+        )
+        await source_db.execute_write(
+            "insert into [odd/name.v~1] values (1, 'one'), (2, 'two')"
+        )
+        return await source.create_token("actor"), await dest.create_token("actor")
+
+    source_token, dest_token = run_async(setup())
+    serve(lambda request: source if request.url.host == "source.example.com" else dest)
+
+    def query(db, sql):
+        async def fetch():
+            return [tuple(row) for row in (await db.execute(sql)).rows]
+
+        return run_async(fetch())
+
+    return source_token, dest_token, source_db, dest_db, query
+
+
+def copy(source_token, dest_token, source, destination, *args):
+    return CliRunner().invoke(
+        cli,
+        ["copy", source, destination, "-i", "https://source.example.com"]
+        + ["--to", "https://dest.example.com"]
+        + ["--token", source_token, "--to-token", dest_token]
+        + list(args),
+        catch_exceptions=False,
+    )
+
+
+@pytest.mark.parametrize(
+    "table,order_by",
+    (("dogs", "id"), ("pairs", "a, b"), ("notes", "rowid"), ("odd/name.v~1", "id")),
+)
+def test_copy_creates_table_and_copies_rows(instances, table, order_by):
+    source_token, dest_token, source_db, dest_db, query = instances
+    result = copy(
+        source_token,
+        dest_token,
+        "copy_source/{}".format(table),
+        "copy_dest/{}".format(table),
+        "--size",
+        "100",
+        "--batch-size",
+        "30",
+    )
+    assert result.exit_code == 0, result.output
+    sql = "select rowid, * from [{}] order by {}".format(table, order_by)
+    source_rows = query(source_db, sql)
+    assert query(dest_db, sql) == source_rows
+    assert "Copied {} rows".format(len(source_rows)) in result.output
+    # Primary keys and column types come from the source schema
+    info = "select name, type, pk from pragma_table_info('{}')".format(table)
+    dest_info = query(dest_db, info)
+    assert [(name, pk) for name, _, pk in dest_info] == [
+        (name, pk) for name, _, pk in query(source_db, info)
+    ]
+    if table == "dogs":
+        assert [type for _, type, _ in dest_info] == [
+            "INTEGER",
+            "TEXT",
+            "REAL",
+            "BLOB",
+            "INTEGER",
+        ]
+
+
+def test_copy_into_existing_table(instances, run_async):
+    source_token, dest_token, _, dest_db, query = instances
+    run_async(
+        dest_db.execute_write(
+            "create table renamed (a text, b integer, value text, primary key (b, a))"
+        )
+    )
+    run_async(dest_db.execute_write("insert into renamed values ('x', 1, 'old')"))
+    result = copy(source_token, dest_token, "copy_source/pairs", "copy_dest/renamed")
+    assert result.exit_code == 1
+    assert "UNIQUE constraint failed" in result.output
+    result = copy(
+        source_token,
+        dest_token,
+        "copy_source/pairs",
+        "copy_dest/renamed",
+        "--replace",
+    )
+    assert result.exit_code == 0, result.output
+    assert query(dest_db, "select * from renamed order by b") == [
+        ("x", 1, "one"),
+        ("y", 2, "two"),
+    ]
+
+
+def test_copy_missing_table(instances):
+    source_token, dest_token, *_ = instances
+    result = copy(source_token, dest_token, "copy_source/missing", "copy_dest/dogs")
+    assert result.exit_code == 1
+    assert "Table copy_source/missing not found" in result.output
+
+
+def test_copy_requires_database_and_table():
+    result = CliRunner().invoke(
+        cli, ["copy", "copy_source", "copy_dest/dogs", "-i", "https://x.com"]
+    )
+    assert result.exit_code == 1
+    assert "copy_source should be in the form database/table" in result.output
+
+
+def test_copy_batch_size_must_be_positive():
+    result = copy("x", "y", "a/dogs", "b/dogs", "--batch-size", "0")
+    assert result.exit_code == 2
+    assert "Invalid value for '--batch-size'" in result.output
@@ -0,0 +1,172 @@
+"""Tests for the delete and update commands."""
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from dclient.cli import cli
+import json
+import pathlib
+import pytest
+
+
+@pytest.fixture
+def datasette(serve, run_async):
+    ds = Datasette(
+        config={
+            "permissions": {
+                "delete-row": {"id": "*"},
+                "update-row": {"id": "*"},
+                "alter-table": {"id": "*"},
+            }
+        }
+    )
+    db = ds.add_memory_database("delete_update")
+
+    async def setup():
+        for table in await db.table_names():
+            await db.execute_write("drop table [{}]".format(table))
+        await db.execute_write(
+            "create table dogs (id integer primary key, name text, age integer)"
+        )
+        await db.execute_write(
+            "create table pairs (a text, b text, value text, primary key (a, b))"
+        )
+        await db.execute_write(
+            "insert into dogs (id, name, age) values "
+            "(1, 'Cleo', 5), (2, 'Pancakes', 4), (3, 'Fido', 3), (4, 'Rex', 2)"
+        )
+        await db.execute_write(
+            "insert into pairs (a, b, value) values "
+            "('x', 'one/two', 'first'), ('y', 'three four', 'second')"
+        )
+        await db.execute_write(
+            "create table [odd/name.v~1] (id integer primary key, name text)"
+        )
+        await db.execute_write(
+            "insert into [odd/name.v~1] values (1, 'one'), (2, 'two')"
+        )
+        return await ds.create_token("actor")
+
+    serve(ds)
+    token = run_async(setup())
+
+    def table_rows(table):
+        async def fetch():
+            response = await ds.client.get(
+                "/delete_update/{}.json?_shape=array".format(table)
+            )
+            return response.json()
+
+        return run_async(fetch())
+
+    return token, table_rows
+
+
+def run(args, token):
+    return CliRunner().invoke(
+        cli,
+        args + ["--token", token, "-i", "http://datasette.example.com", "--silent"],
+    )
+
+
+def test_delete(datasette, tmpdir):
+    token, table_rows = datasette
+    path = pathlib.Path(tmpdir) / "ids.csv"
+    path.write_text("id\n1\n3\n")
+    result = run(
+        ["delete", "delete_update", "dogs", "--pks-from", str(path)]
+        + ["--concurrency", "2"],
+        token,
+    )
+    assert result.exit_code == 0, result.output
+    assert [row["id"] for row in table_rows("dogs")] == [2, 4]
+
+
+def test_delete_compound_pks_are_tilde_encoded(datasette, tmpdir):
+    token, table_rows = datasette
+    path = pathlib.Path(tmpdir) / "keys.ndjson"
+    path.write_text('{"a": "x", "b": "one/two"}\n{"a": "y", "b": "three four"}\n')
+    result = run(["delete", "delete_update", "pairs", "--pks-from", str(path)], token)
+    assert result.exit_code == 0, result.output
+    assert table_rows("pairs") == []
+
+
+def test_update(datasette, tmpdir):
+    token, table_rows = datasette
+    path = pathlib.Path(tmpdir) / "changes.ndjson"
+    path.write_text('{"id": 2, "age": 10}\n{"id": 4, "name": "Max", "color": "red"}\n')
+    result = run(["update", "delete_update", "dogs", str(path), "--alter"], token)
+    assert result.exit_code == 0, result.output
+    assert table_rows("dogs") == [
+        {"id": 1, "name": "Cleo", "age": 5, "color": None},
+        {"id": 2, "name": "Pancakes", "age": 10, "color": None},
+        {"id": 3, "name": "Fido", "age": 3, "color": None},
+        {"id": 4, "name": "Max", "age": 2, "color": "red"},
+    ]
+
+
+def test_update_rejects(datasette, tmpdir):
+    token, table_rows = datasette
+    path = pathlib.Path(tmpdir) / "changes.ndjson"
+    path.write_text('{"id": 1, "age": 6}\n{"id": 99, "age": 1}\n{"age": 2}\n')
+    rejects = pathlib.Path(tmpdir) / "rejects.ndjson"
+    result = run(
+        ["update", "delete_update", "dogs", str(path), "--rejects", str(rejects)],
+        token,
+    )
+    assert result.exit_code == 0, result.output
+    assert "2 rejected rows were written to" in result.output
+    rejected = [json.loads(line) for line in rejects.read_text().splitlines()]
+    assert [item["row"] for item in rejected] == [{"id": 99, "age": 1}, {"age": 2}]
+    assert rejected[1]["errors"] == ["Row is missing primary key column: id"]
+    assert table_rows("dogs")[0]["age"] == 6
+
+
+def test_delete_without_rejects_stops_on_error(datasette, tmpdir):
+    token, table_rows = datasette
+    path = pathlib.Path(tmpdir) / "ids.csv"
+    path.write_text("id\n99\n")
+    result = run(["delete", "delete_update", "dogs", "--pks-from", str(path)], token)
+    assert result.exit_code == 1
+    assert len(table_rows("dogs")) == 4
+
+
+def test_delete_concurrency(httpx_mock, tmpdir):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "ids.csv"
+    path.write_text("id\n" + "".join("{}\n".format(i) for i in range(50)))
+    result = CliRunner().invoke(
+        cli,
+        [
+            "delete",
+            "data",
+            "t",
+            "--pks-from",
+            str(path),
+            "--pk",
+            "id",
+            "--concurrency",
+            "5",
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Deleted 50 rows" in result.output
+    paths = sorted(request.url.path for request in httpx_mock.get_requests())
+    assert paths == sorted("/data/t/{}/-/delete".format(i) for i in range(50))
+
+
+def test_table_names_are_tilde_encoded(datasette, tmpdir):
+    token, table_rows = datasette
+    path = pathlib.Path(tmpdir) / "changes.csv"
+    path.write_text("id,name\n1,uno\n")
+    result = run(["update", "delete_update", "odd/name.v~1", str(path)], token)
+    assert result.exit_code == 0, result.output
+    path.write_text("id\n2\n")
+    result = run(
+        ["delete", "delete_update", "odd/name.v~1", "--pks-from", str(path)], token
+    )
+    assert result.exit_code == 0, result.output
+    assert table_rows("odd~2Fname~2Ev~7E1") == [{"id": 1, "name": "uno"}]
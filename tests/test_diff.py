@@ -0,0 +1,181 @@
+"""Tests for the diff command."""
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from dclient.cli import cli
+import httpx
+import json
+import pathlib
+import pytest
+import sqlite3
+
+
+@pytest.fixture(params=[False, True], ids=["no-hash", "sha1"])
+def can_hash(request):
+    if request.param:
+        request.getfixturevalue("sha1_function")
+    return request.param
+
+
+@pytest.fixture
+def databases(tmpdir):
+    conns = []
+    for name in ("first", "second"):
+        path = pathlib.Path(tmpdir) / name / "data.db"
+        path.parent.mkdir()
+        conn = sqlite3.connect(str(path), isolation_level=None)
+        conn.executescript(
+            """
+            create table dogs (id integer primary key, name text, weight real);
+            create table pairs (a text, b integer, value text, primary key (a, b));
+            insert into pairs values ('x', 1, 'one'), ('x', 2, 'two'), ('y/z', 1, 'three');
+            """
+        )
+        with conn:
+            conn.execute("begin")
+            conn.executemany(
+                "insert into dogs values (?, ?, ?)",
+                [(i, "dog {}".format(i), i / 3) for i in range(1, 2001)],
+            )
+        conns.append(conn)
+    return conns
+
+
+def serve_both(serve, databases, observe=None):
+    servers = [
+        Datasette([conn.execute("pragma database_list").fetchone()[2]])
+        for conn in databases
+    ]
+    serve(
+        lambda request: (
+            servers[0] if request.url.host == "first.example.com" else servers[1]
+        ),
+        observe=observe,
+    )
+
+
+@pytest.fixture
+def instances(serve, databases, can_hash):
+    # Rows returned by each query, to check how much data was moved
+    returned = []
+
+    def observe(request, response):
+        if request.url.params.get("sql") and response.status_code == 200:
+            returned.append(len(response.json().get("rows", [])))
+
+    serve_both(serve, databases, observe)
+    return databases[1], returned, can_hash
+
+
+def diff(path, *args):
+    return CliRunner().invoke(
+        cli,
+        ["diff", path, "-i", "https://first.example.com"]
+        + ["--against", "https://second.example.com"]
+        + list(args),
+    )
+
+
+def test_diff_identical_tables(instances):
+    result = diff("data/dogs")
+    assert result.exit_code == 0, result.output
+    assert "0 changed, 0 missing, 0 extra, 2000 unchanged" in result.output
+
+
+def test_diff_reports_changed_keys(instances):
+    second, returned, can_hash = instances
+    second.execute("update dogs set name = 'Cleo' where id = 3")
+    second.execute("update dogs set weight = 1.5 where id = 1500")
+    second.execute("delete from dogs where id = 700")
+    second.execute("insert into dogs values (2500, 'new', null)")
+    returned.clear()
+    result = diff("data/dogs", "--chunk-size", "50", "--nl")
+    assert result.exit_code == 1, result.output
+    lines = result.output.splitlines()
+    assert sorted(
+        (json.loads(line) for line in lines if line.startswith("{")),
+        key=lambda row: row["id"],
+    ) == [
+        {"status": "changed", "id": 3},
+        {"status": "missing", "id": 700},
+        {"status": "changed", "id": 1500},
+        {"status": "extra", "id": 2500},
+    ]
+    assert "2 changed, 1 missing, 1 extra, 1997 unchanged" in result.output
+    if can_hash:
+        # Only a few small ranges were compared row by row
+        assert sum(returned) < 600
+        assert "every row will be compared" not in result.output
+    else:
+        assert "every row will be compared" in result.output
+
+
+def test_diff_compound_primary_keys(instances):
+    second, _, _ = instances
+    second.execute("update pairs set value = 'changed' where a = 'y/z'")
+    result = diff("data/pairs", "--csv")
+    assert result.exit_code == 1
+    assert "status,a,b\nchanged,y/z,1\n" in result.output
+
+
+def test_diff_different_columns(instances):
+    second, _, _ = instances
+    second.execute("alter table dogs add column age integer")
+    result = diff("data/dogs")
+    assert result.exit_code == 1
+    assert (
+        "data/dogs has different columns on the two instances: "
+        "id, name, weight and id, name, weight, age"
+    ) in result.output
+
+
+def test_diff_splits_ranges_the_server_interrupts(serve, databases, sha1_function):
+    # Like a server whose sql_time_limit_ms only allows counting 300 rows
+    interrupted = []
+
+    def observe(request, response):
+        sql = request.url.params.get("sql", "")
+        if (
+            "count(*)" in sql
+            and response.status_code == 200
+            and response.json()["rows"][0]["c"] > 300
+        ):
+            interrupted.append(sql)
+            return httpx.Response(
+                400,
+                json={
+                    "ok": False,
+                    "title": "SQL Interrupted",
+                    "error": "SQL query took too long. The time limit is "
+                    "controlled by the sql_time_limit_ms setting.",
+                },
+            )
+
+    serve_both(serve, databases, observe)
+    second = databases[1]
+    second.execute("update dogs set name = 'Cleo' where id = 3")
+    second.execute("delete from dogs where id = 1700")
+    result = diff("data/dogs", "--range-size", "5000", "--chunk-size", "50", "--nl")
+    assert result.exit_code == 1, result.output
+    assert sorted(
+        (json.loads(line) for line in result.output.splitlines() if line[:1] == "{"),
+        key=lambda row: row["id"],
+    ) == [{"status": "changed", "id": 3}, {"status": "missing", "id": 1700}]
+    assert "1 changed, 1 missing, 0 extra, 1998 unchanged" in result.output
+    assert interrupted
+
+
+def test_diff_starts_from_bounded_ranges(serve, databases, sha1_function):
+    counted = []
+
+    def observe(request, response):
+        sql = request.url.params.get("sql", "")
+        if "count(*)" in sql and response.status_code == 200:
+            counted.append(response.json()["rows"][0]["c"])
+
+    serve_both(serve, databases, observe)
+    result = diff("data/dogs", "--range-size", "300")
+    assert result.exit_code == 0, result.output
+    assert "0 changed, 0 missing, 0 extra, 2000 unchanged" in result.output
+    # No aggregate query had to count more than one range of rows
+    assert max(counted) == 300
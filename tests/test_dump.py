@@ -0,0 +1,168 @@
+"""Tests for the dump and restore commands."""
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from dclient.cli import cli
+import gzip
+import json
+import pathlib
+import pytest
+
+
+@pytest.fixture
+def instances(serve, run_async):
+    permissions = {
+        "permissions": {
+            "create-table": {"id": "*"},
+            "insert-row": {"id": "*"},
+            "update-row": {"id": "*"},
+        }
+    }
+    source = Datasette(config=permissions)
+    source_db = source.add_memory_database("dump_source")
+    dest = Datasette(config=permissions)
+    dest_db = dest.add_memory_database("dump_dest")
+
+    async def setup():
+        for db in (source_db, dest_db):
+            for table in await db.table_names():
+                await db.execute_write("drop table [{}]".format(table))
+        await source_db.execute_write(
+            "create table dogs (id integer primary key, name text, "
+            "weight real, photo blob)"
+        )
+        await source_db.execute_write_many(
+            "insert into dogs values (?, ?, ?, ?)",
+            [(i, "dog {}".format(i), i / 4, bytes([i % 256])) for i in range(1, 251)],
+        )
+        await source_db.execute_write(
+            "create table [odd/name] (a text, b integer, primary key (b, a))"
+        )
+        await source_db.execute_write(
+            "insert into [odd/name] values ('x', 1), ('y', 2)"
+        )
+        await source_db.execute_write("create table notes (note text)")
+        await source_db.execute_write(
+            "insert into notes values ('first'), ('second'), ('third')"
+        )
+        await source_db.execute_write("delete from notes where note = 'second'")
+        await source_db.execute_write("create table empty (id integer primary key)")
+        return await source.create_token("actor"), await dest.create_token("actor")
+
+    source_token, dest_token = run_async(setup())
+    serve(lambda request: source if request.url.host == "source.example.com" else dest)
+
+    def query(db, sql):
+        async def fetch():
+            return [tuple(row) for row in (await db.execute(sql)).rows]
+
+        return run_async(fetch())
+
+    return source_token, dest_token, source_db, dest_db, query
+
+
+def dump(token, directory, *args):
+    return CliRunner().invoke(
+        cli,
+        ["dump", "dump_source", str(directory), "-i", "https://source.example.com"]
+        + ["--token", token]
+        + list(args),
+        catch_exceptions=False,
+    )
+
+
+def restore(token, directory, *args):
+    return CliRunner().invoke(
+        cli,
+        ["restore", str(directory), "dump_dest", "-i", "https://dest.example.com"]
+        + ["--token", token]
+        + list(args),
+        catch_exceptions=False,
+    )
+
+
+def test_dump_and_restore_round_trip(instances, tmpdir):
+    source_token, dest_token, source_db, dest_db, query = instances
+    directory = pathlib.Path(tmpdir) / "backup"
+    result = dump(source_token, directory, "--size", "100", "--concurrency", "2")
+    assert result.exit_code == 0, result.output
+    assert "dogs: 250 rows" in result.output
+    assert "Dumped 254 rows from 4 tables to {}".format(directory) in result.output
+    manifest = json.loads((directory / "manifest.json").read_text())
+    assert manifest["database"] == "dump_source"
+    assert manifest["tables"] == [
+        {"name": "dogs", "file": "dogs.ndjson.gz", "rows": 250},
+        {"name": "empty", "file": "empty.ndjson.gz", "rows": 0},
+        {"name": "notes", "file": "notes.ndjson.gz", "rows": 2},
+        {"name": "odd/name", "file": "odd~2Fname.ndjson.gz", "rows": 2},
+    ]
+    schema = (directory / "schema.sql").read_text()
+    assert schema.startswith("CREATE TABLE dogs (")
+    with gzip.open(directory / "notes.ndjson.gz", "rt") as fp:
+        assert [json.loads(line) for line in fp] == [
+            {"rowid": 1, "note": "first"},
+            {"rowid": 3, "note": "third"},
+        ]
+
+    result = restore(dest_token, directory, "--batch-size", "30")
+    assert result.exit_code == 0, result.output
+    assert "Restored 254 rows into 4 tables" in result.output
+    for table, order_by in (
+        ("dogs", "id"),
+        ("[odd/name]", "a, b"),
+        ("notes", "rowid"),
+        ("empty", "id"),
+    ):
+        sql = "select rowid, * from {} order by {}".format(table, order_by)
+        assert query(dest_db, sql) == query(source_db, sql)
+        info = "select name, pk from pragma_table_info('{}')".format(table.strip("[]"))
+        assert query(dest_db, info) == query(source_db, info)
+
+    # Restoring again clashes with the rows that are already there
+    result = restore(dest_token, directory, "--table", "notes")
+    assert result.exit_code == 1
+    assert "notes: UNIQUE constraint failed" in result.output
+    result = restore(dest_token, directory, "--table", "notes", "--replace")
+    assert result.exit_code == 0, result.output
+    assert "Restored 2 rows into 1 tables" in result.output
+
+
+def test_dump_selected_tables(instances, tmpdir):
+    source_token, *_ = instances
+    directory = pathlib.Path(tmpdir) / "backup"
+    result = dump(source_token, directory, "--table", "notes", "--silent")
+    assert result.exit_code == 0, result.output
+    assert result.output == ""
+    assert sorted(path.name for path in directory.iterdir()) == [
+        "manifest.json",
+        "notes.ndjson.gz",
+        "schema.sql",
+    ]
+    result = dump(source_token, directory, "--table", "missing")
+    assert result.exit_code == 1
+    assert "Table missing not found" in result.output
+
+
+def test_restore_checks_row_counts(instances, tmpdir):
+    source_token, dest_token, *_ = instances
+    directory = pathlib.Path(tmpdir) / "backup"
+    assert dump(source_token, directory, "--table", "notes").exit_code == 0
+    with gzip.open(directory / "notes.ndjson.gz", "wt") as fp:
+        fp.write(json.dumps({"rowid": 1, "note": "first"}) + "\n")
+    result = restore(dest_token, directory)
+    assert result.exit_code == 1
+    assert "notes: notes.ndjson.gz has 1 rows but the manifest lists 2" in result.output
+
+
+def test_restore_requires_manifest(tmpdir):
+    result = CliRunner().invoke(
+        cli, ["restore", str(tmpdir), "data", "-i", "https://x.com"]
+    )
+    assert result.exit_code == 1
+    assert "has no manifest.json - is it a complete dclient dump?" in result.output
+
+
+def test_restore_batch_size_must_be_positive(tmpdir):
+    result = restore("x", tmpdir, "--batch-size", "0")
+    assert result.exit_code == 2
+    assert "Invalid value for '--batch-size'" in result.output
@@ -0,0 +1,171 @@
+"""Tests for the enrich command."""
+
+import json
+import pathlib
+
+import pytest
+from click.testing import CliRunner
+from datasette.app import Datasette
+
+from dclient.cli import cli
+
+
+@pytest.fixture
+def requested(serve, run_async):
+    ds = Datasette()
+    db = ds.add_memory_database("enrich_test")
+
+    async def setup():
+        for table in await db.table_names():
+            await db.execute_write("drop table [{}]".format(table))
+        await db.execute_write(
+            "create table dogs (id integer primary key, name text, breed text)"
+        )
+        await db.execute_write_many(
+            "insert into dogs values (?, ?, ?)",
+            [(i, "dog {}".format(i), "breed {}".format(i % 3)) for i in range(1, 101)],
+        )
+        await db.execute_write("create table toys (dog text, toy text)")
+        await db.execute_write(
+            "insert into toys values ('dog 1', 'ball'), ('dog 1', 'rope'), "
+            "('a,b', 'sock')"
+        )
+
+    run_async(setup())
+    # The key lookups made by each request
+    requested = []
+
+    def observe(request, response):
+        for name, value in request.url.params.items():
+            if name.endswith("__in"):
+                requested.append(value)
+
+    serve(ds, observe=observe)
+    return requested
+
+
+def enrich(path, *args):
+    return CliRunner().invoke(
+        cli,
+        ["enrich", str(path), "-i", "https://datasette.example.com"] + list(args),
+        catch_exceptions=False,
+    )
+
+
+def test_enrich_csv(requested, tmpdir):
+    path = pathlib.Path(tmpdir) / "orders.csv"
+    path.write_text("order,dog_id\n1,3\n2,5\n3,\n4,3\n5,500\n")
+    result = enrich(path, "--on", "dog_id", "--from", "enrich_test/dogs", "--csv")
+    assert result.exit_code == 0, result.output
+    assert result.stdout == (
+        "order,dog_id,dogs_name,dogs_breed\n"
+        "1,3,dog 3,breed 0\n"
+        "2,5,dog 5,breed 2\n"
+        "3,,None,None\n"
+        "4,3,dog 3,breed 0\n"
+        "5,500,None,None\n"
+    )
+    assert "2 of 5 rows had no match in enrich_test/dogs" in result.stderr
+    # Each distinct key was looked up once, and the empty one not at all
+    assert requested == ["3,5,500"]
+
+
+def test_enrich_batches_and_cache(requested, tmpdir):
+    path = pathlib.Path(tmpdir) / "visits.ndjson"
+    ids = [1, 2, 3, 1, 2, 4, 5, 1, 6, 2]
+    path.write_text("".join(json.dumps({"dog": id}) + "\n" for id in ids))
+    result = enrich(
+        path,
+        "--on",
+        "dog",
+        "--from",
+        "enrich_test/dogs",
+        "--prefix",
+        "",
+        "--batch-size",
+        "3",
+        "--cache-size",
+        "2",
+        "--nl",
+        "-v",
+    )
+    assert result.exit_code == 0, result.output
+    rows = [json.loads(line) for line in result.stdout.splitlines()]
+    assert rows == [
+        {"dog": id, "name": "dog {}".format(id), "breed": "breed {}".format(id % 3)}
+        for id in ids
+    ]
+    # Only the two most recently used keys are remembered between batches
+    assert requested == ["1,2,3", "1,4", "5,6", "2"]
+    assert "Looked up 8 keys, 2 more were cached" in result.stderr
+
+
+def test_enrich_several_matches(requested, tmpdir):
+    path = pathlib.Path(tmpdir) / "dogs.json"
+    path.write_text(json.dumps([{"name": "dog 1"}, {"name": "a,b"}, {"name": "x"}]))
+    result = enrich(path, "--on", "name", "--from", "enrich_test/toys", "--key", "dog")
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.stdout) == [
+        {"name": "dog 1", "toys_rowid": 1, "toys_toy": "ball"},
+        {"name": "dog 1", "toys_rowid": 2, "toys_toy": "rope"},
+        {"name": "a,b", "toys_rowid": 3, "toys_toy": "sock"},
+        {"name": "x", "toys_rowid": None, "toys_toy": None},
+    ]
+
+
+def test_enrich_chunks_long_key_lists(requested, tmpdir):
+    path = pathlib.Path(tmpdir) / "ids.csv"
+    path.write_text("id\n" + "".join("{}\n".format(i) for i in range(1, 101)))
+    result = enrich(
+        path, "--on", "id", "--from", "enrich_test/dogs", "--max-url-length", "200"
+    )
+    assert result.exit_code == 0, result.output
+    assert [row["dogs_name"] for row in json.loads(result.stdout)] == [
+        "dog {}".format(i) for i in range(1, 101)
+    ]
+    assert len(requested) > 1
+    # The chunks are looked up at the same time, so can finish in any order
+    assert sorted(int(key) for keys in requested for key in keys.split(",")) == list(
+        range(1, 101)
+    )
+
+
+@pytest.mark.parametrize("fmt", ("--csv", "--tsv"))
+def test_enrich_json_rows_with_different_keys(requested, tmpdir, fmt):
+    path = pathlib.Path(tmpdir) / "rows.ndjson"
+    path.write_text('{"k": 1}\n{"k": 2, "extra": "important"}\n')
+    result = enrich(path, "--on", "k", "--from", "enrich_test/dogs", fmt)
+    assert result.exit_code == 0, result.output
+    # The header covers the columns of every row
+    assert result.stdout.splitlines() == [
+        line.replace(",", "\t" if fmt == "--tsv" else ",")
+        for line in (
+            "k,dogs_name,dogs_breed,extra",
+            "1,dog 1,breed 1,",
+            "2,dog 2,breed 2,important",
+        )
+    ]
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (["--from", "enrich_test/cats"], "Table enrich_test/cats not found"),
+        (
+            ["--from", "enrich_test/dogs", "--key", "nope"],
+            "Table enrich_test/dogs has no column nope",
+        ),
+        (
+            ["--from", "enrich_test/dogs", "--on", "nope"],
+            'Row has no nope column: {"id": "1"}',
+        ),
+    ),
+)
+def test_enrich_errors(requested, tmpdir, args, error):
+    path = pathlib.Path(tmpdir) / "ids.csv"
+    path.write_text("id\n1\n")
+    if "--on" not in args:
+        args = args + ["--on", "id"]
+    result = enrich(path, *args)
+    assert result.exit_code == 1
+    assert error in result.output
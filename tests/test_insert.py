@@ -1,13 +1,31 @@
 import asyncio
 from collections import namedtuple
 from concurrent.futures import ThreadPoolExecutor
+import bz2
+import collections
 from click.testing import CliRunner
 from datasette.app import Datasette
-from dclient.cli import cli
+from dclient.cli import (
+    cli,
+    _affinity,
+    _coerce_batch,
+    _RowDeduper,
+    _open_input,
+    _pipelined,
+    _stop_on_signals,
+    _stream_batches,
+)
+import gzip
 import httpx
 import json
+import lzma
+import os
 import pathlib
 import pytest
+import signal
+import sqlite3
+import threading
+import time
 
 
 @pytest.fixture
@@ -332,3 +350,1310 @@ async def test_insert_against_datasette(
     if expected_table_json:
         response = await ds.client.get("/data/table1.json?_shape=array")
         assert response.json() == expected_table_json
+
+
+# The first batch has its types detected, later batches are sent as strings
+DETECTED_IDS = list(range(1, 51)) + [str(i) for i in range(51, 201)]
+
+
+@pytest.mark.parametrize(
+    "content,extra_args,expected_ids",
+    (
+        (
+            "id,name\n" + "".join(f"{i},name {i}\n" for i in range(1, 201)),
+            ["--csv"],
+            DETECTED_IDS,
+        ),
+        (
+            "id\tname\n" + "".join(f"{i}\tname {i}\n" for i in range(1, 201)),
+            [],
+            DETECTED_IDS,
+        ),
+        (
+            "".join(
+                json.dumps({"id": i, "name": f"name {i}"}) + "\n" for i in range(1, 201)
+            ),
+            ["--nl"],
+            list(range(1, 201)),
+        ),
+    ),
+)
+def test_insert_parse_workers(
+    httpx_mock, tmpdir, mocker, content, extra_args, expected_ids
+):
+    # Small chunks so the file is split across several worker processes
+    mocker.patch("dclient.cli.PARSE_CHUNK_SIZE", 100)
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.txt"
+    path.write_text(content)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "table1",
+            str(path),
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+            "--parse-workers",
+            "3",
+            "--batch-size",
+            "50",
+            "--silent",
+        ]
+        + extra_args,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    rows = []
+    for request in httpx_mock.get_requests():
+        rows.extend(json.loads(request.read())["rows"])
+    assert [row["id"] for row in rows] == expected_ids
+    assert rows[-1]["name"] == "name 200"
+
+
+def test_insert_parse_workers_rejects_json(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.json"
+    path.write_text(SIMPLE_JSON)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "table1",
+            str(path),
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+            "--parse-workers",
+            "2",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "only works with CSV, TSV or newline-delimited JSON" in result.output
+
+
+def test_pipelined_applies_backpressure():
+    produced = []
+
+    def producer():
+        for i in range(20):
+            produced.append(i)
+            yield i
+
+    consumed = []
+    for item in _pipelined(producer(), 2):
+        consumed.append(item)
+        if item == 0:
+            time.sleep(0.2)
+            # Queue holds 2, one more is blocked waiting to be queued
+            assert len(produced) <= 4
+    assert consumed == list(range(20))
+
+
+def test_pipelined_reraises_producer_errors():
+    def producer():
+        yield 1
+        raise ValueError("bad row")
+
+    items = []
+    with pytest.raises(ValueError, match="bad row"):
+        for item in _pipelined(producer(), 2):
+            items.append(item)
+    assert items == [1]
+
+
+@pytest.mark.parametrize(
+    "content,format_arg",
+    (
+        ("id,name\n" + "".join(f"{i},name {i}\n" for i in range(1, 11)), "--csv"),
+        (
+            "".join(json.dumps({"id": i}) + "\n" for i in range(1, 11)),
+            "--nl",
+        ),
+    ),
+)
+def test_insert_checkpoint_and_resume(httpx_mock, tmpdir, content, format_arg):
+    path = pathlib.Path(tmpdir) / "data.txt"
+    path.write_text(content)
+    checkpoint = pathlib.Path(tmpdir) / "checkpoint.json"
+    args = [
+        "insert",
+        "data",
+        "table1",
+        str(path),
+        format_arg,
+        "--token",
+        "x",
+        "-i",
+        "https://datasette.example.com",
+        "--batch-size",
+        "3",
+        "--no-detect-types",
+        "--checkpoint",
+        str(checkpoint),
+    ]
+    # Two batches succeed, then the server fails
+    httpx_mock.add_response(json={"ok": True})
+    httpx_mock.add_response(json={"ok": True})
+    httpx_mock.add_response(
+        status_code=500, json={"ok": False, "errors": ["Server error"]}
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    assert "Server error" in result.output
+    saved = json.loads(checkpoint.read_text())
+    assert saved["rows"] == 6
+    assert saved["file"] == str(path.resolve())
+    # The offset is the exact end of the sixth row
+    lines = content.splitlines(True)
+    header_lines = 1 if format_arg == "--csv" else 0
+    assert saved["offset"] == len("".join(lines[: header_lines + 6]))
+
+    httpx_mock.reset()
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    result = runner.invoke(cli, args + ["--resume"])
+    assert result.exit_code == 0, result.output
+    sent = [
+        row["id"]
+        for request in httpx_mock.get_requests()
+        for row in json.loads(request.read())["rows"]
+    ]
+    assert [str(id) for id in sent] == ["7", "8", "9", "10"]
+    assert json.loads(checkpoint.read_text())["rows"] == 10
+
+
+def test_insert_resume_requires_checkpoint(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.csv"
+    path.write_text(SIMPLE_CSV)
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "table1", str(path), "-i", "https://x.com", "--resume"],
+    )
+    assert result.exit_code == 1
+    assert "--resume requires --checkpoint" in result.output
+
+
+def test_stop_on_signals():
+    with _stop_on_signals(signal.SIGINT) as stopped:
+        assert not stopped.is_set()
+        os.kill(os.getpid(), signal.SIGINT)
+        assert stopped.is_set()
+    assert signal.getsignal(signal.SIGINT) is signal.default_int_handler
+
+
+def test_upsert_skip_unchanged(httpx_mock, tmpdir, mocker):
+    mocker.patch("dclient.cli.get_config_dir", return_value=pathlib.Path(tmpdir))
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.csv"
+    args = [
+        "upsert",
+        "data",
+        "table1",
+        str(path),
+        "--csv",
+        "--pk",
+        "id",
+        "--skip-unchanged",
+        "--token",
+        "x",
+        "-i",
+        "https://datasette.example.com",
+    ]
+
+    def sent_rows():
+        rows = [
+            row
+            for request in httpx_mock.get_requests()
+            for row in json.loads(request.read())["rows"]
+        ]
+        httpx_mock.reset()
+        httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+        return rows
+
+    runner = CliRunner()
+    path.write_text("id,name\n1,Cleo\n2,Pancakes\n3,Fido\n")
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert [row["id"] for row in sent_rows()] == [1, 2, 3]
+    assert "Skipped 0 unchanged rows" in result.output
+
+    # Nothing has changed, so nothing is sent
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert sent_rows() == []
+    assert "Skipped 3 unchanged rows" in result.output
+
+    # Only the changed and new rows are sent
+    path.write_text("id,name\n1,Cleo\n2,Pancakes the Second\n3,Fido\n4,Azi\n")
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert sent_rows() == [
+        {"id": 2, "name": "Pancakes the Second"},
+        {"id": 4, "name": "Azi"},
+    ]
+
+    # A different table has its own cache
+    result = runner.invoke(cli, [arg if arg != "table1" else "table2" for arg in args])
+    assert len(sent_rows()) == 4
+
+
+def test_skip_unchanged_requires_pk(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.csv"
+    path.write_text(SIMPLE_CSV)
+    result = CliRunner().invoke(
+        cli,
+        ["upsert", "data", "t", str(path), "-i", "https://x.com", "--skip-unchanged"],
+    )
+    assert result.exit_code == 1
+    assert "--skip-unchanged requires --pk" in result.output
+
+
+@pytest.mark.parametrize(
+    "source_args",
+    (
+        ["--from-table", "dogs"],
+        ["--from-sql", "select * from dogs order by id"],
+    ),
+)
+def test_insert_from_sqlite(httpx_mock, tmpdir, source_args):
+    db_path = str(pathlib.Path(tmpdir) / "local.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table dogs (id integer primary key, name text, weight real)")
+    conn.executemany(
+        "insert into dogs values (?, ?, ?)",
+        [(1, "Cleo", 12.5), (2, "Pancakes", None), (3, "Fido", 30.0)],
+    )
+    conn.commit()
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "dogs",
+            "--from-sqlite",
+            db_path,
+            "--batch-size",
+            "2",
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+        ]
+        + source_args,
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    requests = httpx_mock.get_requests()
+    assert [json.loads(request.read())["rows"] for request in requests] == [
+        [
+            {"id": 1, "name": "Cleo", "weight": 12.5},
+            {"id": 2, "name": "Pancakes", "weight": None},
+        ],
+        [{"id": 3, "name": "Fido", "weight": 30.0}],
+    ]
+
+
+def test_insert_from_sqlite_encodes_blobs(httpx_mock, tmpdir):
+    db_path = str(pathlib.Path(tmpdir) / "local.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table photos (id integer primary key, data blob)")
+    conn.execute("insert into photos values (1, ?)", (b"\x00\xff",))
+    conn.commit()
+    httpx_mock.add_response(json={"ok": True})
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "photos",
+            "--from-sqlite",
+            db_path,
+            "--from-table",
+            "photos",
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert json.loads(httpx_mock.get_request().read())["rows"] == [
+        {"id": 1, "data": {"$base64": True, "encoded": "AP8="}}
+    ]
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        ([], "Provide a FILEPATH, or use --from-sqlite"),
+        (["--from-sqlite", "local.db"], "requires either --from-table or --from-sql"),
+        (["--from-table", "dogs"], "can only be used with --from-sqlite"),
+    ),
+)
+def test_insert_from_sqlite_errors(args, error):
+    result = CliRunner().invoke(
+        cli, ["insert", "data", "dogs", "-i", "https://x.com"] + args
+    )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+def test_insert_stats_and_dry_run(httpx_mock, tmpdir):
+    path = pathlib.Path(tmpdir) / "data.csv"
+    path.write_text("id,name\n1,Cleo\n2,Pancakes\n3,Fido\n")
+    stats_path = pathlib.Path(tmpdir) / "stats.json"
+    args = [
+        "insert",
+        "data",
+        "dogs",
+        str(path),
+        "--csv",
+        "--token",
+        "x",
+        "-i",
+        "https://datasette.example.com",
+        "--batch-size",
+        "2",
+        "--stats",
+        "--stats-json",
+        str(stats_path),
+    ]
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert "Rows: 3 in" in result.output
+    assert "Batch latency: p50" in result.output
+    report = json.loads(stats_path.read_text())
+    assert report["rows"] == 3
+    assert report["batches"] == 2
+    assert set(report["stages"]) == {"parse", "convert", "serialize", "request"}
+    assert report["bytes"] == sum(
+        len(request.read()) for request in httpx_mock.get_requests()
+    )
+
+    # --dry-run does everything except send the rows
+    httpx_mock.reset()
+    result = CliRunner().invoke(cli, args + ["--dry-run"])
+    assert result.exit_code == 0, result.output
+    assert httpx_mock.get_requests() == []
+    assert "Dry run: 3 rows were not sent" in result.output
+    report = json.loads(stats_path.read_text())
+    assert report["rows"] == 3
+    assert "request" not in report["stages"]
+
+
+COMPRESSED_CSV = "id,name\n" + "".join(f"{i},name {i}\n" for i in range(1, 11))
+
+
+@pytest.mark.parametrize(
+    "compress,suffix",
+    ((gzip.compress, ".gz"), (bz2.compress, ".bz2"), (lzma.compress, ".xz")),
+)
+@pytest.mark.parametrize(
+    "name,content",
+    (
+        ("data.csv", COMPRESSED_CSV),
+        ("data.ndjson", "".join(json.dumps({"id": i}) + "\n" for i in range(1, 11))),
+    ),
+)
+def test_insert_compressed(httpx_mock, tmpdir, compress, suffix, name, content):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / (name + suffix)
+    path.write_bytes(compress(content.encode("utf-8")))
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "table1",
+            str(path),
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+            "--batch-size",
+            "4",
+            "--create",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    rows = [
+        row
+        for request in httpx_mock.get_requests()
+        for row in json.loads(request.read())["rows"]
+    ]
+    assert len(rows) == 10
+    assert [str(row["id"]) for row in rows] == [str(i) for i in range(1, 11)]
+
+
+def test_insert_compressed_stdin(httpx_mock):
+    httpx_mock.add_response(json={"ok": True})
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "table1",
+            "-",
+            "--csv",
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+        ],
+        input=gzip.compress(COMPRESSED_CSV.encode("utf-8")),
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    rows = json.loads(httpx_mock.get_request().read())["rows"]
+    assert [row["name"] for row in rows][-1] == "name 10"
+
+
+def test_open_input_tracks_compressed_bytes(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.csv.gz"
+    content = "".join(f"{i},{os.urandom(8).hex()}\n" for i in range(10000))
+    path.write_bytes(gzip.compress(content.encode("utf-8")))
+    fp, raw, compression = _open_input(str(path))
+    with raw, fp:
+        assert compression == "gzip"
+        assert fp.read() == content.encode("utf-8")
+        # Progress is measured against the size of the file on disk
+        assert raw.tell() == path.stat().st_size
+
+
+def test_insert_compressed_checkpoint_and_resume(httpx_mock, tmpdir):
+    path = pathlib.Path(tmpdir) / "data.csv.gz"
+    path.write_bytes(gzip.compress(COMPRESSED_CSV.encode("utf-8")))
+    checkpoint = pathlib.Path(tmpdir) / "checkpoint.json"
+    args = [
+        "insert",
+        "data",
+        "table1",
+        str(path),
+        "--token",
+        "x",
+        "-i",
+        "https://datasette.example.com",
+        "--batch-size",
+        "3",
+        "--no-detect-types",
+        "--checkpoint",
+        str(checkpoint),
+    ]
+    httpx_mock.add_response(json={"ok": True})
+    httpx_mock.add_response(
+        status_code=500, json={"ok": False, "errors": ["Server error"]}
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 1
+    # Offsets are recorded in the decompressed data
+    lines = COMPRESSED_CSV.splitlines(True)
+    assert json.loads(checkpoint.read_text())["offset"] == len("".join(lines[:4]))
+
+    httpx_mock.reset()
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    result = runner.invoke(cli, args + ["--resume"])
+    assert result.exit_code == 0, result.output
+    sent = [
+        row["id"]
+        for request in httpx_mock.get_requests()
+        for row in json.loads(request.read())["rows"]
+    ]
+    assert sent == [str(i) for i in range(4, 11)]
+
+
+def test_insert_compressed_rejects_parse_workers(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.csv.gz"
+    path.write_bytes(gzip.compress(COMPRESSED_CSV.encode("utf-8")))
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "t",
+            str(path),
+            "-i",
+            "https://x.com",
+            "--parse-workers",
+            "2",
+        ],
+    )
+    assert result.exit_code == 1
+    assert "--parse-workers cannot be used with compressed input" in result.output
+
+
+def test_stream_batches_flushes_partial_batch_when_input_is_idle():
+    more = threading.Event()
+
+    def rows():
+        yield from range(3)
+        # Like tail -f with nothing new to read
+        more.wait()
+        yield from range(3, 5)
+
+    batches = _stream_batches(rows(), 10, 0.1)
+    start = time.monotonic()
+    assert next(batches) == [0, 1, 2]
+    assert time.monotonic() - start < 5
+    more.set()
+    assert list(batches) == [[3, 4]]
+
+
+def test_stream_batches_leftover_rows_wait_from_their_arrival():
+    def rows():
+        yield 0
+        time.sleep(0.6)
+        yield from range(1, 4)
+        time.sleep(0.6)
+        yield from range(4, 6)
+
+    # Row 3 arrives with the rows that fill the first batch, so it has only
+    # waited 0.6 seconds when rows 4 and 5 fill the second one
+    assert list(_stream_batches(rows(), 3, 1)) == [[0, 1, 2], [3, 4, 5]]
+
+
+def test_stream_batches_full_batches_and_stop():
+    stopped = threading.Event()
+    blocked = threading.Event()
+
+    def rows():
+        yield from range(7)
+        blocked.wait()
+
+    batches = _stream_batches(rows(), 3, 60, stopped)
+    assert next(batches) == [0, 1, 2]
+    assert next(batches) == [3, 4, 5]
+    # Stopping sends the rest straight away, without waiting for max_latency
+    stopped.set()
+    assert list(batches) == [[6]]
+    blocked.set()
+
+
+def test_insert_stream(httpx_mock):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    read_fd, write_fd = os.pipe()
+
+    def producer():
+        with os.fdopen(write_fd, "wb", buffering=0) as writer:
+            writer.write(b'{"id": 1}\n{"id": 2}\n')
+            # The partial batch is sent without waiting for more input
+            deadline = time.monotonic() + 5
+            while not httpx_mock.get_requests() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            writer.write(b'{"id": 3}\n')
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    with os.fdopen(read_fd, "rb") as reader:
+        result = CliRunner().invoke(
+            cli,
+            [
+                "insert",
+                "data",
+                "logs",
+                "-",
+                "--nl",
+                "--token",
+                "x",
+                "-i",
+                "https://datasette.example.com",
+                "--stream",
+                "--max-latency",
+                "0.05",
+            ],
+            input=reader,
+            catch_exceptions=False,
+        )
+    thread.join()
+    assert result.exit_code == 0, result.output
+    assert [
+        [row["id"] for row in json.loads(request.read())["rows"]]
+        for request in httpx_mock.get_requests()
+    ] == [[1, 2], [3]]
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (["--max-latency", "1"], "--max-latency requires --stream"),
+        (["--stream", "--json"], "--stream requires CSV, TSV or newline-delimited"),
+    ),
+)
+def test_insert_stream_errors(args, error):
+    result = CliRunner().invoke(
+        cli, ["insert", "data", "t", "-", "--nl", "-i", "https://x.com"] + args
+    )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+def test_insert_create_first_batch_only_and_alter_new_columns(httpx_mock, tmpdir):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    rows = [{"id": i} for i in range(1, 5)] + [{"id": 5, "extra": "x"}, {"id": 6}]
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "table1",
+            str(path),
+            "--nl",
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+            "--batch-size",
+            "2",
+            "--create",
+            "--pk",
+            "id",
+            "--alter",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    requests = httpx_mock.get_requests()
+    assert [request.url.path for request in requests] == [
+        "/data/-/create",
+        "/data/table1/-/insert",
+        "/data/table1/-/insert",
+    ]
+    bodies = [json.loads(request.read()) for request in requests]
+    assert bodies[0]["pk"] == "id"
+    assert "pk" not in bodies[1] and "table" not in bodies[1]
+    # alter is only sent with batches that have new columns
+    assert [body.get("alter", False) for body in bodies] == [True, False, True]
+
+
+def test_insert_rejects_bisects_failing_batches(httpx_mock, tmpdir):
+    sent = []
+
+    def callback(request):
+        rows = json.loads(request.read())["rows"]
+        bad = [row["id"] for row in rows if row.get("bad")]
+        if bad:
+            return httpx.Response(
+                400, json={"ok": False, "errors": ["Bad rows: {}".format(bad)]}
+            )
+        sent.extend(row["id"] for row in rows)
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.add_callback(callback, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text(
+        "".join(json.dumps({"id": i, "bad": i in (3, 12)}) + "\n" for i in range(1, 17))
+    )
+    rejects = pathlib.Path(tmpdir) / "rejects.ndjson"
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "table1",
+            str(path),
+            "--nl",
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+            "--batch-size",
+            "8",
+            "--rejects",
+            str(rejects),
+            "--stats",
+        ],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "2 rejected rows were written to" in result.output
+    # Rows are counted once, when the server accepts them
+    assert "Rows: 14 in" in result.output
+    assert sorted(sent) == [i for i in range(1, 17) if i not in (3, 12)]
+    assert [json.loads(line) for line in rejects.read_text().splitlines()] == [
+        {"row": {"id": 3, "bad": True}, "errors": ["Bad rows: [3]"]},
+        {"row": {"id": 12, "bad": True}, "errors": ["Bad rows: [12]"]},
+    ]
+    # Each batch of 8 with one bad row takes 1 + 2 + 2 + 2 requests
+    assert len(httpx_mock.get_requests()) == 14
+
+
+def test_insert_without_rejects_stops_on_error(httpx_mock, tmpdir):
+    httpx_mock.add_response(
+        status_code=400, json={"ok": False, "errors": ["Bad row"]}, is_reusable=True
+    )
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text('{"id": 1}\n{"id": 2}\n')
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(path), "--nl", "--token", "x"]
+        + ["-i", "https://datasette.example.com"],
+    )
+    assert result.exit_code == 1
+    assert "Error: Bad row" in result.output
+    assert len(httpx_mock.get_requests()) == 1
+
+
+@pytest.mark.parametrize(
+    "declared,expected",
+    (
+        ("INTEGER", "integer"),
+        ("bigint", "integer"),
+        ("VARCHAR(20)", "text"),
+        ("TEXT", "text"),
+        ("BLOB", "blob"),
+        ("", "blob"),
+        (None, "blob"),
+        ("DOUBLE PRECISION", "real"),
+        ("FLOAT", "real"),
+        ("DECIMAL(10,5)", "numeric"),
+        # INT wins over everything else, as in SQLite
+        ("FLOATING POINT", "integer"),
+    ),
+)
+def test_affinity(declared, expected):
+    assert _affinity(declared) == expected
+
+
+def test_coerce_batch():
+    column_types = {"id": "integer", "score": "real", "name": "text", "n": "numeric"}
+    rows, invalid = _coerce_batch(
+        [
+            {"id": "1", "score": "2.5", "name": 12, "n": "3", "other": "x"},
+            {"id": 2.0, "score": "", "name": "Cleo", "n": "three"},
+            {"id": 3, "score": 1, "name": {"a": [1]}, "n": None},
+            {"id": "1.5", "score": "nan", "name": ["list"], "n": None},
+        ],
+        column_types,
+    )
+    assert rows == [
+        {"id": 1, "score": 2.5, "name": "12", "n": 3, "other": "x"},
+        {"id": 2, "score": None, "name": "Cleo", "n": "three"},
+        # Nested values are stored as JSON text
+        {"id": 3, "score": 1.0, "name": '{"a": [1]}', "n": None},
+    ]
+    assert invalid == [
+        (
+            {"id": "1.5", "score": "nan", "name": ["list"], "n": None},
+            [
+                'id: "1.5" is not a valid integer value',
+                'score: "nan" is not a valid real value',
+            ],
+        )
+    ]
+
+
+def _schema_types_mock(httpx_mock, schema):
+    bodies = []
+
+    def callback(request):
+        if request.url.path.endswith("/-/schema.json"):
+            if schema is None:
+                return httpx.Response(
+                    404, json={"ok": False, "errors": ["Table not found"]}
+                )
+            return httpx.Response(
+                200,
+                json={
+                    "ok": True,
+                    "database": "data",
+                    "table": "dogs",
+                    "schema": schema,
+                },
+            )
+        bodies.append(json.loads(request.read()))
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.add_callback(callback, is_reusable=True)
+    return bodies
+
+
+def _insert_schema_types(path, *args):
+    return CliRunner().invoke(
+        cli,
+        ["insert", "data", "dogs", str(path), "--csv", "--schema-types"]
+        + ["--token", "x", "-i", "https://datasette.example.com", "--batch-size", "2"]
+        + list(args),
+    )
+
+
+def test_insert_schema_types(httpx_mock, tmpdir):
+    bodies = _schema_types_mock(
+        httpx_mock,
+        "CREATE TABLE [dogs] ([id] INTEGER PRIMARY KEY, [name] TEXT, "
+        "[weight] REAL, [zip] VARCHAR(5))",
+    )
+    path = pathlib.Path(tmpdir) / "dogs.csv"
+    path.write_text(
+        "id,name,weight,zip\n1,Cleo,5.5,01234\n2,101,,02134\n3,Pancakes,4,0\n"
+    )
+    result = _insert_schema_types(path)
+    assert result.exit_code == 0, result.output
+    # Every batch is converted, not just the first - and zip stays text
+    assert [row for body in bodies for row in body["rows"]] == [
+        {"id": 1, "name": "Cleo", "weight": 5.5, "zip": "01234"},
+        {"id": 2, "name": "101", "weight": None, "zip": "02134"},
+        {"id": 3, "name": "Pancakes", "weight": 4.0, "zip": "0"},
+    ]
+
+
+def test_insert_schema_types_invalid_rows(httpx_mock, tmpdir):
+    bodies = _schema_types_mock(
+        httpx_mock, "CREATE TABLE dogs (id INTEGER PRIMARY KEY, weight REAL)"
+    )
+    path = pathlib.Path(tmpdir) / "dogs.csv"
+    path.write_text("id,weight\n1,5\ntwo,3\n3,heavy\n")
+    result = _insert_schema_types(path)
+    assert result.exit_code == 1
+    assert 'Error: Invalid row {"id": "two", "weight": "3"}: id: "two"' in result.output
+
+    bodies.clear()
+    rejects = pathlib.Path(tmpdir) / "rejects.ndjson"
+    result = _insert_schema_types(path, "--rejects", str(rejects))
+    assert result.exit_code == 0, result.output
+    assert "2 rejected rows were written to" in result.output
+    assert [row for body in bodies for row in body["rows"]] == [
+        {"id": 1, "weight": 5.0}
+    ]
+    assert [json.loads(line) for line in rejects.read_text().splitlines()] == [
+        {
+            "row": {"id": "two", "weight": "3"},
+            "errors": ['id: "two" is not a valid integer value'],
+        },
+        {
+            "row": {"id": "3", "weight": "heavy"},
+            "errors": ['weight: "heavy" is not a valid real value'],
+        },
+    ]
+
+
+def test_insert_schema_types_nested_json(httpx_mock, tmpdir):
+    bodies = _schema_types_mock(
+        httpx_mock, "CREATE TABLE [dogs] ([id] INTEGER PRIMARY KEY, [meta] TEXT)"
+    )
+    path = pathlib.Path(tmpdir) / "dogs.ndjson"
+    path.write_text(
+        '{"id": 1, "meta": {"a": 1, "name": "Bá"}}\n{"id": "2", "meta": [1, 2]}\n'
+    )
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "dogs", str(path), "--nl", "--schema-types"]
+        + ["--token", "x", "-i", "https://datasette.example.com"],
+    )
+    assert result.exit_code == 0, result.output
+    assert bodies[0]["rows"] == [
+        {"id": 1, "meta": '{"a": 1, "name": "Bá"}'},
+        {"id": 2, "meta": "[1, 2]"},
+    ]
+
+
+def test_insert_schema_types_missing_table(httpx_mock, tmpdir):
+    bodies = _schema_types_mock(httpx_mock, None)
+    path = pathlib.Path(tmpdir) / "dogs.csv"
+    path.write_text("id,name\n1,Cleo\n")
+    result = _insert_schema_types(path, "--create")
+    assert result.exit_code == 0, result.output
+    # Falls back to detecting types from the first batch
+    assert bodies[0]["rows"] == [{"id": 1, "name": "Cleo"}]
+
+
+def test_row_deduper_keeps_last_occurrence():
+    rows = [{"id": i % 4, "n": i} for i in range(10)]
+    deduper = _RowDeduper(["id"])
+    assert deduper.batch(rows[:6]) == [
+        {"id": 2, "n": 2},
+        {"id": 3, "n": 3},
+        {"id": 0, "n": 4},
+        {"id": 1, "n": 5},
+    ]
+    assert deduper.dropped == 2
+    # The window catches duplicates that are up to 4 rows apart
+    deduper = _RowDeduper(["id"], window=4)
+    assert list(deduper.rows(rows)) == [
+        {"id": 2, "n": 6},
+        {"id": 3, "n": 7},
+        {"id": 0, "n": 8},
+        {"id": 1, "n": 9},
+    ]
+    assert deduper.dropped == 6
+    # A smaller window bounds memory, at the cost of missing some duplicates
+    deduper = _RowDeduper(["id"], window=2)
+    assert len(list(deduper.rows(rows))) == 10
+    # For --ignore the first occurrence is kept
+    deduper = _RowDeduper(["id"], keep_first=True)
+    assert deduper.batch(rows[:6]) == [
+        {"id": 0, "n": 0},
+        {"id": 1, "n": 1},
+        {"id": 2, "n": 2},
+        {"id": 3, "n": 3},
+    ]
+    deduper = _RowDeduper(["id"], window=4, keep_first=True)
+    assert list(deduper.rows(rows)) == rows[:4]
+    assert deduper.dropped == 6
+    # For upsert, later rows are merged into the earlier ones
+    partial = [{"id": 1, "a": 1}, {"id": 2, "a": 2}, {"id": 1, "b": 3, "a": 4}]
+    merged = [{"id": 2, "a": 2}, {"id": 1, "a": 4, "b": 3}]
+    assert _RowDeduper(["id"], merge=True).batch(partial) == merged
+    assert list(_RowDeduper(["id"], window=4, merge=True).rows(partial)) == merged
+
+
+@pytest.mark.parametrize("args", ([], ["--dedupe-window", "10"]))
+def test_upsert_dedupe_pk_merges_columns(httpx_mock, tmpdir, args):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text('{"id": 7, "a": "x"}\n{"id": 8, "a": "z"}\n{"id": 7, "b": "y"}\n')
+    result = CliRunner().invoke(
+        cli,
+        ["upsert", "data", "t", str(path), "--pk", "id", "--dedupe-pk"]
+        + ["--token", "x", "-i", "https://datasette.example.com"]
+        + args,
+    )
+    assert result.exit_code == 0, result.output
+    bodies = [json.loads(request.read()) for request in httpx_mock.get_requests()]
+    assert [row for body in bodies for row in body["rows"]] == [
+        {"id": 8, "a": "z"},
+        {"id": 7, "a": "x", "b": "y"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    (
+        ([], [[2, 1], [1, 3]]),
+        (["--dedupe-window", "10"], [[2, 1, 3]]),
+    ),
+)
+def test_insert_dedupe_pk(httpx_mock, tmpdir, args, expected):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text(
+        "".join(
+            json.dumps({"id": id, "name": name}) + "\n"
+            for id, name in ((1, "a"), (2, "b"), (1, "c"), (3, "d"), (1, "e"), (3, "f"))
+        )
+    )
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(path), "--replace", "--pk", "id"]
+        + ["--dedupe-pk", "--batch-size", "3", "--token", "x"]
+        + ["-i", "https://datasette.example.com"]
+        + args,
+    )
+    assert result.exit_code == 0, result.output
+    bodies = [json.loads(request.read()) for request in httpx_mock.get_requests()]
+    assert [[row["id"] for row in body["rows"]] for body in bodies] == expected
+    names = {row["id"]: row["name"] for body in bodies for row in body["rows"]}
+    assert names == {1: "e", 2: "b", 3: "f"}
+    dropped = 6 - sum(len(ids) for ids in expected)
+    assert "Dropped {} duplicate rows".format(dropped) in result.output
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    (
+        ([], [[(1, "a"), (2, "b")], [(3, "d"), (1, "e")]]),
+        (["--dedupe-window", "10"], [[(1, "a"), (2, "b"), (3, "d")]]),
+    ),
+)
+def test_insert_dedupe_pk_ignore(httpx_mock, tmpdir, args, expected):
+    # --ignore keeps the first row for each key, so that is the one to send
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text(
+        "".join(
+            json.dumps({"id": id, "name": name}) + "\n"
+            for id, name in ((1, "a"), (2, "b"), (1, "c"), (3, "d"), (1, "e"), (3, "f"))
+        )
+    )
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(path), "--ignore", "--pk", "id"]
+        + ["--dedupe-pk", "--batch-size", "3", "--token", "x"]
+        + ["-i", "https://datasette.example.com"]
+        + args,
+    )
+    assert result.exit_code == 0, result.output
+    bodies = [json.loads(request.read()) for request in httpx_mock.get_requests()]
+    assert [
+        [(row["id"], row["name"]) for row in body["rows"]] for body in bodies
+    ] == expected
+
+
+@pytest.mark.parametrize(
+    "args,error",
+    (
+        (["--dedupe-pk"], "--dedupe-pk requires --pk"),
+        (["--dedupe-window", "5", "--pk", "id"], "--dedupe-window requires"),
+        (
+            ["--dedupe-pk", "--dedupe-window", "5", "--pk", "id", "--stream"],
+            "--dedupe-window cannot be used with --checkpoint or --stream",
+        ),
+    ),
+)
+def test_insert_dedupe_pk_errors(tmpdir, args, error):
+    path = pathlib.Path(tmpdir) / "data.csv"
+    path.write_text("id\n1\n")
+    result = CliRunner().invoke(
+        cli, ["insert", "data", "t", str(path), "--csv", "-i", "https://x.com"] + args
+    )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+def test_insert_table_field_routes_rows(httpx_mock, tmpdir):
+    lock = threading.Lock()
+    in_flight = collections.Counter()
+    max_in_flight = collections.Counter()
+    sent = collections.defaultdict(list)
+
+    def callback(request):
+        body = json.loads(request.read())
+        table = body.get("table") or request.url.path.split("/")[2]
+        with lock:
+            in_flight[table] += 1
+            in_flight["all"] += 1
+            max_in_flight[table] = max(max_in_flight[table], in_flight[table])
+            max_in_flight["all"] = max(max_in_flight["all"], in_flight["all"])
+        time.sleep(0.05)
+        with lock:
+            in_flight[table] -= 1
+            in_flight["all"] -= 1
+            sent[table].append((request.url.path, body["rows"]))
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.add_callback(callback, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "events.ndjson"
+    path.write_text(
+        "".join(
+            json.dumps({"type": ("click", "view", "buy")[i % 3], "id": i}) + "\n"
+            for i in range(18)
+        )
+    )
+    stats_path = pathlib.Path(tmpdir) / "stats.json"
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", str(path), "--table-field", "type", "--create"]
+        + ["--batch-size", "2", "--token", "x", "-i", "https://datasette.example.com"]
+        + ["--stats-json", str(stats_path)],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    assert "click: 6 rows" in result.output
+    # Each table keeps its own totals, which are added up at the end
+    report = json.loads(stats_path.read_text())
+    assert report["rows"] == 18
+    assert report["batches"] == 9
+    assert set(sent) == {"click", "view", "buy"}
+    for offset, table in enumerate(("click", "view", "buy")):
+        # Only the first batch for each table uses the create API
+        assert [path for path, rows in sent[table]] == ["/data/-/create"] + [
+            "/data/{}/-/insert".format(table)
+        ] * 2
+        assert [row for path, rows in sent[table] for row in rows] == [
+            {"id": i} for i in range(offset, 18, 3)
+        ]
+        assert max_in_flight[table] == 1
+    # Different tables were uploaded at the same time
+    assert max_in_flight["all"] > 1
+
+
+def test_insert_table_field_missing_value(httpx_mock, tmpdir):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "events.ndjson"
+    path.write_text('{"type": "a", "id": 1}\n{"id": 2}\n{"type": "", "id": 3}\n')
+    args = ["insert", "data", str(path), "--table-field", "type", "--token", "x"]
+    args += ["-i", "https://datasette.example.com"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 1
+    assert 'Error: Row has no type value: {"id": 2}' in result.output
+
+    rejects = pathlib.Path(tmpdir) / "rejects.ndjson"
+    result = CliRunner().invoke(cli, args + ["--rejects", str(rejects)])
+    assert result.exit_code == 0, result.output
+    assert "2 rejected rows were written to" in result.output
+    assert [json.loads(line)["row"] for line in rejects.read_text().splitlines()] == [
+        {"id": 2},
+        {"id": 3},
+    ]
+
+
+def test_insert_table_field_errors(tmpdir):
+    path = pathlib.Path(tmpdir) / "events.ndjson"
+    path.write_text('{"type": "a"}\n')
+    args = ["--table-field", "type", "-i", "https://x.com"]
+    result = CliRunner().invoke(cli, ["insert", "data", "t", str(path)] + args)
+    assert result.exit_code == 1
+    assert "Cannot use both TABLE and --table-field" in result.output
+    result = CliRunner().invoke(
+        cli, ["insert", "data", str(path), "--checkpoint", "c.json"] + args
+    )
+    assert result.exit_code == 1
+    assert "--table-field cannot be used with --checkpoint" in result.output
+
+
+def test_insert_multiple_files(httpx_mock, tmpdir):
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = []
+    sent = []
+
+    def callback(request):
+        with lock:
+            in_flight.append(1)
+            max_in_flight.append(len(in_flight))
+        time.sleep(0.02)
+        with lock:
+            in_flight.pop()
+            sent.extend(json.loads(request.read())["rows"])
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.add_callback(callback, is_reusable=True)
+    shards = pathlib.Path(tmpdir) / "shards"
+    shards.mkdir()
+    for i in range(5):
+        (shards / "day{}.csv".format(i)).write_text(
+            "id,day\n" + "".join("{},{}\n".format(i * 10 + j, i) for j in range(4))
+        )
+    (shards / "extra.ndjson").write_text('{"id": 100, "day": 9}\n')
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(shards / "*.csv"), str(shards / "extra.ndjson")]
+        + ["--files-concurrency", "3", "--batch-size", "2", "--stats"]
+        + ["--token", "x", "-i", "https://datasette.example.com"],
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    # Totals cover every file
+    assert "Rows: 21 in" in result.output
+    assert sorted(int(row["id"]) for row in sent) == sorted(
+        [i * 10 + j for i in range(5) for j in range(4)] + [100]
+    )
+    assert 1 < max(max_in_flight) <= 3
+
+
+def test_insert_multiple_files_error_names_file(httpx_mock, tmpdir):
+    def callback(request):
+        if json.loads(request.read())["rows"][0]["id"] == 2:
+            return httpx.Response(400, json={"ok": False, "errors": ["Bad row"]})
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.add_callback(callback, is_reusable=True)
+    good = pathlib.Path(tmpdir) / "good.ndjson"
+    good.write_text('{"id": 1}\n')
+    bad = pathlib.Path(tmpdir) / "bad.ndjson"
+    bad.write_text('{"id": 2}\n')
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(good), str(bad), "--token", "x"]
+        + ["-i", "https://datasette.example.com"],
+    )
+    assert result.exit_code == 1
+    assert "Error: {}: Bad row".format(bad) in result.output
+
+
+@pytest.mark.parametrize(
+    "paths,args,error",
+    (
+        (["*.csv"], [], "No files match"),
+        (["missing.csv"], [], "File missing.csv does not exist"),
+        (["a.csv", "-"], [], "Standard input cannot be combined with other files"),
+        (
+            ["a.csv", "b.csv"],
+            ["--checkpoint", "c.json"],
+            "cannot be used with multiple",
+        ),
+    ),
+)
+def test_insert_multiple_files_errors(tmpdir, monkeypatch, paths, args, error):
+    monkeypatch.chdir(tmpdir)
+    if paths[0] == "a.csv":
+        pathlib.Path("a.csv").write_text("id\n1\n")
+        pathlib.Path("b.csv").write_text("id\n2\n")
+    result = CliRunner().invoke(
+        cli, ["insert", "data", "t"] + paths + args + ["--csv", "-i", "https://x.com"]
+    )
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+def test_insert_fan_out_to_several_instances(httpx_mock, tmpdir, monkeypatch):
+    monkeypatch.setenv("DCLIENT_CONFIG_DIR", str(tmpdir))
+    (pathlib.Path(tmpdir) / "auth.json").write_text(
+        json.dumps(
+            {
+                "https://prod.example.com": "prod-token",
+                "https://staging.example.com": "staging-token",
+            }
+        )
+    )
+    staging_batches = []
+
+    def callback(request):
+        if request.url.host == "staging.example.com":
+            staging_batches.append(request)
+            if len(staging_batches) > 1:
+                return httpx.Response(500, json={"ok": False, "errors": ["Down"]})
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.add_callback(callback, is_reusable=True)
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text("".join(json.dumps({"id": i}) + "\n" for i in range(6)))
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(path), "--create", "--batch-size", "2"]
+        + ["-i", "https://prod.example.com", "-i", "https://staging.example.com"],
+    )
+    assert result.exit_code == 1
+    assert "https://prod.example.com: 6 rows sent" in result.output
+    assert (
+        "https://staging.example.com: 2 rows sent, then failed: Down" in result.output
+    )
+    requests = httpx_mock.get_requests()
+    prod = [r for r in requests if r.url.host == "prod.example.com"]
+    # Each instance has its own token, and its own first batch creates the table
+    assert {r.headers["authorization"] for r in prod} == {"Bearer prod-token"}
+    assert [r.url.path for r in prod] == ["/data/-/create"] + ["/data/t/-/insert"] * 2
+    assert {r.headers["authorization"] for r in staging_batches} == {
+        "Bearer staging-token"
+    }
+    # Staging was not sent anything after it failed
+    assert len(staging_batches) == 2
+
+
+def test_insert_fan_out_all_instances_fail(httpx_mock, tmpdir):
+    httpx_mock.add_response(
+        status_code=500, json={"ok": False, "errors": ["Down"]}, is_reusable=True
+    )
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text("".join(json.dumps({"id": i}) + "\n" for i in range(6)))
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(path), "--batch-size", "2", "--token", "x"]
+        + ["-i", "https://a.example.com", "-i", "https://b.example.com"],
+    )
+    assert result.exit_code == 1
+    assert "Error: Could not send to any of the instances" in result.output
+    assert len(httpx_mock.get_requests()) == 2
+
+
+def test_insert_fan_out_errors(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text('{"id": 1}\n')
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "t", str(path), "--rejects", "r.ndjson"]
+        + ["-i", "https://a.example.com", "-i", "https://b.example.com"],
+    )
+    assert result.exit_code == 1
+    assert "Multiple instances cannot be used with" in result.output
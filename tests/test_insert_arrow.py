@@ -0,0 +1,100 @@
+from click.testing import CliRunner
+from dclient.cli import cli
+import datetime
+import decimal
+import json
+import pathlib
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+import pyarrow.ipc  # noqa: E402
+import pyarrow.parquet  # noqa: E402
+
+TABLE = pa.table(
+    {
+        "id": [1, 2, 3],
+        "name": ["Cleo", "Pancakes", None],
+        "weight": [12.5, float("nan"), 30.0],
+        "born": [
+            datetime.date(2020, 1, 1),
+            datetime.date(2021, 6, 15),
+            datetime.date(2019, 3, 4),
+        ],
+        "price": pa.array(
+            [decimal.Decimal("1.50"), decimal.Decimal("2.25"), None],
+            type=pa.decimal128(5, 2),
+        ),
+    }
+)
+EXPECTED_ROWS = [
+    {"id": 1, "name": "Cleo", "weight": 12.5, "born": "2020-01-01", "price": 1.5},
+    {"id": 2, "name": "Pancakes", "weight": None, "born": "2021-06-15", "price": 2.25},
+    {"id": 3, "name": None, "weight": 30.0, "born": "2019-03-04", "price": None},
+]
+
+
+@pytest.fixture
+def non_mocked_hosts():
+    return ["localhost"]
+
+
+def _insert(httpx_mock, path, *args):
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    result = CliRunner().invoke(
+        cli,
+        [
+            "insert",
+            "data",
+            "dogs",
+            str(path),
+            "--token",
+            "x",
+            "-i",
+            "https://datasette.example.com",
+            "--batch-size",
+            "2",
+        ]
+        + list(args),
+        catch_exceptions=False,
+    )
+    assert result.exit_code == 0, result.output
+    return [json.loads(request.read())["rows"] for request in httpx_mock.get_requests()]
+
+
+@pytest.mark.parametrize("explicit", (True, False))
+def test_insert_parquet(httpx_mock, tmpdir, explicit):
+    path = pathlib.Path(tmpdir) / "dogs.parquet"
+    pyarrow.parquet.write_table(TABLE, path, row_group_size=3)
+    args = ["--parquet"] if explicit else []
+    assert _insert(httpx_mock, path, *args) == [EXPECTED_ROWS[:2], EXPECTED_ROWS[2:]]
+
+
+@pytest.mark.parametrize("stream", (True, False))
+def test_insert_arrow_ipc(httpx_mock, tmpdir, stream):
+    path = pathlib.Path(tmpdir) / "dogs.arrow"
+    with pa.OSFile(str(path), "wb") as sink:
+        new = pyarrow.ipc.new_stream if stream else pyarrow.ipc.new_file
+        with new(sink, TABLE.schema) as writer:
+            writer.write_table(TABLE)
+    assert _insert(httpx_mock, path, "--arrow") == [
+        EXPECTED_ROWS[:2],
+        EXPECTED_ROWS[2:],
+    ]
+
+
+@pytest.mark.parametrize(
+    "content,args",
+    (
+        ("id,name,weight\n1,Cleo,12.5\n2,Pancakes,\n", ["--arrow-csv"]),
+        ("id\tname\tweight\n1\tCleo\t12.5\n2\tPancakes\t\n", ["--arrow-csv", "--tsv"]),
+    ),
+)
+def test_insert_arrow_csv(httpx_mock, tmpdir, content, args):
+    path = pathlib.Path(tmpdir) / "dogs.csv"
+    path.write_text(content)
+    assert _insert(httpx_mock, path, *args) == [
+        [
+            {"id": 1, "name": "Cleo", "weight": 12.5},
+            {"id": 2, "name": "Pancakes", "weight": None},
+        ]
+    ]
@@ -0,0 +1,125 @@
+"""Tests for the lookup command."""
+
+import json
+import pathlib
+import urllib.parse
+
+import pytest
+from click.testing import CliRunner
+from datasette.app import Datasette
+
+from dclient.cli import _in_chunks, cli
+
+
+@pytest.fixture
+def datasette(httpx_mock, serve, run_async):
+    ds = Datasette()
+    db = ds.add_memory_database("lookup_test")
+
+    async def setup():
+        for table in await db.table_names():
+            await db.execute_write("drop table [{}]".format(table))
+        await db.execute_write("create table dogs (id integer primary key, name text)")
+        await db.execute_write_many(
+            "insert into dogs values (?, ?)",
+            [(i, "dog {}".format(i)) for i in range(1, 2501)]
+            + [(3000, "Cleo, the dog"), (3001, "[not json")],
+        )
+
+    run_async(setup())
+    serve(ds)
+    return httpx_mock
+
+
+def lookup(path, *args, input=None):
+    return CliRunner().invoke(
+        cli,
+        ["lookup", "lookup_test", "dogs", "--pks-from", str(path)]
+        + ["-i", "https://datasette.example.com"]
+        + list(args),
+        input=input,
+    )
+
+
+def test_lookup_in_input_order(datasette, tmpdir):
+    ids = [str(i) for i in range(2600, 0, -3)] + ["7", "7"]
+    path = pathlib.Path(tmpdir) / "ids.txt"
+    path.write_text("\n".join(ids) + "\n")
+    missing = pathlib.Path(tmpdir) / "missing.txt"
+    result = lookup(
+        path,
+        "--nl",
+        "--max-url-length",
+        "500",
+        "--concurrency",
+        "3",
+        "--missing",
+        str(missing),
+    )
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    rows = [json.loads(line) for line in lines if line.startswith("{")]
+    expected = [int(i) for i in ids if int(i) <= 2500]
+    assert [row["id"] for row in rows] == expected
+    assert rows[0] == {"id": 2498, "name": "dog 2498"}
+    not_found = [i for i in ids if int(i) > 2500]
+    assert missing.read_text().splitlines() == not_found
+    assert (
+        "34 keys were not found: 2600, 2597, 2594, 2591, 2588, 2585, 2582, 2579, "
+        "2576, 2573 and 24 more"
+    ) in result.output
+    urls = [str(request.url) for request in datasette.get_requests()]
+    assert len(urls) > 5
+    assert all(len(url) <= 500 for url in urls)
+
+
+def test_lookup_text_keys_from_csv(datasette, tmpdir):
+    path = pathlib.Path(tmpdir) / "names.csv"
+    path.write_text('name\n"Cleo, the dog"\n[not json\ndog 5\nnobody\n')
+    result = lookup(path, "--key", "name", "--csv")
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith(
+        'id,name\n3000,"Cleo, the dog"\n3001,[not json\n5,dog 5\n'
+    )
+    assert "1 keys were not found: nobody" in result.output
+
+
+@pytest.mark.parametrize(
+    "args,expected",
+    (
+        ([], '[\n  {\n    "id": 2,\n    "name": "dog 2"\n  },\n  {\n    "id": 1,'),
+        (["-t"], "id  name \n--  -----\n2   dog 2\n1   dog 1\n"),
+    ),
+)
+def test_lookup_from_stdin(datasette, tmpdir, args, expected):
+    result = lookup("-", *args, input="2\n1\n")
+    assert result.exit_code == 0, result.output
+    assert result.output.startswith(expected)
+
+
+def test_lookup_requires_key_column(tmpdir):
+    path = pathlib.Path(tmpdir) / "ids.csv"
+    path.write_text("name\nCleo\n")
+    result = lookup(path)
+    assert result.exit_code == 1
+    assert 'Row has no id value: {"name": "Cleo"}' in result.output
+
+
+def test_in_chunks():
+    keys = [str(i) for i in range(1000)] + ["a,b"] + [str(i) for i in range(50)]
+    url = "https://example.com"
+    chunks = list(_in_chunks(keys, url, "/db/t.json", "id", 300))
+    assert [key for chunk in chunks for key in chunk] == keys
+    for chunk in chunks:
+        if "a,b" in chunk:
+            value = json.dumps(chunk, separators=(",", ":"))
+        else:
+            value = ",".join(chunk)
+        query = urllib.parse.urlencode(
+            {"_shape": "objects", "_size": "max", "id__in": value}
+        )
+        length = len("{}/db/t.json?{}".format(url, query))
+        assert length <= 300
+        # Each chunk is as long as it can be
+        if chunk is not chunks[-1] and "a,b" not in chunk:
+            assert length > 300 - 8
@@ -0,0 +1,214 @@
+"""Tests for the push command."""
+
+from click.testing import CliRunner
+from datasette.app import Datasette
+from dclient.cli import cli
+import pathlib
+import pytest
+import sqlite3
+
+
+@pytest.fixture(params=[False, True], ids=["no-hash", "sha1"])
+def remote(request, serve, run_async):
+    if request.param:
+        request.getfixturevalue("sha1_function")
+    ds = Datasette(
+        config={
+            "permissions": {
+                "create-table": {"id": "*"},
+                "insert-row": {"id": "*"},
+                "update-row": {"id": "*"},
+                "delete-row": {"id": "*"},
+                "alter-table": {"id": "*"},
+            }
+        }
+    )
+    db = ds.add_memory_database("push_test")
+
+    async def setup():
+        for table in await db.table_names():
+            await db.execute_write("drop table [{}]".format(table))
+        return await ds.create_token("actor")
+
+    token = run_async(setup())
+    requests = []
+
+    def observe(request, response):
+        if response.status_code not in (301, 302):
+            requests.append(request)
+
+    serve(ds, observe=observe)
+
+    def rows(sql):
+        async def fetch():
+            return [tuple(row) for row in (await db.execute(sql)).rows]
+
+        return run_async(fetch())
+
+    def execute(sql):
+        run_async(db.execute_write(sql))
+
+    return token, rows, execute, requests, request.param
+
+
+def push(token, path, *args):
+    return CliRunner().invoke(
+        cli,
+        ["push", str(path), "push_test", "--token", token]
+        + ["-i", "http://datasette.example.com"]
+        + list(args),
+        catch_exceptions=False,
+    )
+
+
+@pytest.fixture
+def local_db(tmpdir):
+    path = pathlib.Path(tmpdir) / "local.db"
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        create table dogs (id integer primary key, name text, weight real, photo blob);
+        create table pairs (a text, b integer, value text, primary key (a, b));
+        create table no_pk (name text);
+        """
+    )
+    conn.executemany(
+        "insert into dogs values (?, ?, ?, ?)",
+        [(i, "dog {}".format(i), i / 3, bytes([i])) for i in range(1, 26)]
+        + [(26, None, None, None)],
+    )
+    conn.executemany(
+        "insert into pairs values (?, ?, ?)",
+        [("x", 1, "one"), ("x", 2, "two"), ("y/z", 1, "three")],
+    )
+    conn.commit()
+    return path, conn
+
+
+def test_push_creates_tables_then_syncs_changes(remote, local_db):
+    token, remote_rows, execute, requests, _ = remote
+    path, conn = local_db
+    result = push(token, path, "--chunk-size", "7", "--batch-size", "10")
+    assert result.exit_code == 0, result.output
+    assert "Skipping no_pk: it has no primary key" in result.output
+    assert "dogs: 26 upserted, 0 deleted, 0 unchanged" in result.output
+    local_dogs = conn.execute("select * from dogs order by id").fetchall()
+    assert remote_rows("select * from dogs order by id") == local_dogs
+
+    # Change the local database, and add a row that only exists remotely
+    conn.execute("update dogs set name = 'Cleo' where id = 3")
+    conn.execute("update dogs set weight = 1.5 where id = 20")
+    conn.execute("insert into dogs values (30, 'new', null, null)")
+    conn.execute("delete from dogs where id = 10")
+    conn.execute("update pairs set value = 'changed' where a = 'y/z'")
+    conn.commit()
+    execute("insert into dogs (id, name) values (40, 'remote only')")
+
+    requests.clear()
+    result = push(token, path, "--chunk-size", "7", "--dry-run")
+    assert result.exit_code == 0, result.output
+    assert "dogs: 3 to upsert, 2 to delete, 23 unchanged" in result.output
+    assert all(request.method == "GET" for request in requests)
+
+    result = push(token, path, "--chunk-size", "7")
+    assert result.exit_code == 0, result.output
+    assert "dogs: 3 upserted, 2 deleted, 23 unchanged" in result.output
+    assert "pairs: 1 upserted, 0 deleted, 2 unchanged" in result.output
+    assert (
+        remote_rows("select * from dogs order by id")
+        == conn.execute("select * from dogs order by id").fetchall()
+    )
+    assert (
+        remote_rows("select * from pairs order by a, b")
+        == conn.execute("select * from pairs order by a, b").fetchall()
+    )
+
+    # Nothing has changed, so only reads are needed
+    requests.clear()
+    result = push(token, path, "--chunk-size", "7")
+    assert result.exit_code == 0, result.output
+    assert "dogs: 0 upserted, 0 deleted, 26 unchanged" in result.output
+    assert all(request.method == "GET" for request in requests)
+
+
+def test_push_adds_missing_columns(remote, local_db):
+    token, remote_rows, execute, _, _ = remote
+    path, conn = local_db
+    conn.execute("insert into pairs values ('n', 5, null)")
+    conn.commit()
+    execute("create table pairs (a text, b integer, primary key (a, b))")
+    execute("insert into pairs (a, b) values ('x', 1), ('n', 5), ('q', 9)")
+    result = push(token, path, "--table", "pairs", "--batch-size", "1")
+    assert result.exit_code == 0, result.output
+    # The missing column compares as null, so rows are still matched up
+    assert "pairs: 3 upserted, 1 deleted, 1 unchanged" in result.output
+    assert (
+        remote_rows("select * from pairs order by a, b")
+        == conn.execute("select a, b, value from pairs order by a, b").fetchall()
+    )
+
+
+def test_push_missing_primary_key_column(remote, local_db):
+    token, _, execute, _, _ = remote
+    path, _ = local_db
+    execute("create table pairs (a text primary key, value text)")
+    result = push(token, path, "--table", "pairs")
+    assert result.exit_code == 1
+    assert (
+        "pairs: the remote table has no b column, so rows can't be matched by "
+        "primary key"
+    ) in result.output
+
+
+def test_push_table_names_are_tilde_encoded(remote, tmpdir):
+    token, remote_rows, _, _, _ = remote
+    path = pathlib.Path(tmpdir) / "odd.db"
+    conn = sqlite3.connect(path)
+    conn.execute("create table [odd/name.v~1] (id integer primary key, name text)")
+    conn.execute("insert into [odd/name.v~1] values (1, 'one'), (2, 'two')")
+    conn.commit()
+    assert push(token, path).exit_code == 0
+    conn.execute("delete from [odd/name.v~1] where id = 2")
+    conn.execute("update [odd/name.v~1] set name = 'uno'")
+    conn.commit()
+    result = push(token, path)
+    assert result.exit_code == 0, result.output
+    assert "odd/name.v~1: 1 upserted, 1 deleted, 0 unchanged" in result.output
+    assert remote_rows("select * from [odd/name.v~1]") == [(1, "uno")]
+
+
+def test_push_uses_aggregate_queries_when_server_can_hash(remote, local_db):
+    token, _, _, requests, can_hash = remote
+    path, _ = local_db
+    assert push(token, path, "--table", "dogs").exit_code == 0
+    requests.clear()
+    result = push(token, path, "--table", "dogs", "--chunk-size", "5")
+    assert result.exit_code == 0, result.output
+    sql = [request.url.params.get("sql", "") for request in requests]
+    row_by_row = [query for query in sql if query.startswith('select "id" as p0')]
+    if can_hash:
+        # One aggregate query per chunk, no row by row comparison
+        assert len([query for query in sql if "count(*)" in query]) == 6
+        assert not row_by_row
+    else:
+        assert len(row_by_row) == 6
+
+
+def test_push_unknown_table(tmpdir):
+    path = pathlib.Path(tmpdir) / "local.db"
+    sqlite3.connect(path).execute("create table t (id integer primary key)")
+    result = CliRunner().invoke(
+        cli,
+        ["push", str(path), "data", "--table", "missing", "-i", "https://x.com"],
+    )
+    assert result.exit_code == 1
+    assert "Table missing not found" in result.output
+
+
+@pytest.mark.parametrize("option", ("--chunk-size", "--batch-size", "--concurrency"))
+def test_push_options_must_be_positive(tmpdir, option):
+    path = pathlib.Path(tmpdir) / "data.db"
+    sqlite3.connect(str(path)).close()
+    result = push("x", path, option, "0")
+    assert result.exit_code == 2
+    assert "Invalid value for '{}'".format(option) in result.output
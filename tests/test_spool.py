@@ -0,0 +1,177 @@
+"""Tests for insert --spool and dclient spool flush."""
+
+from click.testing import CliRunner
+from dclient.cli import cli
+import httpx
+import json
+import pathlib
+import pytest
+import sqlite3
+
+
+@pytest.fixture
+def ndjson(tmpdir):
+    path = pathlib.Path(tmpdir) / "data.ndjson"
+    path.write_text("".join(json.dumps({"id": i}) + "\n" for i in range(1, 7)))
+    return path
+
+
+def insert(path, spool, *args):
+    return CliRunner().invoke(
+        cli,
+        ["insert", "data", "dogs", str(path), "--spool", str(spool)]
+        + ["--batch-size", "2", "--token", "secret-insert-token"]
+        + ["-i", "https://datasette.example.com"]
+        + list(args),
+    )
+
+
+def flush(spool, *args):
+    return CliRunner().invoke(
+        cli, ["spool", "flush", str(spool), "--token", "flush-token"] + list(args)
+    )
+
+
+def spooled(spool):
+    conn = sqlite3.connect(str(pathlib.Path(spool) / "spool.db"))
+    return conn.execute(
+        "select instance, database, table_name, url, body, rows from requests "
+        "order by id"
+    ).fetchall()
+
+
+def batch_ids(request):
+    return [row["id"] for row in json.loads(request.read())["rows"]]
+
+
+def test_spool_keeps_batches_in_order_after_a_failure(httpx_mock, ndjson, tmpdir):
+    spool = pathlib.Path(tmpdir) / "spool"
+    responses = iter(
+        [
+            httpx.Response(201, json={"ok": True}),
+            httpx.Response(503, text="Unavailable"),
+        ]
+    )
+    httpx_mock.add_callback(lambda request: next(responses), is_reusable=True)
+    result = insert(ndjson, spool, "--create")
+    assert result.exit_code == 0, result.output
+    assert (
+        "4 rows could not be sent and were spooled in {} - send them later with: "
+        "dclient spool flush {}".format(spool, spool)
+    ) in result.output
+    # The third batch was not sent, as it has to follow the second
+    assert [batch_ids(request) for request in httpx_mock.get_requests()] == [
+        [1, 2],
+        [3, 4],
+    ]
+    rows = spooled(spool)
+    assert [row[:4] for row in rows] == [
+        (
+            "https://datasette.example.com",
+            "data",
+            "dogs",
+            "https://datasette.example.com/data/dogs/-/insert",
+        )
+    ] * 2
+    assert [json.loads(row[4])["rows"] for row in rows] == [
+        [{"id": 3}, {"id": 4}],
+        [{"id": 5}, {"id": 6}],
+    ]
+    # Tokens are never written to the spool
+    assert b"secret-insert-token" not in (spool / "spool.db").read_bytes()
+
+    # A later insert into the same table queues up behind the spooled batches
+    result = insert(ndjson, spool)
+    assert result.exit_code == 0, result.output
+    assert "already waiting in" in result.output
+    assert len(httpx_mock.get_requests()) == 2
+    assert len(spooled(spool)) == 5
+
+    httpx_mock.reset()
+    httpx_mock.add_response(json={"ok": True}, is_reusable=True)
+    result = flush(spool)
+    assert result.exit_code == 0, result.output
+    assert "data/dogs: sent 10 rows in 5 batches" in result.output
+    requests = httpx_mock.get_requests()
+    assert [batch_ids(request) for request in requests] == [
+        [3, 4],
+        [5, 6],
+        [1, 2],
+        [3, 4],
+        [5, 6],
+    ]
+    assert {request.headers["authorization"] for request in requests} == {
+        "Bearer flush-token"
+    }
+    assert spooled(spool) == []
+    assert "Nothing to send" in flush(spool).output
+
+
+def test_spool_connection_errors(httpx_mock, ndjson, tmpdir):
+    spool = pathlib.Path(tmpdir) / "spool"
+    httpx_mock.add_exception(httpx.ConnectError("Connection refused"))
+    result = insert(ndjson, spool)
+    assert result.exit_code == 0, result.output
+    # Only one request is attempted, the rest go straight to the spool
+    assert len(httpx_mock.get_requests()) == 1
+    assert [row[5] for row in spooled(spool)] == [2, 2, 2]
+
+
+def test_spool_does_not_hold_rejected_rows(httpx_mock, ndjson, tmpdir):
+    spool = pathlib.Path(tmpdir) / "spool"
+    httpx_mock.add_response(
+        status_code=400, json={"ok": False, "errors": ["Bad row"]}, is_reusable=True
+    )
+    result = insert(ndjson, spool)
+    assert result.exit_code == 1
+    assert "Error: Bad row" in result.output
+    assert spooled(spool) == []
+
+
+def test_spool_flush_stops_each_table_at_first_failure(httpx_mock, tmpdir):
+    spool = pathlib.Path(tmpdir) / "spool"
+    for table in ("dogs", "cats"):
+        path = pathlib.Path(tmpdir) / "{}.ndjson".format(table)
+        path.write_text("".join(json.dumps({"id": i}) + "\n" for i in range(1, 7)))
+        httpx_mock.add_response(status_code=500, text="Error")
+        result = CliRunner().invoke(
+            cli,
+            ["insert", "data", table, str(path), "--spool", str(spool)]
+            + ["--batch-size", "2", "--token", "x"]
+            + ["-i", "https://datasette.example.com"],
+        )
+        assert result.exit_code == 0, result.output
+
+    def callback(request):
+        if "/dogs/" in request.url.path and batch_ids(request) == [3, 4]:
+            return httpx.Response(400, json={"ok": False, "errors": ["Bad row"]})
+        return httpx.Response(201, json={"ok": True})
+
+    httpx_mock.reset()
+    httpx_mock.add_callback(callback, is_reusable=True)
+    result = flush(spool, "--concurrency", "2")
+    assert result.exit_code == 1
+    assert "data/cats: sent 6 rows in 3 batches" in result.output
+    assert (
+        "data/dogs: sent 2 rows in 1 batches, stopped with 4 rows in 2 batches "
+        "still waiting: Bad row"
+    ) in result.output
+    assert [json.loads(row[4])["rows"] for row in spooled(spool)] == [
+        [{"id": 3}, {"id": 4}],
+        [{"id": 5}, {"id": 6}],
+    ]
+
+
+def test_spool_does_not_count_spooled_rows_as_sent(httpx_mock, ndjson, tmpdir):
+    spool = pathlib.Path(tmpdir) / "spool"
+    httpx_mock.add_response(status_code=503, text="Unavailable", is_reusable=True)
+    result = CliRunner().invoke(
+        cli,
+        ["insert", "data", "dogs", str(ndjson), "--spool", str(spool)]
+        + ["--batch-size", "2", "--token", "x", "--stats"]
+        + ["-i", "https://a.example.com", "-i", "https://b.example.com"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "https://a.example.com: 0 rows sent, 6 spooled" in result.output
+    assert "https://b.example.com: 0 rows sent, 6 spooled" in result.output
+    assert "Rows: 0 in" in result.output
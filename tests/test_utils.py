@@ -1,4 +1,4 @@
-from dclient.utils import token_for_url, url_matches_prefix
+from dclient.utils import percentile, tilde_encode, token_for_url, url_matches_prefix
 import pytest
 
 
@@ -65,3 +65,32 @@ def test_url_matches_prefix(url, prefix_url, expected):
 def test_token_for_url(url, tokens, expected):
     # Should always return longest matching of the available options
     assert token_for_url(url, tokens) == expected
+
+
+@pytest.mark.parametrize(
+    "values,pct,expected",
+    (
+        ([], 50, None),
+        ([5], 99, 5),
+        ([1, 2, 3, 4], 50, 2),
+        ([4, 3, 2, 1], 90, 4),
+        (list(range(1, 101)), 99, 99),
+        (list(range(1, 101)), 100, 100),
+    ),
+)
+def test_percentile(values, pct, expected):
+    assert percentile(values, pct) == expected
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    (
+        ("simple", "simple"),
+        ("one/two", "one~2Ftwo"),
+        ("three four", "three+four"),
+        ("a.b~c", "a~2Eb~7Ec"),
+        ("café", "caf~C3~A9"),
+    ),
+)
+def test_tilde_encode(value, expected):
+    assert tilde_encode(value) == expected
@@ -0,0 +1,246 @@
+"""Tests for insert and upsert --verify."""
+
+import json
+import pathlib
+
+import pytest
+from click.testing import CliRunner
+from datasette.app import Datasette
+
+from dclient.cli import cli
+
+
+@pytest.fixture
+def remote(request, serve, run_async):
+    # Parametrize with False for a server that can't hash rows
+    if getattr(request, "param", True):
+        request.getfixturevalue("sha1_function")
+    ds = Datasette(
+        config={
+            "permissions": {
+                "create-table": {"id": "*"},
+                "insert-row": {"id": "*"},
+                "update-row": {"id": "*"},
+                "alter-table": {"id": "*"},
+            }
+        }
+    )
+    db = ds.add_memory_database("verify_test")
+
+    async def setup():
+        for table in await db.table_names():
+            await db.execute_write("drop table [{}]".format(table))
+        return await ds.create_token("actor")
+
+    token = run_async(setup())
+    # Lets a test change the rows in a request before the server sees them
+    tamper = []
+
+    def rewrite(request, content):
+        if request.method == "POST" and tamper:
+            data = json.loads(content)
+            data["rows"] = tamper[0](data["rows"])
+            content = json.dumps(data).encode("utf-8")
+        return content
+
+    serve(ds, rewrite=rewrite)
+
+    def rows(sql):
+        async def fetch():
+            return [tuple(row) for row in (await db.execute(sql)).rows]
+
+        return run_async(fetch())
+
+    def execute(sql):
+        run_async(db.execute_write(sql))
+
+    return token, rows, execute, tamper
+
+
+def load(command, token, path, *args):
+    return CliRunner().invoke(
+        cli,
+        [command, "verify_test", "dogs", str(path), "--verify", "--token", token]
+        + ["-i", "http://datasette.example.com", "--batch-size", "3"]
+        + list(args),
+        catch_exceptions=False,
+    )
+
+
+def write_ndjson(tmpdir, rows):
+    path = pathlib.Path(tmpdir) / "dogs.ndjson"
+    path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    return path
+
+
+DOGS = [
+    {"id": 1, "name": "Cleo", "weight": 4.25, "toys": ["ball", "rope"]},
+    {"id": 2, "name": "Pancakes", "weight": None, "toys": {"best": "sock"}},
+    {"id": 3, "name": "Fido", "weight": 12, "toys": []},
+    # Added by --alter in the second batch, and stored with column affinity
+    {"id": "4", "name": "Rex", "weight": "5.5", "age": 3},
+    {"id": 5, "name": "Bá", "photo": {"$base64": True, "encoded": "AAEC"}},
+]
+
+
+def test_verify_insert(remote, tmpdir):
+    token, rows, _, _ = remote
+    path = write_ndjson(tmpdir, DOGS)
+    result = load("insert", token, path, "--create", "--pk", "id", "--alter")
+    assert result.exit_code == 0, result.output
+    assert "Verified 5 rows against the server's count and checksum" in result.output
+    assert rows("select id, weight, age from dogs where id = 4") == [(4, 5.5, 3)]
+
+    # Rows that were already in the table are left out of the check
+    path = write_ndjson(tmpdir, [{"id": i, "name": "new"} for i in range(6, 10)])
+    result = load("insert", token, path)
+    assert result.exit_code == 0, result.output
+    assert "Verified 4 rows" in result.output
+
+
+def test_verify_insert_rowid_table(remote, tmpdir):
+    token, _, execute, _ = remote
+    execute("create table dogs (name text)")
+    execute("insert into dogs (rowid, name) values (10, 'Old')")
+    path = write_ndjson(tmpdir, [{"name": "a"}, {"name": "b"}, {"rowid": 3}])
+    result = load("insert", token, path)
+    assert result.exit_code == 0, result.output
+    assert "Verified 3 rows" in result.output
+
+
+@pytest.mark.parametrize("args", ([], ["--replace"]))
+def test_verify_keys_assigned_by_server(remote, tmpdir, args):
+    token, rows, execute, tamper = remote
+    execute("create table dogs (id integer primary key, a text, b integer)")
+    if not args:
+        # --replace needs the table to start out empty
+        execute("insert into dogs values (10, 'old', 1)")
+    path = pathlib.Path(tmpdir) / "dogs.csv"
+    path.write_text("a,b\nx,1\ny,2\nz,3\nw,4\n")
+    result = load("insert", token, path, "--csv", *args)
+    assert result.exit_code == 0, result.output
+    assert "Verified 4 rows" in result.output
+    assert [row[1:] for row in rows("select * from dogs where a != 'old'")] == [
+        ("x", 1),
+        ("y", 2),
+        ("z", 3),
+        ("w", 4),
+    ]
+
+    # Rows with and without a key can be mixed, and changes are still found
+    execute("delete from dogs")
+    path = write_ndjson(tmpdir, [{"id": 5, "a": "x"}, {"a": "y"}, {"a": "z"}])
+    tamper.append(
+        lambda batch: [
+            dict(row, a="changed") if row["a"] == "z" else row for row in batch
+        ]
+    )
+    result = load("insert", token, path, *args)
+    assert result.exit_code == 1
+    assert "the server's checksum for the table does not match" in result.output
+
+
+def test_verify_detects_missing_rows(remote, tmpdir):
+    token, _, _, tamper = remote
+    path = write_ndjson(tmpdir, DOGS)
+    tamper.append(lambda batch: [row for row in batch if row["id"] != 2])
+    result = load("insert", token, path, "--create", "--pk", "id", "--alter")
+    assert result.exit_code == 1
+    assert (
+        "Verification failed: 5 rows were sent, but the table has 4 more rows "
+        "than before"
+    ) in result.output
+
+
+def test_verify_detects_changed_rows(remote, tmpdir):
+    token, _, _, tamper = remote
+    path = write_ndjson(tmpdir, DOGS)
+    tamper.append(
+        lambda batch: [
+            dict(row, name="changed") if row["id"] == 1 else row for row in batch
+        ]
+    )
+    result = load("insert", token, path, "--create", "--pk", "id", "--alter")
+    assert result.exit_code == 1
+    assert (
+        "Verification failed: the server's checksum for the table does not match "
+        "the 5 rows that were sent"
+    ) in result.output
+
+
+@pytest.mark.parametrize(
+    "command,args,expected",
+    (
+        ("upsert", [], "Pancakes"),
+        ("insert", ["--replace"], "Pancakes"),
+        ("insert", ["--ignore"], "Cleo"),
+    ),
+)
+def test_verify_repeated_keys(remote, tmpdir, command, args, expected):
+    token, rows, execute, _ = remote
+    execute("create table dogs (id integer primary key, name text)")
+    path = write_ndjson(
+        tmpdir,
+        [{"id": 1, "name": "Cleo"}, {"id": 2, "name": "Fido"}]
+        + [{"id": 3, "name": "Rex"}, {"id": 1, "name": "Pancakes"}],
+    )
+    result = load(command, token, path, *args)
+    assert result.exit_code == 0, result.output
+    assert "Verified 3 rows" in result.output
+    assert rows("select name from dogs where id = 1") == [(expected,)]
+
+    # Once the table has rows, they might be changed by the next load
+    result = load(command, token, path, *args)
+    assert result.exit_code == 1
+    assert (
+        "--verify can only be used with --replace, --ignore or upsert when the "
+        "table starts out empty"
+    ) in result.output
+
+
+@pytest.mark.parametrize("remote", [False], indirect=True)
+def test_verify_needs_hash_function(remote, tmpdir):
+    token, _, _, _ = remote
+    path = write_ndjson(tmpdir, DOGS)
+    result = load("insert", token, path, "--create")
+    assert result.exit_code == 1
+    assert (
+        "--verify needs the server to have a sha1(), sha256() or md5() SQL function"
+    ) in result.output
+
+
+def test_verify_cannot_be_used_with_dry_run(tmpdir):
+    path = write_ndjson(tmpdir, DOGS)
+    result = load("insert", "x", path, "--dry-run")
+    assert result.exit_code == 1
+    assert "--verify cannot be used with --dry-run" in result.output
+
+
+def test_verify_upsert_merges_columns(remote, tmpdir):
+    token, rows, execute, _ = remote
+    execute("create table dogs (id integer primary key, a integer, b integer)")
+    path = write_ndjson(
+        tmpdir,
+        [{"id": 1, "a": 1}, {"id": 2, "a": 2}, {"id": 3, "b": 3}]
+        + [{"id": 1, "b": 2}, {"id": 3, "b": None}],
+    )
+    result = load("upsert", token, path)
+    assert result.exit_code == 0, result.output
+    assert "Verified 3 rows" in result.output
+    assert rows("select * from dogs order by id") == [
+        (1, 1, 2),
+        (2, 2, None),
+        (3, None, None),
+    ]
+
+
+def test_verify_upsert_leaving_out_batch_columns(remote, tmpdir):
+    token, _, execute, _ = remote
+    execute("create table dogs (id integer primary key, a integer, b integer)")
+    path = write_ndjson(tmpdir, [{"id": 1, "a": 1}, {"id": 1, "b": 2}])
+    result = load("upsert", token, path)
+    assert result.exit_code == 1
+    assert (
+        "Could not verify: an upsert for a row that was already sent left out "
+        "columns that other rows in its batch have"
+    ) in result.output